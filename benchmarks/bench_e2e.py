@@ -0,0 +1,328 @@
+"""
+Сквозной офлайн-стенд: бот в этом же процессе, ролики отдаёт локальный HTTP-сервер
+(yt-dlp берёт их generic-экстрактором по прямой ссылке), Bot API — заглушка fake_telegram.py.
+Апдейты подаются в диспетчер (dp.feed_update), то есть проходят те же фильтры и хэндлеры:
+process_video_link для ссылок в личке, inline_handler и inline_chosen для инлайн-режима.
+
+Фазы: message (ссылки, которых нет в кэше), message_cached (те же ссылки повторно — из кэша),
+inline_query (ответ на инлайн-запрос), inline_chosen (выбор результата — скачивание и замена заглушки).
+Для каждой фазы: p50/p95/p99, задач в секунду, CPU (процесс + ffmpeg) и пиковый RSS процесса бота;
+для стадий конвейера (tgdl_stage_seconds) — то же по замерам внутри process_and_upload.
+CPU стадий при --concurrency больше 1 перекрывается между задачами — точен он при 1.
+Память ffmpeg не показываем: ru_maxrss дочерних в Linux включает RSS бота на момент fork.
+
+Клипы: синтетические MP4 (H.264/AAC, идут как TikTok) и WebM (VP9/Opus, идут как YouTube Shorts —
+им нужен перекод), если есть ffmpeg; либо свои файлы аргументами. Сеть не нужна.
+
+Запуск из корня репозитория:
+    python benchmarks/bench_e2e.py [--jobs 40] [--concurrency 8] [--upload-delay 0.05] [clip.mp4 ...]
+"""
+import os
+import sys
+import time
+import json
+import shutil
+import asyncio
+import logging
+import argparse
+import resource
+import tempfile
+import itertools
+from contextlib import contextmanager
+
+from aiohttp import web
+from aiogram.types import Update
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.dirname(HERE))
+
+from fake_telegram import FakeTelegram  # noqa: E402
+
+# (имя, кодеки и контейнер) — ffmpeg-аргументы синтетических клипов
+SYNTHETIC_CLIPS = (
+    ("clip.mp4", ["-c:v", "libx264", "-preset", "veryfast", "-pix_fmt", "yuv420p",
+                  "-c:a", "aac", "-movflags", "+faststart"]),
+    ("clip.webm", ["-c:v", "libvpx-vp9", "-deadline", "realtime", "-cpu-used", "8", "-c:a", "libopus"]),
+)
+# платформа и вид ссылки, под которой клип показывается боту (id подставляется свой на каждую задачу)
+PLATFORM_BY_EXT = {
+    ".mp4": ("tiktok", "https://www.tiktok.com/@bench/video/{n}"),
+    ".webm": ("youtube_shorts", "https://www.youtube.com/shorts/{n:011d}"),
+}
+CONTENT_TYPES = {".mp4": "video/mp4", ".webm": "video/webm"}
+USER_BASE = 50_000
+
+
+def percentile(values: list[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))] if values else 0.0
+
+
+def cpu_seconds() -> float:
+    """CPU этого процесса и завершившихся дочерних (ffmpeg/ffprobe), user + system."""
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+def peak_rss_mb() -> float:
+    """Пик RSS процесса в МБ (ru_maxrss в Linux — в КБ)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class StageRecorder:
+    """Подменяет metrics.STAGE_SECONDS.time: сырые длительности и CPU стадий (гистограмма тоже пишется)."""
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self.samples: dict[tuple[str, str], list[tuple[float, float]]] = {}
+        self.rss: dict[tuple[str, str], float] = {}
+
+    @contextmanager
+    def time(self, **labels):
+        start, cpu = time.perf_counter(), cpu_seconds()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.histogram.observe(elapsed, **labels)
+            key = (labels.get("stage", ""), labels.get("platform", ""))
+            self.samples.setdefault(key, []).append((elapsed, cpu_seconds() - cpu))
+            self.rss[key] = max(self.rss.get(key, 0.0), peak_rss_mb())
+
+
+async def make_clips(workdir: str, seconds: int, ffmpeg: str) -> list[str]:
+    paths = []
+    for name, codec_args in SYNTHETIC_CLIPS:
+        path = os.path.join(workdir, name)
+        proc = await asyncio.create_subprocess_exec(
+            ffmpeg, "-y", "-loglevel", "error",
+            "-f", "lavfi", "-i", f"testsrc2=size=720x1280:rate=30:duration={seconds}",
+            "-f", "lavfi", "-i", f"sine=frequency=440:sample_rate=48000:duration={seconds}",
+            *codec_args, "-shortest", path,
+        )
+        if await proc.wait() == 0:
+            paths.append(path)
+        else:
+            print(f"Не удалось сгенерировать {name} (нет кодека в этой сборке ffmpeg?) — пропускаю")
+    return paths
+
+
+async def start_media_server(clips: list[str]) -> tuple[web.AppRunner, str]:
+    """/media/<номер клипа>/<id>.<ext>: любой id отдаёт тот же файл — для бота это разные ролики."""
+    blobs = []
+    for path in clips:
+        with open(path, "rb") as f:
+            blobs.append((f.read(), CONTENT_TYPES.get(os.path.splitext(path)[1], "application/octet-stream")))
+
+    async def media(request: web.Request) -> web.Response:
+        body, content_type = blobs[int(request.match_info["clip"])]
+        return web.Response(body=body, content_type=content_type)
+
+    app = web.Application()
+    app.router.add_get("/media/{clip}/{name}", media)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    return runner, f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}/media"
+
+
+class Bench:
+    def __init__(self, app, api: FakeTelegram, clips: list[str], media_base: str, concurrency: int):
+        self.app = app
+        self.api = api
+        self.clips = clips
+        self.media_base = media_base
+        self.concurrency = concurrency
+        self.update_ids = itertools.count(1)
+        self.local_urls: dict[str, str] = {}  # ссылка платформы (или 'платформа:id') -> адрес на локальном сервере
+        self.results: list[tuple[str, list[float], float, float, float]] = []
+
+    def job_url(self, n: int) -> str:
+        index = n % len(self.clips)
+        ext = os.path.splitext(self.clips[index])[1]
+        _platform, template = PLATFORM_BY_EXT.get(ext, PLATFORM_BY_EXT[".mp4"])
+        url = template.format(n=n)
+        self.local_urls[url] = f"{self.media_base}/{index}/{n}{ext}"
+        self.local_urls[f"{_platform}:{n}"] = self.local_urls[url]
+        return url
+
+    def patch_bot(self) -> None:
+        """Платформу и id бот определяет по настоящей ссылке, а качает yt-dlp с локального сервера."""
+        normalize = self.app.normalize_url
+
+        async def bench_normalize(url: str, resolve: bool = True):
+            normalized = await normalize(url, resolve)
+            if normalized and url.strip() in self.local_urls:
+                platform, canonical_id, _url = normalized
+                return platform, canonical_id, self.local_urls[url.strip()]
+            return normalized
+
+        self.app.normalize_url = bench_normalize
+        # инлайн-режим восстанавливает ссылку по id результата ('v:<платформа>:<id>')
+        canonical = self.app.canonical_url
+        self.app.canonical_url = lambda platform, canonical_id: (
+            self.local_urls.get(f"{platform}:{canonical_id}") or canonical(platform, canonical_id)
+        )
+
+    def update(self, **event) -> Update:
+        return Update.model_validate({"update_id": next(self.update_ids), **event}, context={"bot": self.app.bot})
+
+    def message_update(self, user_id: int, text: str):
+        return self.update(message={
+            "message_id": next(self.update_ids),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+            "text": text,
+        })
+
+    async def feed(self, update) -> float:
+        start = time.perf_counter()
+        await self.app.dp.feed_update(self.app.bot, update)
+        return time.perf_counter() - start
+
+    async def phase(self, name: str, jobs: list) -> list:
+        """Запускает корутины-фабрики jobs по concurrency штук; каждая возвращает длительность."""
+        sem = asyncio.Semaphore(self.concurrency)
+        latencies: list[float] = []
+        outputs: list = []
+
+        async def run(job) -> None:
+            async with sem:
+                latency, output = await job()
+                latencies.append(latency)
+                outputs.append(output)
+
+        cpu = cpu_seconds()
+        start = time.perf_counter()
+        await asyncio.gather(*(run(job) for job in jobs))
+        wall = time.perf_counter() - start
+        self.results.append((name, latencies, wall, cpu_seconds() - cpu, peak_rss_mb()))
+        return outputs
+
+    async def run_messages(self, name: str, numbers: list[int]) -> None:
+        def job(n: int):
+            async def go():
+                return await self.feed(self.message_update(USER_BASE + n, self.job_url(n))), None
+            return go
+        await self.phase(name, [job(n) for n in numbers])
+
+    async def run_inline(self, numbers: list[int]) -> None:
+        def query(n: int):
+            async def go():
+                user_id = USER_BASE + n
+                query_id = f"q{n}"
+                latency = await self.feed(self.update(inline_query={
+                    "id": query_id,
+                    "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+                    "query": self.job_url(n),
+                    "offset": "",
+                }))
+                answer = self.api.inline_answers.get(query_id) or []
+                return latency, (user_id, answer[0]["id"]) if answer else None
+            return go
+
+        chosen = [c for c in await self.phase("inline_query", [query(n) for n in numbers]) if c]
+
+        def choose(user_id: int, result_id: str):
+            async def go():
+                return await self.feed(self.update(chosen_inline_result={
+                    "result_id": result_id,
+                    "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+                    "query": "",
+                    "inline_message_id": f"inline-{result_id}",
+                })), None
+            return go
+        await self.phase("inline_chosen", [choose(*c) for c in chosen])
+
+    def report(self, stages: StageRecorder) -> None:
+        print(f"\n{'фаза':<16} {'задач':>6} {'p50, мс':>9} {'p95, мс':>9} {'p99, мс':>9} {'задач/с':>8} "
+              f"{'CPU, с':>7} {'RSS, МБ':>8}")
+        for name, latencies, wall, cpu, rss in self.results:
+            print(f"{name:<16} {len(latencies):6d} {percentile(latencies, .5) * 1e3:9.1f} "
+                  f"{percentile(latencies, .95) * 1e3:9.1f} {percentile(latencies, .99) * 1e3:9.1f} "
+                  f"{len(latencies) / wall if wall else 0:8.1f} {cpu:7.2f} {rss:8.1f}")
+
+        print(f"\n{'стадия':<24} {'раз':>5} {'p50, мс':>9} {'p95, мс':>9} {'p99, мс':>9} "
+              f"{'CPU, с':>7} {'RSS, МБ':>8}")
+        for (stage, platform), samples in sorted(stages.samples.items()):
+            wall = [s[0] for s in samples]
+            print(f"{stage + '/' + platform:<24} {len(samples):5d} {percentile(wall, .5) * 1e3:9.1f} "
+                  f"{percentile(wall, .95) * 1e3:9.1f} {percentile(wall, .99) * 1e3:9.1f} "
+                  f"{sum(s[1] for s in samples):7.2f} {stages.rss[(stage, platform)]:8.1f}")
+
+        outcomes = {f"{platform}/{result}": int(v) for (platform, result), v in self.app.metrics.JOBS._values.items()}
+        print(f"\nитоги задач: {json.dumps(outcomes, ensure_ascii=False)}")
+        print(f"решения конвейера: {dict(self.app.pipeline_counters)}")
+        print(f"загружено в заглушку: {self.api.bytes_uploaded / 1024 / 1024:.1f} МБ, "
+              f"правок статуса: {self.api.count('editMessageText')}")
+
+
+async def main(args: argparse.Namespace) -> None:
+    api = FakeTelegram(upload_delay=args.upload_delay)
+    await api.start()
+    workdir = tempfile.mkdtemp(prefix="bench-e2e-")
+    # настройки бота читаются при импорте — задаём их до import bot
+    os.environ.update({
+        "BOT_TOKEN": "123456:bench",
+        "TELEGRAM_API_SERVER": api.base,
+        "CACHE_DB": os.path.join(workdir, "file_ids.sqlite3"),
+        "WORKSPACE_DIR": os.path.join(workdir, "work"),
+        "JOB_QUEUE": "",
+        "INLINE_DEBOUNCE": str(args.inline_debounce),
+        "INLINE_PLACEHOLDER_FILE_ID": "bench-placeholder",
+        "INLINE_UPLOAD_CHAT_ID": "-100",
+        "MAX_QUEUED_JOBS": str(max(50, args.concurrency * 2)),
+    })
+    import bot as app
+    logging.getLogger().setLevel(args.log_level)
+
+    stages = StageRecorder(app.metrics.STAGE_SECONDS)
+    app.metrics.STAGE_SECONDS.time = stages.time
+    media_runner = None
+    try:
+        clips = args.clips
+        if not clips:
+            ffmpeg = app.FFMPEG_PATH if os.path.exists(app.FFMPEG_PATH) else shutil.which("ffmpeg")
+            if not ffmpeg:
+                sys.exit("ffmpeg не найден — положите его в bin/ или в PATH, либо передайте свои клипы")
+            print("Генерирую синтетические клипы…")
+            clips = await make_clips(workdir, args.seconds, ffmpeg)
+        print(f"Клипы: {', '.join(f'{os.path.basename(c)} ({os.path.getsize(c) / 1024:.0f} КБ)' for c in clips)}")
+        media_runner, media_base = await start_media_server(clips)
+
+        bench = Bench(app, api, clips, media_base, args.concurrency)
+        bench.patch_bot()
+        numbers = list(range(1, args.jobs + 1))
+        await bench.run_messages("message", numbers)
+        await bench.run_messages("message_cached", numbers)
+        await bench.run_inline(list(range(args.jobs + 1, 2 * args.jobs + 1)))
+        print(f"задач: {args.jobs} на фазу, параллельно: {args.concurrency}, "
+              f"задержка загрузки: {args.upload_delay * 1e3:.0f} мс")
+        bench.report(stages)
+    finally:
+        if media_runner:
+            await media_runner.cleanup()
+        await app.bot.session.close()
+        await app.close_urls_session()
+        await app.progress_updater.close()
+        await app.workspace.close()
+        app.scheduler.shutdown()
+        app.ydl_pool.close()
+        await api.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("clips", nargs="*", help="свои .mp4/.webm вместо синтетических")
+    parser.add_argument("--jobs", type=int, default=40, help="задач в каждой фазе")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--seconds", type=int, default=5, help="длина синтетических клипов")
+    parser.add_argument("--upload-delay", type=float, default=0.0, help="имитация загрузки в Телеграм, сек")
+    parser.add_argument("--inline-debounce", type=float, default=0.0)
+    parser.add_argument("--log-level", default="WARNING")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,102 @@
+"""
+Бенчмарк параллельных фрагментов: локальный HLS (плейлист + сегменты с задержкой ответа,
+как у CDN далеко от сервера) качается yt-dlp с разным concurrent_fragment_downloads,
+а затем серией загрузок с FragmentTuner, который сам подбирает уровень. Сеть не нужна.
+
+Запуск из корня репозитория:
+    python benchmarks/bench_fragments.py [--segments 60] [--segment-kb 256] [--latency 0.08] [--downloads 12]
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import tempfile
+import threading
+
+from aiohttp import web
+import yt_dlp
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from download_profiles import FRAGMENT_LADDER, FragmentTuner  # noqa: E402
+
+
+def start_server(segments: int, segment_size: int, latency: float) -> str:
+    payload = os.urandom(segment_size)
+    playlist = "\n".join(
+        ["#EXTM3U", "#EXT-X-VERSION:3", "#EXT-X-TARGETDURATION:2", "#EXT-X-MEDIA-SEQUENCE:0"]
+        + [f"#EXTINF:2.0,\nseg{i}.ts" for i in range(segments)]
+        + ["#EXT-X-ENDLIST", ""]
+    )
+
+    async def index(request: web.Request) -> web.Response:
+        return web.Response(text=playlist, content_type="application/vnd.apple.mpegurl")
+
+    async def segment(request: web.Request) -> web.Response:
+        await asyncio.sleep(latency)
+        return web.Response(body=payload, content_type="video/mp2t")
+
+    loop = asyncio.new_event_loop()
+    ready = threading.Event()
+    address = {}
+
+    async def run() -> None:
+        app = web.Application()
+        app.router.add_get("/hls/{n}/index.m3u8", index)
+        app.router.add_get("/hls/{n}/{segment}", segment)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        address["port"] = site._server.sockets[0].getsockname()[1]
+        ready.set()
+
+    threading.Thread(target=lambda: (loop.run_until_complete(run()), loop.run_forever()), daemon=True).start()
+    ready.wait()
+    return f"http://127.0.0.1:{address['port']}/hls"
+
+
+def download(url: str, workdir: str, name: str, fragments: int, hook=None) -> float:
+    opts = {
+        "quiet": True, "no_warnings": True, "noprogress": True, "fixup": "never",
+        "outtmpl": os.path.join(workdir, f"{name}.%(ext)s"),
+        "concurrent_fragment_downloads": fragments,
+        "progress_hooks": [hook] if hook else [],
+    }
+    start = time.perf_counter()
+    with yt_dlp.YoutubeDL(opts) as ydl:
+        ydl.extract_info(url, download=True)
+    return time.perf_counter() - start
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--segments", type=int, default=60)
+    parser.add_argument("--segment-kb", type=int, default=256)
+    parser.add_argument("--latency", type=float, default=0.08, help="задержка ответа на сегмент, сек")
+    parser.add_argument("--downloads", type=int, default=12, help="загрузок подряд с FragmentTuner")
+    args = parser.parse_args()
+
+    base = start_server(args.segments, args.segment_kb * 1024, args.latency)
+    size_mb = args.segments * args.segment_kb / 1024
+    print(f"HLS: {args.segments} сегментов по {args.segment_kb} КБ ({size_mb:.1f} МБ), задержка {args.latency * 1e3:.0f} мс")
+    with tempfile.TemporaryDirectory(prefix="bench-fragments-") as workdir:
+        print(f"  {'фрагментов':>10} {'время, с':>9} {'МБ/с':>7}")
+        for n in FRAGMENT_LADDER:
+            elapsed = download(f"{base}/fixed{n}/index.m3u8", workdir, f"fixed{n}", n)
+            print(f"  {n:>10} {elapsed:9.2f} {size_mb / elapsed:7.1f}")
+
+        tuner = FragmentTuner(adaptive=True, probe_every=5)
+        print(f"\nFragmentTuner, {args.downloads} загрузок (платформа twitter):")
+        total = 0.0
+        for i in range(args.downloads):
+            level = tuner.level("twitter")
+            elapsed = download(f"{base}/tuned{i}/index.m3u8", workdir, f"tuned{i}", level, tuner.hook("twitter", level))
+            total += elapsed
+            print(f"  #{i + 1:<3} фрагментов {level:>2}: {elapsed:6.2f} с")
+        print(f"  всего {total:.2f} с, {tuner.stats()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""
+Бенчмарк профилей перекода: старый `libx264 -preset ultrafast -crf 23` против планов transcode.py
+(auto / capped / 2pass) на синтетических клипах (ffmpeg testsrc2 + sine) или своих файлах.
+Для каждого клипа и профиля печатает время кодирования, размер выхода и влез ли он в лимит.
+Нужны ffmpeg и ffprobe (bin/ или в PATH); сеть не нужна.
+
+Запуск из корня репозитория:
+    python benchmarks/bench_transcode.py [--limit-mb 8] [--threads 2] [clip.mp4 ...]
+"""
+import os
+import sys
+import time
+import shutil
+import asyncio
+import argparse
+import tempfile
+from dataclasses import replace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import transcode  # noqa: E402
+from media import ffmpeg_bin, probe_media_async, run_ffmpeg  # noqa: E402
+
+# (имя, ширина, высота, секунд) — вертикальные ролики, как в TikTok/Shorts/Reels, и один горизонтальный
+SYNTHETIC_CLIPS = (
+    ("vertical_720p_15s", 720, 1280, 15),
+    ("vertical_1080p_30s", 1080, 1920, 30),
+    ("landscape_1080p_60s", 1920, 1080, 60),
+)
+
+
+async def make_clip(workdir: str, name: str, width: int, height: int, seconds: int) -> str:
+    """Клип с движением и шумом (иначе x264 сожмёт его в ничто) + стерео AAC, с высоким битрейтом."""
+    path = os.path.join(workdir, f"{name}.mp4")
+    await run_ffmpeg([
+        "-y",
+        "-f", "lavfi", "-i", f"testsrc2=size={width}x{height}:rate=30:duration={seconds}",
+        "-f", "lavfi", "-i", f"sine=frequency=440:sample_rate=48000:duration={seconds}",
+        "-vf", "noise=alls=20:allf=t",
+        "-c:v", "libx264", "-preset", "ultrafast", "-qp", "12", "-pix_fmt", "yuv420p",
+        "-c:a", "aac", "-b:a", "192k", "-shortest", path,
+    ], timeout=600)
+    return path
+
+
+async def legacy(path: str, out: str, threads: int) -> None:
+    await run_ffmpeg([
+        "-y", "-i", path,
+        "-c:v", "libx264", "-preset", "ultrafast", "-crf", "23",
+        "-profile:v", "high", "-level:v", "4.0", "-pix_fmt", "yuv420p",
+        "-c:a", "aac", "-b:a", "128k", "-movflags", "+faststart",
+        "-vf", "scale=trunc(iw/2)*2:trunc(ih/2)*2", out,
+    ], timeout=1800, threads=threads)
+
+
+async def bench_clip(path: str, limit: int, threads: int, workdir: str) -> None:
+    info = await probe_media_async(path)
+    if not info:
+        print(f"{path}: ffprobe не смог прочитать файл")
+        return
+    print(f"\n{os.path.basename(path)}: {info.width}x{info.height}, {info.duration:.1f} с, "
+          f"{info.size / 1024 / 1024:.1f} МБ, {info.vcodec}/{info.acodec}")
+    plan = transcode.plan_transcode(info, limit, threads)
+    profiles = [("legacy ultrafast crf23", None)]
+    if plan is None:
+        print("  план: ролик не сжать под лимит даже на минимальном битрейте")
+    else:
+        profiles += [
+            (f"auto ({plan.mode})", plan),
+            ("capped", replace(plan, mode="capped")),
+            ("2pass", replace(plan, mode="2pass")),
+        ]
+        print(f"  план: {plan}")
+
+    print(f"  {'профиль':<24} {'время, с':>9} {'размер, МБ':>11} {'x realtime':>11}  лимит")
+    for name, profile in profiles:
+        out = os.path.join(workdir, "out.mp4")
+        start = time.perf_counter()
+        if profile is None:
+            await legacy(path, out, threads)
+        else:
+            await transcode.encode(profile, path, out, info, timeout=1800)
+        elapsed = time.perf_counter() - start
+        size = os.path.getsize(out)
+        verdict = "влез" if size <= limit else "НЕ влез"
+        print(f"  {name:<24} {elapsed:9.2f} {size / 1024 / 1024:11.2f} {info.duration / elapsed:11.1f}  {verdict}")
+        os.remove(out)
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("clips", nargs="*", help="свои файлы вместо синтетических")
+    parser.add_argument("--limit-mb", type=float, default=8.0, help="лимит размера (маленький, чтобы план сжимал)")
+    parser.add_argument("--threads", type=int, default=2)
+    args = parser.parse_args()
+
+    if not shutil.which(ffmpeg_bin()) and not os.path.exists(ffmpeg_bin()):
+        sys.exit("ffmpeg не найден — положите его в bin/ или в PATH")
+    limit = int(args.limit_mb * 1024 * 1024)
+    with tempfile.TemporaryDirectory(prefix="bench-transcode-") as workdir:
+        clips = args.clips
+        if not clips:
+            print("Генерирую синтетические клипы…")
+            clips = [await make_clip(workdir, *spec) for spec in SYNTHETIC_CLIPS]
+        print(f"Лимит {args.limit_mb} МБ, потоков x264: {args.threads}")
+        for path in clips:
+            await bench_clip(path, limit, args.threads, workdir)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
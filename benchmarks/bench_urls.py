@@ -0,0 +1,88 @@
+"""
+Бенчмарк нормализации ссылок: старая проверка подстрок vs precompiled-шаблоны urls.py,
+плюс разворот коротких ссылок (холодный и из кэша) через локальный aiohttp-сервер — сеть не нужна.
+
+Запуск из корня репозитория:  python benchmarks/bench_urls.py
+"""
+import os
+import sys
+import time
+import asyncio
+import timeit
+
+from aiohttp import web
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import urls  # noqa: E402
+
+SAMPLE_URLS = [
+    "https://www.tiktok.com/@someone/video/7234567890123456789?is_from_webapp=1&sender_device=pc",
+    "https://m.tiktok.com/v/7234567890123456789.html",
+    "https://www.instagram.com/reel/CxYz123AbC/?igshid=MzRlODBiNWFlZA==",
+    "https://instagram.com/p/CxYz123AbC/",
+    "https://www.youtube.com/shorts/dQw4w9WgXcQ?feature=share",
+    "https://www.youtube.com/watch?list=PL123&v=dQw4w9WgXcQ&t=42s",
+    "https://youtu.be/dQw4w9WgXcQ?si=abcdef",
+    "https://x.com/someone/status/1712345678901234567?s=20",
+    "https://twitter.com/i/web/status/1712345678901234567",
+    "https://example.com/not/a/video",
+    "https://notx.com/status/1",
+]
+
+
+def legacy_platform(url: str):
+    """Копия старого get_platform_from_url (проверка подстрок) — для сравнения."""
+    u = url.lower()
+    if "tiktok.com" in u:
+        return "tiktok"
+    if "instagram.com" in u:
+        return "instagram"
+    if "youtube.com" in u or "youtu.be" in u:
+        return "youtube_shorts"
+    if "twitter.com" in u or "x.com" in u:
+        return "twitter"
+    return None
+
+
+def bench_matching(number: int = 20000) -> None:
+    for name, fn in (("legacy substring", legacy_platform), ("urls.match_url", urls.match_url)):
+        t = timeit.timeit(lambda: [fn(u) for u in SAMPLE_URLS], number=number)
+        per_url = t / (number * len(SAMPLE_URLS)) * 1e6
+        print(f"{name:<18} {per_url:7.2f} мкс/ссылка")
+    print()
+    for u in SAMPLE_URLS:
+        print(f"  {legacy_platform(u)!s:<15} {urls.match_url(u)!s:<90} {u}")
+
+
+async def bench_redirects(count: int = 200) -> None:
+    async def short(request: web.Request) -> web.Response:
+        raise web.HTTPFound(f"/@someone/video/{request.match_info['code']}")
+
+    async def target(request: web.Request) -> web.Response:
+        return web.Response(text="ok")
+
+    app = web.Application()
+    app.router.add_get("/t/{code}", short)
+    app.router.add_get("/@someone/video/{code}", target)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    links = [f"http://127.0.0.1:{port}/t/{i}" for i in range(count)]
+    try:
+        for label in ("холодный", "из кэша"):
+            start = time.perf_counter()
+            await asyncio.gather(*(urls.resolve_redirect(link) for link in links))
+            elapsed = time.perf_counter() - start
+            print(f"resolve_redirect {label:<9} {elapsed / count * 1e3:7.3f} мс/ссылка ({count} шт.)")
+    finally:
+        await urls.close_session()
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    bench_matching()
+    print()
+    asyncio.run(bench_redirects())
@@ -0,0 +1,119 @@
+"""
+Стенд webhook-режима: бот (BOT_MODE=webhook) запускается отдельным процессом против заглушки
+Bot API (fake_telegram.py), сюда летят поддельные апдейты /start. Меряем время ответа вебхука,
+сколько апдейтов в секунду бот доводит до ответа пользователю и как быстро он мягко останавливается.
+Сеть не нужна.
+
+Запуск из корня репозитория:  python benchmarks/bench_webhook.py [--updates 500] [--concurrency 50]
+"""
+import os
+import sys
+import time
+import signal
+import socket
+import asyncio
+import argparse
+import tempfile
+import statistics
+
+import aiohttp
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_telegram import FakeTelegram  # noqa: E402
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SECRET = "bench-secret"
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def fake_update(update_id: int, user_id: int, text: str) -> dict:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+            "text": text,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(text)}] if text.startswith("/") else [],
+        },
+    }
+
+
+def percentile(values: list[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+async def main(updates: int, concurrency: int) -> None:
+    api = FakeTelegram()
+    await api.start()
+    port = free_port()
+    workdir = tempfile.mkdtemp(prefix="bench-webhook-")
+    env = {
+        **os.environ,
+        "BOT_TOKEN": "123456:bench",
+        "BOT_MODE": "webhook",
+        "TELEGRAM_API_SERVER": api.base,
+        "WEBHOOK_URL": f"http://127.0.0.1:{port}",
+        "WEBHOOK_HOST": "127.0.0.1",
+        "WEBHOOK_PORT": str(port),
+        "WEBHOOK_SECRET": SECRET,
+        "CACHE_DB": os.path.join(workdir, "file_ids.sqlite3"),
+    }
+    proc = await asyncio.create_subprocess_exec(
+        sys.executable, "-c", "import asyncio, bot; asyncio.run(bot.main())",
+        cwd=ROOT, env=env, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL,
+    )
+    try:
+        if not await api.wait_for("setWebhook", 1, timeout=30):
+            raise RuntimeError("бот не вызвал setWebhook за 30 с")
+
+        url = f"http://127.0.0.1:{port}/webhook"
+        headers = {"X-Telegram-Bot-Api-Secret-Token": SECRET}
+        latencies: list[float] = []
+        sem = asyncio.Semaphore(concurrency)
+
+        async with aiohttp.ClientSession() as session:
+            async def post(i: int) -> None:
+                async with sem:
+                    start = time.perf_counter()
+                    async with session.post(url, json=fake_update(i, 10_000 + i, "/start"), headers=headers) as resp:
+                        await resp.read()
+                        assert resp.status == 200, resp.status
+                    latencies.append(time.perf_counter() - start)
+
+            sent_before = api.count("sendMessage")
+            start = time.perf_counter()
+            await asyncio.gather(*(post(i) for i in range(1, updates + 1)))
+            accepted = time.perf_counter() - start
+            handled = await api.wait_for("sendMessage", sent_before + updates, timeout=120)
+            total = time.perf_counter() - start
+
+        print(f"апдейтов: {updates}, параллельно: {concurrency}")
+        print(f"ответ вебхука      p50 {percentile(latencies, .5) * 1e3:7.2f} мс   "
+              f"p95 {percentile(latencies, .95) * 1e3:7.2f} мс   p99 {percentile(latencies, .99) * 1e3:7.2f} мс")
+        print(f"приём              {updates / accepted:7.0f} апдейтов/с")
+        print(f"до ответа юзеру    {updates / total:7.0f} апдейтов/с" + ("" if handled else "  (не все дошли!)"))
+        print(f"среднее            {statistics.mean(latencies) * 1e3:7.2f} мс")
+    finally:
+        start = time.perf_counter()
+        if proc.returncode is None:
+            proc.send_signal(signal.SIGTERM)
+        await proc.wait()
+        print(f"остановка          {time.perf_counter() - start:7.2f} с (код {proc.returncode})")
+        await api.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--updates", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=50)
+    args = parser.parse_args()
+    asyncio.run(main(args.updates, args.concurrency))
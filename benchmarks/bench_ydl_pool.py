@@ -0,0 +1,93 @@
+"""
+Микробенчмарк экстракции yt-dlp: новый YoutubeDL на каждый запрос vs пул ydl_pool.YDLPool.
+Ролик отдаёт локальный aiohttp-сервер (generic-экстрактор, прямая ссылка на mp4) — сеть не нужна.
+Так измеряется именно накладная часть: создание YoutubeDL, разбор cookiefile, новые соединения.
+
+Запуск из корня репозитория:  python benchmarks/bench_ydl_pool.py [запросов] [cookies.txt]
+"""
+import os
+import sys
+import time
+import asyncio
+import threading
+import statistics
+
+from aiohttp import web
+import yt_dlp
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ydl_pool import YDLPool  # noqa: E402
+
+SAMPLE = os.urandom(256 * 1024)
+
+
+def start_server() -> str:
+    async def video(request: web.Request) -> web.Response:
+        return web.Response(body=SAMPLE, content_type="video/mp4")
+
+    loop = asyncio.new_event_loop()
+    ready = threading.Event()
+    address = {}
+
+    async def run() -> None:
+        app = web.Application()
+        app.router.add_get("/clip/{n}.mp4", video)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        address["port"] = site._server.sockets[0].getsockname()[1]
+        ready.set()
+
+    threading.Thread(target=lambda: (loop.run_until_complete(run()), loop.run_forever()), daemon=True).start()
+    ready.wait()
+    return f"http://127.0.0.1:{address['port']}/clip"
+
+
+def base_options(cookies: str):
+    def options(platform: str) -> dict:
+        opts = {"quiet": True, "no_warnings": True, "noplaylist": True, "format": "b"}
+        if cookies:
+            opts["cookiefile"] = cookies
+        return opts
+    return options
+
+
+def report(label: str, samples: list[float]) -> None:
+    samples = sorted(samples)
+    p95 = samples[int(len(samples) * 0.95) - 1]
+    print(f"{label:<10} среднее {statistics.mean(samples) * 1e3:7.2f} мс   "
+          f"медиана {statistics.median(samples) * 1e3:7.2f} мс   p95 {p95 * 1e3:7.2f} мс")
+
+
+def main() -> None:
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    cookies = sys.argv[2] if len(sys.argv) > 2 else ""
+    base = start_server()
+    options = base_options(cookies)
+
+    fresh = []
+    for i in range(count):
+        start = time.perf_counter()
+        with yt_dlp.YoutubeDL(options("bench")) as ydl:
+            ydl.extract_info(f"{base}/{i}.mp4", download=False)
+        fresh.append(time.perf_counter() - start)
+
+    pool = YDLPool(options, size=1, max_uses=10 ** 9)
+    pooled = []
+    for i in range(count):
+        start = time.perf_counter()
+        with pool.acquire("bench", {"format": "b"}) as ydl:
+            ydl.extract_info(f"{base}/{i}.mp4", download=False)
+        pooled.append(time.perf_counter() - start)
+    pool.close()
+
+    print(f"{count} экстракций, yt-dlp {yt_dlp.version.__version__}")
+    report("без пула", fresh)
+    report("с пулом", pooled)
+    print(f"пул: {pool.stats()}")
+
+
+if __name__ == "__main__":
+    main()
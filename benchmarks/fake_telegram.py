@@ -0,0 +1,110 @@
+"""
+Заглушка Telegram Bot API на aiohttp для офлайн-стендов: бот подключается к ней через
+TELEGRAM_API_SERVER=http://127.0.0.1:<порт>. Отвечает правдоподобными объектами на методы,
+которые вызывает бот, и записывает каждый вызов (метод, время, размер тела).
+"""
+import time
+import json
+import asyncio
+import itertools
+from typing import Optional
+
+from aiohttp import web
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+
+
+class FakeTelegram:
+    def __init__(self, upload_delay: float = 0.0):
+        self.upload_delay = upload_delay  # имитация времени загрузки видео в Телеграм
+        self.calls: list[tuple[str, float, int]] = []
+        self.bytes_uploaded = 0
+        self.inline_answers: dict[str, list[dict]] = {}  # inline_query_id -> результаты answerInlineQuery
+        self.base = ""
+        self._message_ids = itertools.count(1000)
+        self._file_ids = itertools.count(1)
+        self._changed = asyncio.Event()
+        self._runner: Optional[web.AppRunner] = None
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        app = web.Application(client_max_size=2 * 1024 ** 3)
+        app.router.add_post("/bot{token}/{method}", self._handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        self.base = f"http://{host}:{site._server.sockets[0].getsockname()[1]}"
+        return self.base
+
+    async def stop(self) -> None:
+        if self._runner:
+            await self._runner.cleanup()
+
+    def count(self, method: str) -> int:
+        return sum(1 for m, _t, _n in self.calls if m == method)
+
+    async def wait_for(self, method: str, count: int, timeout: float) -> bool:
+        deadline = time.monotonic() + timeout
+        while self.count(method) < count:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            self._changed.clear()
+            try:
+                await asyncio.wait_for(self._changed.wait(), timeout=remaining)
+            except asyncio.TimeoutError:
+                pass
+        return True
+
+    def _message(self, params: dict, **extra) -> dict:
+        chat_id = int(params.get("chat_id") or 0)
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "group"},
+            "from": BOT_USER,
+            **extra,
+        }
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params: dict = {}
+        size = 0
+        if request.content_type == "application/json":
+            params = await request.json()
+        else:
+            form = await request.post()
+            for key, value in form.items():
+                if isinstance(value, web.FileField):
+                    size += len(value.file.read())
+                else:
+                    params[key] = value
+
+        method_lower = method.lower()
+        if method_lower == "getme":
+            result = BOT_USER
+        elif method_lower == "sendvideo":
+            if self.upload_delay:
+                await asyncio.sleep(self.upload_delay)
+            self.bytes_uploaded += size
+            video = params.get("video")
+            file_id = video if video and not str(video).startswith("attach://") else f"fake-file-{next(self._file_ids)}"
+            result = self._message(params, video={
+                "file_id": file_id, "file_unique_id": file_id, "width": 720, "height": 1280, "duration": 10,
+            })
+        elif method_lower in ("sendmessage", "editmessagetext"):
+            result = self._message(params, text=params.get("text", ""))
+        elif method_lower == "answerinlinequery":
+            results = params.get("results") or []
+            self.inline_answers[str(params.get("inline_query_id"))] = (
+                json.loads(results) if isinstance(results, str) else results
+            )
+            result = True
+        elif method_lower == "editmessagemedia":
+            result = True if params.get("inline_message_id") else self._message(params)
+        else:
+            result = True
+
+        self.calls.append((method, time.monotonic(), size))
+        self._changed.set()
+        return web.json_response({"ok": True, "result": result}, dumps=json.dumps)
@@ -1,46 +1,141 @@
 import os
+import re
 import logging
 import asyncio
 import uuid
 import subprocess
 import time
-from typing import Optional, Callable
+import signal
+import threading
+from collections import Counter
+from typing import Optional, Callable, Awaitable, Any, NamedTuple
 
 from aiogram import Bot, Dispatcher, types
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.filters import Command
 from aiogram.types import (
     FSInputFile,
+    InputFile,
     ReplyKeyboardMarkup,
     KeyboardButton,
     InlineQuery,
     InlineQueryResultCachedVideo,
+    ChosenInlineResult,
+    InputMediaVideo,
     ReplyKeyboardRemove,
+    InlineKeyboardMarkup,
+    InlineKeyboardButton,
+    CallbackQuery,
+    ReplyParameters,
 )
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
 
 import yt_dlp
 from dotenv import load_dotenv
 
+import metrics
+from cache import FileIdCache, InlineState
+from download_profiles import FragmentTuner, get_profile
+from jobqueue import open_job_queue
+from logs import setup_logging, bind_job_id, current_job_id
+from ratelimit import KeyedLimiter, PlatformCooldown, RateLimited, parse_rates
+from media import (
+    FFMPEG_PATH, FFPROBE_PATH, FFmpegError, MediaInfo, needs_repack, probe_media_async, run_ffmpeg,
+)
+from progress import ProgressUpdater
+from scheduler import JobScheduler, QueueFull
+from transcode import bitrate_budget, plan_transcode, encode_to_fit
+from workspace import Workspace
+from streaming import RemuxStream
+from ydl_pool import YDLPool
+from urls import normalize_url, canonical_key, canonical_url, close_session as close_urls_session
+
 load_dotenv()
 
 # --- Конфигурация ---
 API_TOKEN = os.getenv("BOT_TOKEN")
-FFMPEG_PATH = "bin/ffmpeg"
 COOKIES_FILE = os.getenv("COOKIES_FILE", "ig_cookies.txt")
 TG_UPLOAD_LIMIT_MB = int(os.getenv("TG_UPLOAD_LIMIT_MB", "49"))  # лимит загрузки для ботов
 TG_UPLOAD_LIMIT = TG_UPLOAD_LIMIT_MB * 1024 * 1024
+CACHE_DB = os.getenv("CACHE_DB", "cache/file_ids.sqlite3")
+CACHE_TTL_HOURS = int(os.getenv("CACHE_TTL_HOURS", "168"))  # file_id у Телеграма живут долго
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "50000"))
+CPU_COUNT = os.cpu_count() or 2
+DOWNLOAD_WORKERS = int(os.getenv("DOWNLOAD_WORKERS", "4"))                 # сетевые скачивания yt-dlp
+FFMPEG_WORKERS = int(os.getenv("FFMPEG_WORKERS", str(CPU_COUNT)))          # репак/probe (лёгкие)
+TRANSCODE_WORKERS = int(os.getenv("TRANSCODE_WORKERS", str(max(1, CPU_COUNT // 2))))  # libx264
+TRANSCODE_THREADS = int(os.getenv("TRANSCODE_THREADS", str(max(1, CPU_COUNT // TRANSCODE_WORKERS))))  # потоков x264 на перекод
+TRANSCODE_TIMEOUT = int(os.getenv("TRANSCODE_TIMEOUT", "600"))
+# Слишком большой ролик не отклоняем, а сжимаем под лимит (если исходник не больше TRANSCODE_FIT_MAX_MB)
+TRANSCODE_FIT = os.getenv("TRANSCODE_FIT", "1") == "1"
+TRANSCODE_FIT_MAX_MB = int(os.getenv("TRANSCODE_FIT_MAX_MB", "400"))
+MAX_QUEUED_JOBS = int(os.getenv("MAX_QUEUED_JOBS", "50"))       # всего задач в работе и в очереди
+MAX_JOBS_PER_USER = int(os.getenv("MAX_JOBS_PER_USER", "3"))
+PROGRESS_GLOBAL_RATE = float(os.getenv("PROGRESS_GLOBAL_RATE", "20"))    # правок статусов в секунду на весь бот, 0 — без лимита
+PROGRESS_CHAT_INTERVAL = float(os.getenv("PROGRESS_CHAT_INTERVAL", "1.5"))  # пауза между правками в личке, сек
+PROGRESS_GROUP_INTERVAL = float(os.getenv("PROGRESS_GROUP_INTERVAL", "3.5"))  # в группах лимит ~20 в минуту
+YDL_POOL_SIZE = int(os.getenv("YDL_POOL_SIZE", str(DOWNLOAD_WORKERS)))  # свободных YoutubeDL на платформу, 0 — без пула
+YDL_POOL_MAX_USES = int(os.getenv("YDL_POOL_MAX_USES", "200"))  # потом экземпляр пересоздаётся
+# Потоковый режим: yt-dlp → ffmpeg → Телеграм без промежуточных файлов (fragmented MP4)
+STREAM_UPLOADS = os.getenv("STREAM_UPLOADS", "0") == "1"
+STREAM_FORMAT = "b[ext=mp4][vcodec~='^(avc|h264)'][acodec~='^(mp4a|aac)']"  # только то, что не надо перекодировать
+# Раздельный режим: бот только кладёт задачи в очередь, конвейер крутят процессы worker.py
+JOB_QUEUE = os.getenv("JOB_QUEUE", "")  # пусто — всё в этом процессе; sqlite:///cache/jobs.sqlite3 или redis://...
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "1.0"))  # как часто бот проверяет результат, сек
+JOB_LEASE = float(os.getenv("JOB_LEASE", "60"))  # без heartbeat дольше — задача возвращается в очередь
+# Сколько ждать результат с момента, как задачу взял воркер: дольше — результат потерян, задачу отменяем
+JOB_RESULT_TIMEOUT = float(os.getenv("JOB_RESULT_TIMEOUT", str(2 * TRANSCODE_TIMEOUT + 5 * JOB_LEASE)))
+# Приём апдейтов: polling (по умолчанию) или webhook — aiohttp-сервер, удобно за балансировщиком
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # публичный https-адрес, например https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")  # проверяется по X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))  # параллельных запросов от Телеграма
+SHUTDOWN_DRAIN_TIMEOUT = float(os.getenv("SHUTDOWN_DRAIN_TIMEOUT", "60"))  # сколько ждать начатые задачи при остановке
+# Инлайн-режим: мгновенный ответ (кэш или заглушка), скачивание — после выбора результата
+INLINE_DEBOUNCE = float(os.getenv("INLINE_DEBOUNCE", "0.6"))  # ждём, пока пользователь допишет ссылку, сек
+INLINE_PLACEHOLDER_FILE_ID = os.getenv("INLINE_PLACEHOLDER_FILE_ID", "")  # иначе сгенерируем сами
+INLINE_UPLOAD_CHAT_ID = int(os.getenv("INLINE_UPLOAD_CHAT_ID", "0"))  # куда грузить ради file_id; 0 — в личку
+# Служебный чат, куда ролики из чатов грузятся ради file_id (сообщение сразу удаляется), а всем
+# ждущим уходят по нему; 0 — прямо ответом первому из ждущих, остальным по его file_id
+UPLOAD_CHAT_ID = int(os.getenv("UPLOAD_CHAT_ID", "0"))
+INLINE_PENDING_LIMIT = int(os.getenv("INLINE_PENDING_LIMIT", "10000"))
+INLINE_PENDING_TTL = float(os.getenv("INLINE_PENDING_TTL", "3600"))  # сколько ждём выбора показанной заглушки, сек
+# Рабочие каталоги задач: квота на диске, резерв до скачивания, уборка сирот
+WORKSPACE_DIR = os.getenv("WORKSPACE_DIR", "downloads")
+WORKSPACE_QUOTA_MB = int(os.getenv("WORKSPACE_QUOTA_MB", "4096"))        # на процесс
+WORKSPACE_MIN_FREE_MB = int(os.getenv("WORKSPACE_MIN_FREE_MB", "512"))   # столько всегда оставляем свободным на диске
+WORKSPACE_UNKNOWN_SIZE_MB = int(os.getenv("WORKSPACE_UNKNOWN_SIZE_MB", "100"))  # резерв, если размер не оценить
+WORKSPACE_TMPFS_DIR = os.getenv("WORKSPACE_TMPFS_DIR", "")  # например /dev/shm/tgdl; пусто — только диск
+WORKSPACE_TMPFS_QUOTA_MB = int(os.getenv("WORKSPACE_TMPFS_QUOTA_MB", "512"))
+WORKSPACE_TMPFS_MAX_JOB_MB = int(os.getenv("WORKSPACE_TMPFS_MAX_JOB_MB", "64"))  # задачи крупнее — на диск
+WORKSPACE_WAIT_TIMEOUT = float(os.getenv("WORKSPACE_WAIT_TIMEOUT", "120"))
+WORKSPACE_SWEEP_INTERVAL = float(os.getenv("WORKSPACE_SWEEP_INTERVAL", "600"))
+WORKSPACE_ORPHAN_AGE = float(os.getenv("WORKSPACE_ORPHAN_AGE", "21600"))  # файлы без владельца старше — удаляются
+# Справедливость и защита аккаунтов: ведро жетонов на пользователя и на платформу, пауза платформы при блокировках
+USER_RATE_PER_MIN = float(os.getenv("USER_RATE_PER_MIN", "6"))  # новых задач в минуту на пользователя, 0 — без лимита
+USER_RATE_BURST = float(os.getenv("USER_RATE_BURST", "3"))
+PLATFORM_RATES = os.getenv("PLATFORM_RATES", "instagram=20/3")  # платформа=в минуту[/запас],...; остальные без лимита
+PLATFORM_RATE_MAX_WAIT = float(os.getenv("PLATFORM_RATE_MAX_WAIT", "60"))  # дольше ждать жетон — «перегружен»
+COOLDOWN_FAILURES = int(os.getenv("COOLDOWN_FAILURES", "3"))  # блокировок подряд до паузы, 0 — без паузы
+COOLDOWN_BASE = float(os.getenv("COOLDOWN_BASE", "300"))      # первая пауза, сек; повторные — вдвое дольше
+COOLDOWN_MAX = float(os.getenv("COOLDOWN_MAX", "3600"))
+TELEGRAM_API_SERVER = os.getenv("TELEGRAM_API_SERVER", "")  # свой Bot API сервер (local bot api, тестовый стенд)
+# Наблюдаемость: LOG_FORMAT=json — по строке JSON на запись (с job_id); /metrics в формате Prometheus
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # 0 — отдельный сервер не поднимаем (в webhook-режиме /metrics есть всегда)
+# процессы worker.py слушают WORKER_METRICS_PORT + номер процесса; по умолчанию сразу за портом бота
+WORKER_METRICS_PORT = int(os.getenv("WORKER_METRICS_PORT", str(METRICS_PORT + 1 if METRICS_PORT else 0)))
+METRICS_STORE_INTERVAL = float(os.getenv("METRICS_STORE_INTERVAL", "15"))  # как часто снимать метрики JOB_QUEUE, сек
 
 # --- Помощники ---
-def ffmpeg_bin() -> str:
-    """Возвращает путь к ffmpeg: локальный бинарь или системный."""
-    return FFMPEG_PATH if os.path.exists(FFMPEG_PATH) else "ffmpeg"
-
-def ffprobe_bin() -> str:
-    """Возвращает путь к ffprobe: локальный бинарь или системный."""
-    local = "bin/ffprobe"
-    return local if os.path.exists(local) else "ffprobe"
-
 def install_ffmpeg() -> None:
     """Попытка скачать статический ffmpeg (Linux x86_64). На macOS/Windows поставьте системно."""
     if os.path.exists(FFMPEG_PATH):
@@ -57,8 +152,8 @@ def install_ffmpeg() -> None:
         # Переносим и ffmpeg, и ffprobe
         os.rename(os.path.join(temp_dir, "ffmpeg"), FFMPEG_PATH)
         if os.path.exists(os.path.join(temp_dir, "ffprobe")):
-            os.rename(os.path.join(temp_dir, "ffprobe"), "bin/ffprobe")
-            os.chmod("bin/ffprobe", 0o755)
+            os.rename(os.path.join(temp_dir, "ffprobe"), FFPROBE_PATH)
+            os.chmod(FFPROBE_PATH, 0o755)
         os.chmod(FFMPEG_PATH, 0o755)
         os.remove(archive_path)
         os.rmdir(temp_dir)
@@ -66,36 +161,14 @@ def install_ffmpeg() -> None:
     except Exception as e:
         logging.error(f"Не удалось установить FFmpeg: {e}")
 
-def check_codecs(file_path: str) -> tuple[str, str]:
-    """Возвращает (видеокодек, аудиокодек) через ffprobe, либо ('','') при ошибке."""
-    try:
-        vcodec = subprocess.check_output(
-            [ffprobe_bin(), "-v", "error", "-select_streams", "v:0",
-             "-show_entries", "stream=codec_name", "-of", "csv=p=0", file_path],
-            timeout=30
-        ).decode().strip()
-        acodec = subprocess.check_output(
-            [ffprobe_bin(), "-v", "error", "-select_streams", "a:0",
-             "-show_entries", "stream=codec_name", "-of", "csv=p=0", file_path],
-            timeout=30
-        ).decode().strip()
-        return vcodec, acodec
-    except Exception as e:
-        logging.error(f"Ошибка при проверке кодеков: {e}")
-        return "", ""
-
-def repack_to_mp4(input_path: str) -> Optional[str]:
+async def repack_to_mp4(input_path: str) -> Optional[str]:
     """Быстрый репак без перекодирования (минимальная нагрузка на CPU)."""
     try:
         base, _ = os.path.splitext(input_path)
         out = f"{base}_repack.mp4"
-        subprocess.run(
-            [ffmpeg_bin(), "-nostdin", "-loglevel", "error",
-             "-y", "-i", input_path, "-c", "copy", "-movflags", "+faststart", out],
-            check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=180
-        )
+        await run_ffmpeg(["-y", "-i", input_path, "-c", "copy", "-movflags", "+faststart", out], timeout=180)
         return out if os.path.exists(out) else None
-    except subprocess.TimeoutExpired:
+    except asyncio.TimeoutError:
         logging.error("Репак превысил таймаут и был прерван.")
         return None
     except Exception as e:
@@ -111,21 +184,64 @@ def file_size(path: str) -> int:
 def human_mb(n: int) -> str:
     return f"{n/1024/1024:.1f} МБ"
 
+def human_wait(seconds: float) -> str:
+    return f"{seconds:.0f} с" if seconds < 90 else f"{seconds / 60:.0f} мин"
+
+def progress_bar(percent: float) -> str:
+    filled = max(0, min(10, int(percent // 10)))
+    return "█" * filled + "░" * (10 - filled)
+
 def display_platform_name(platform: str) -> str:
     return {
         "tiktok": "tiktok",
         "instagram": "instagram",
         "twitter": "twitter",
+        "youtube": "youtube",
         "youtube_shorts": "youtube shorts",
     }.get(platform, platform)
 
 # --- Логирование и инициализация бота ---
-logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+setup_logging(LOG_FORMAT)
 if not API_TOKEN:
     raise RuntimeError("Не задан BOT_TOKEN в окружении (.env).")
 
-bot = Bot(token=API_TOKEN)
+bot = Bot(
+    token=API_TOKEN,
+    session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_SERVER)) if TELEGRAM_API_SERVER else None,
+)
 dp = Dispatcher()
+file_id_cache = FileIdCache(CACHE_DB, ttl=CACHE_TTL_HOURS * 3600, max_entries=CACHE_MAX_ENTRIES)
+progress_updater = ProgressUpdater(
+    bot,
+    global_rate=PROGRESS_GLOBAL_RATE,
+    chat_interval=PROGRESS_CHAT_INTERVAL,
+    group_interval=PROGRESS_GROUP_INTERVAL,
+)
+scheduler = JobScheduler(
+    download_workers=DOWNLOAD_WORKERS,
+    ffmpeg_workers=FFMPEG_WORKERS,
+    transcode_workers=TRANSCODE_WORKERS,
+    max_jobs=MAX_QUEUED_JOBS,
+    max_jobs_per_user=MAX_JOBS_PER_USER,
+)
+job_queue = open_job_queue(JOB_QUEUE)
+# Вёдра пользователей и платформ и паузы платформ с JOB_QUEUE живут в очереди — общие для всех
+# экземпляров бота и воркеров
+user_limiter = KeyedLimiter(USER_RATE_PER_MIN / 60, USER_RATE_BURST, store=job_queue, scope="user")
+platform_limiter = KeyedLimiter(0, 0, overrides=parse_rates(PLATFORM_RATES), store=job_queue, scope="platform")
+platform_cooldown = PlatformCooldown(COOLDOWN_FAILURES, COOLDOWN_BASE, COOLDOWN_MAX, store=job_queue)
+# с Redis в JOB_QUEUE состояние инлайн-режима видят экземпляры бота на всех машинах, иначе — в SQLite кэша
+inline_state = InlineState(CACHE_DB, pending_ttl=INLINE_PENDING_TTL, max_pending=INLINE_PENDING_LIMIT,
+                           store=job_queue)
+workspace = Workspace(
+    WORKSPACE_DIR,
+    quota=WORKSPACE_QUOTA_MB * 1024 * 1024,
+    min_free=WORKSPACE_MIN_FREE_MB * 1024 * 1024,
+    tmpfs_root=WORKSPACE_TMPFS_DIR,
+    tmpfs_quota=WORKSPACE_TMPFS_QUOTA_MB * 1024 * 1024,
+    tmpfs_max_job=WORKSPACE_TMPFS_MAX_JOB_MB * 1024 * 1024,
+    wait_timeout=WORKSPACE_WAIT_TIMEOUT,
+)
 
 # --- FSM и клавиатура ---
 class DownloadState(StatesGroup):
@@ -145,51 +261,44 @@ def create_main_keyboard() -> ReplyKeyboardMarkup:
     return keyboard
 
 # --- Утилиты ---
-def get_platform_from_url(url: str) -> Optional[str]:
-    u = url.lower()
-    if "tiktok.com" in u:
-        return "tiktok"
-    if "instagram.com" in u:
-        return "instagram"
-    if "youtube.com" in u or "youtu.be" in u:
-        # трактуем любые ютуб-ссылки как shorts для простоты
-        return "youtube_shorts"
-    if "twitter.com" in u or "x.com" in u:
-        return "twitter"
-    return None
+MOBILE_COMPAT_PLATFORMS = {"instagram", "youtube", "youtube_shorts"}  # где бывает не h264/aac
 
-# --- Конвертация (запасной план для IG/Shorts после репака) ---
-def convert_video_for_mobile(input_path: str) -> Optional[str]:
+def video_cache_key(platform: str, canonical_id: Optional[str]) -> Optional[str]:
+    """Ключ кэша file_id; None — у ссылки нет стабильного id, кэшировать нечего."""
+    return canonical_key(platform, canonical_id) if canonical_id else None
+
+# --- Конвертация (запасной план для IG/YouTube вместо репака; сжатие под лимит) ---
+async def convert_video_for_mobile(
+    input_path: str,
+    info: Optional[MediaInfo] = None,
+    on_progress: Optional[Callable[[Optional[float], str], Awaitable[None]]] = None,
+) -> Optional[str]:
     """
-    Перекод в mp4 (H.264 + AAC) для совместимости iOS/Android.
-    Используется ТОЛЬКО если после репака кодеки всё ещё не h264/aac и это Instagram/YouTube Shorts.
-    Если аудио уже AAC — копируем его, чтобы снизить нагрузку.
+    Перекод в mp4 (H.264 + AAC) для совместимости iOS/Android, который гарантированно влезает
+    в TG_UPLOAD_LIMIT: пресет, CRF/битрейт и разрешение выбирает transcode.plan_transcode
+    по длительности и лимиту. Используется, если кодеки не h264/aac (IG/YouTube) или файл
+    больше лимита. Если аудио уже AAC и бюджет позволяет — копируем его.
     """
     try:
         base, _ext = os.path.splitext(input_path)
         output_path = f"{base}_ios.mp4"
 
-        _vcodec, acodec = check_codecs(input_path)
-        audio_args = ["-c:a", "copy"] if acodec == "aac" else ["-c:a", "aac", "-b:a", "128k"]
-
-        cmd = [
-            ffmpeg_bin(), "-nostdin", "-loglevel", "error",
-            "-y", "-i", input_path,
-            "-c:v", "libx264", "-preset", "ultrafast", "-crf", "23",
-            "-profile:v", "high", "-level:v", "4.0",
-            "-pix_fmt", "yuv420p",
-            *audio_args,
-            "-movflags", "+faststart",
-            "-vf", "scale=trunc(iw/2)*2:trunc(ih/2)*2",
-            output_path,
-        ]
-        logging.info(f"Конвертирую в совместимый формат (iOS/Android): {output_path}")
-        subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=300)
+        info = info or await probe_media_async(input_path)
+        plan = plan_transcode(info, TG_UPLOAD_LIMIT, TRANSCODE_THREADS)
+        if plan is None:
+            logging.info(f"Ролик слишком длинный, чтобы сжать его под {TG_UPLOAD_LIMIT_MB} МБ: {input_path}")
+            return None
+        logging.info(f"Конвертирую в совместимый формат (iOS/Android) по плану {plan}: {output_path}")
+        fits = await encode_to_fit(
+            plan, input_path, output_path, info, TG_UPLOAD_LIMIT, timeout=TRANSCODE_TIMEOUT, on_progress=on_progress,
+        )
+        if not fits:
+            logging.warning(f"После перекода файл всё ещё больше лимита: {output_path}")
         return output_path if os.path.exists(output_path) else None
-    except subprocess.TimeoutExpired:
+    except asyncio.TimeoutError:
         logging.error("Конвертация превысила таймаут и была прервана.")
         return None
-    except subprocess.CalledProcessError as e:
+    except FFmpegError as e:
         logging.error(f"Ошибка конвертации видео: {e}")
         return None
     except Exception as e:
@@ -197,123 +306,441 @@ def convert_video_for_mobile(input_path: str) -> Optional[str]:
         return None
 
 # --- Скачивание ---
+def ydl_options(platform: str) -> dict:
+    """
+    Общие опции yt-dlp для платформы: cookies и формат по умолчанию, а сетевое — User-Agent,
+    повторы с экспоненциальной паузой, куски HTTP и параллельность фрагментов — из профиля платформы.
+    """
+    ydl_opts = {
+        "quiet": True,
+        "no_warnings": True,
+        "noprogress": True,  # прогресс нам приходит хуком; без флага yt-dlp рисует его в stderr
+        "noplaylist": True,
+        "ffmpeg_location": FFMPEG_PATH if os.path.exists(FFMPEG_PATH) else None,
+        **get_profile(platform).ydl_options(),
+    }
+
+    # cookies только для Instagram
+    if platform == "instagram" and os.path.exists(COOKIES_FILE):
+        ydl_opts["cookiefile"] = COOKIES_FILE
+        logging.info(f"Использую cookiefile: {COOKIES_FILE}")
+
+    ydl_opts.update(ydl_format_options(platform))
+    return ydl_opts
+
+def ydl_format_options(platform: str, format_override: Optional[str] = None) -> dict:
+    """Выбор формата: явный format_id или строка форматов по умолчанию для платформы."""
+    if format_override:
+        return {
+            "format": format_override,
+            "merge_output_format": "mp4" if "+" in format_override else None,
+        }
+    if platform in {"youtube", "youtube_shorts"}:
+        # Сначала прогрессивный MP4 (совместим с iOS), затем avc1+m4a, потом любой
+        return {
+            "format": (
+                "b[ext=mp4]/"
+                "bv*[vcodec^=avc1][ext=mp4]+ba[ext=m4a]/"
+                "bv*+ba/b"
+            ),
+            "merge_output_format": None,
+        }
+    return {
+        "format": (
+            "bestvideo[vcodec^=avc1][ext=mp4]+bestaudio[ext=m4a]/"
+            "best[ext=mp4]/best"
+        ),
+        "merge_output_format": "mp4",
+    }
+
+# Ошибки yt-dlp, которыми платформа говорит «вы нас достали»: стена логина Instagram, 429 и т.п.
+BLOCKED_RE = re.compile(
+    r"login required|log ?in to|checkpoint_required|rate.?limit|too many requests|HTTP Error 429", re.I,
+)
+
+def note_blocked(platform: str, error: Exception) -> bool:
+    """Если ошибка похожа на блокировку — учитываем её для паузы платформы."""
+    if not BLOCKED_RE.search(str(error)):
+        return False
+    platform_cooldown.blocked(platform)
+    metrics.DOWNLOAD_FAILURES.inc(platform=platform, reason="blocked")
+    return True
+
+# Прогретые YoutubeDL по платформам: cookies, экстракторы и соединения живут между задачами
+ydl_pool = YDLPool(ydl_options, size=YDL_POOL_SIZE, max_uses=YDL_POOL_MAX_USES)
+# Параллельность фрагментов HLS/DASH по платформам подстраивается под скорость прошлых загрузок
+fragment_tuner = FragmentTuner()
+
+def preflight_video(url: str, platform: str) -> Optional[dict]:
+    """
+    Метаданные ролика без скачивания (extract_info download=False): по ним оцениваем размер
+    и выбираем формат. Тот же info потом отдаётся в download_video_from_url — без второй экстракции.
+    Карусель или тред с несколькими видео — берём первый ролик (как и раньше при скачивании
+    всего плейлиста в один файл). None — оценить нечего, качаем обычным extract_info.
+    Ошибка экстракции — VideoJobError('download').
+    """
+    try:
+        with ydl_pool.acquire(platform) as ydl:
+            info = ydl.extract_info(url, download=False)
+    except Exception as e:
+        logging.warning(f"Не удалось получить метаданные с {platform} ({url}): {e}")
+        if not note_blocked(platform, e):
+            metrics.DOWNLOAD_FAILURES.inc(platform=platform, reason="extract")
+        raise VideoJobError("download") from e
+    platform_cooldown.ok(platform)
+    if info and info.get("_type", "video") != "video":
+        entries = [e for e in info.get("entries") or [] if e and e.get("_type", "video") == "video"]
+        info = entries[0] if entries else None
+    if not info:
+        logging.warning(f"Ссылка {url} — не одиночное видео, предварительная оценка пропущена.")
+        return None
+    return info
+
+# Поля, которые yt-dlp дописывает в info при выборе формата. При повторной обработке
+# с другим форматом они не должны пережить новый выбор
+FORMAT_SELECTION_FIELDS = ("requested_formats", "requested_downloads", "format_id", "format", "url", "ext")
+
+def info_for_reprocess(info: dict) -> dict:
+    """Копия info из preflight_video без следов прошлого выбора формата — для process_ie_result."""
+    info = dict(info)
+    for field in FORMAT_SELECTION_FIELDS:
+        info.pop(field, None)
+    return info
+
+def estimate_format_size(fmt: dict, duration: float) -> Optional[int]:
+    """Размер формата в байтах: filesize, filesize_approx или битрейт × длительность."""
+    size = fmt.get("filesize") or fmt.get("filesize_approx")
+    if size:
+        return int(size)
+    tbr = fmt.get("tbr")  # кбит/с
+    if tbr and duration:
+        return int(tbr * 1000 / 8 * duration)
+    return None
+
+def estimate_info_size(info: dict) -> Optional[int]:
+    """Размер выбранного yt-dlp формата (для video+audio — сумма), None если оценить нельзя."""
+    duration = info.get("duration") or 0.0
+    sizes = [estimate_format_size(f, duration) for f in info.get("requested_formats") or [info]]
+    if not sizes or any(s is None for s in sizes):
+        return None
+    return sum(sizes)
+
+def format_candidates(info: dict) -> list[tuple[tuple, int, str]]:
+    """
+    Все форматы с видео и известным размером: (качество, размер, спецификация для yt-dlp).
+    Видео без звука склеивается с самым лёгким аудио (m4a в приоритете) — видео важнее.
+    """
+    duration = info.get("duration") or 0.0
+    formats = info.get("formats") or []
+    audio_only = [
+        f for f in formats
+        if f.get("vcodec") == "none" and f.get("acodec") not in (None, "none")
+        and estimate_format_size(f, duration) is not None
+    ]
+    audio_only.sort(key=lambda f: (f.get("ext") != "m4a", estimate_format_size(f, duration)))
+    audio = audio_only[0] if audio_only else None
+
+    candidates = []
+    for f in formats:
+        if f.get("vcodec") in (None, "none"):
+            continue
+        size = estimate_format_size(f, duration)
+        if size is None:
+            continue
+        spec = f["format_id"]
+        if f.get("acodec") in (None, "none"):
+            if audio is None:
+                continue
+            size += estimate_format_size(audio, duration)
+            spec = f"{f['format_id']}+{audio['format_id']}"
+        is_h264 = str(f.get("vcodec", "")).startswith(("avc1", "h264"))
+        candidates.append(((is_h264, f.get("height") or 0, f.get("tbr") or 0), size, spec))
+    return candidates
+
+def choose_format_within_limit(info: dict, limit: int) -> tuple[Optional[str], Optional[int]]:
+    """
+    Возвращает (format_id для скачивания, оценка размера).
+    Если выбор yt-dlp по умолчанию влезает в лимит (или размер неизвестен) — оставляем его.
+    Иначе ищем лучший формат, который влезает: сначала H.264 (не придётся перекодировать),
+    потом по высоте и битрейту. format_id=None — ничего не влезает.
+    """
+    estimate = estimate_info_size(info)
+    if estimate is None or estimate <= limit:
+        return info.get("format_id"), estimate
+
+    candidates = [c for c in format_candidates(info) if c[1] <= limit]
+    if not candidates:
+        return None, estimate
+    _quality, size, spec = max(candidates)
+    logging.info(f"Формат по умолчанию ~{human_mb(estimate)} не влезает в лимит, беру {spec} (~{human_mb(size)})")
+    return spec, size
+
+def smallest_format(info: dict) -> tuple[Optional[str], Optional[int]]:
+    """(format_id, размер) самого лёгкого формата — его и сжимаем, когда в лимит не влезает ничего."""
+    candidates = format_candidates(info)
+    if not candidates:
+        return None, None
+    _quality, size, spec = min(candidates, key=lambda c: c[1])
+    return spec, size
+
 def download_video_from_url(
     url: str,
     platform: str,
     progress_hook: Optional[Callable[[dict], None]] = None,
     format_override: Optional[str] = None,
     max_filesize: Optional[int] = None,
+    info: Optional[dict] = None,
+    workdir: str = WORKSPACE_DIR,
 ) -> Optional[str]:
     """
-    Скачивает видео и возвращает путь к файлу (как скачано у источника).
-    Далее ВСЕГДА делаем репак. Перекодировка — только редкий запасной случай.
+    Скачивает видео в каталог workdir и возвращает путь к файлу (как скачано у источника).
+    Если передан info из preflight_video — качаем по нему, без повторной экстракции.
+    Далее репак (если файл ещё не faststart-mp4). Перекодировка — только редкий запасной случай.
     """
-    try:
-        unique_id = uuid.uuid4()
-        output_template = f"downloads/{platform}/{unique_id}.%(ext)s"
-        os.makedirs(f"downloads/{platform}", exist_ok=True)
-
-        ydl_opts = {
-            "quiet": True,
-            "no_warnings": True,
-            "outtmpl": output_template,
-            "noplaylist": True,
-            "ffmpeg_location": FFMPEG_PATH if os.path.exists(FFMPEG_PATH) else None,
-            "retries": 5,
-            "fragment_retries": 5,
-            "concurrent_fragment_downloads": 1,
-            "http_headers": {
-                "User-Agent": (
-                    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
-                    "AppleWebKit/537.36 (KHTML, like Gecko) "
-                    "Chrome/124.0.0.0 Safari/537.36"
-                )
-            },
-        }
-
-        # cookies только для Instagram
-        if platform == "instagram" and os.path.exists(COOKIES_FILE):
-            ydl_opts["cookiefile"] = COOKIES_FILE
-            logging.info(f"Использую cookiefile: {COOKIES_FILE}")
+    fragments = fragment_tuner.level(platform)
+    tuner_hook = fragment_tuner.hook(platform, fragments)
+    segmented = False
 
-        # Форматы
-        if format_override:
-            ydl_opts["format"] = format_override
-        else:
-            if platform == "youtube_shorts":
-                # Сначала прогрессивный MP4 (совместим с iOS), затем avc1+m4a, потом любой
-                ydl_opts["format"] = (
-                    "b[ext=mp4]/"
-                    "bv*[vcodec^=avc1][ext=mp4]+ba[ext=m4a]/"
-                    "bv*+ba/b"
-                )
-            else:
-                ydl_opts["format"] = (
-                    "bestvideo[vcodec^=avc1][ext=mp4]+bestaudio[ext=m4a]/"
-                    "best[ext=mp4]/best"
-                )
-                ydl_opts["merge_output_format"] = "mp4"
+    def hooks(d: dict) -> None:
+        nonlocal segmented
+        segmented = segmented or bool(d.get("fragment_count"))
+        tuner_hook(d)
+        if progress_hook:
+            progress_hook(d)
 
-        if max_filesize:
-            ydl_opts["max_filesize"] = max_filesize
+    try:
+        unique_id = uuid.uuid4()
+        output_template = os.path.join(workdir, f"{unique_id}.%(ext)s")
+        os.makedirs(workdir, exist_ok=True)
 
-        if progress_hook:
-            ydl_opts["progress_hooks"] = [progress_hook]
+        job_opts = ydl_format_options(platform, format_override)
+        job_opts["outtmpl"] = output_template
+        job_opts["max_filesize"] = max_filesize
+        job_opts["concurrent_fragment_downloads"] = fragments
 
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        with ydl_pool.acquire(platform, job_opts, hooks) as ydl:
             logging.info(f"Начинаю скачивание с {display_platform_name(platform)}: {url}")
-            ydl.extract_info(url, download=True)
-            base_path = f"downloads/{platform}/{unique_id}"
+            if info:
+                ydl.process_ie_result(info_for_reprocess(info), download=True)
+            else:
+                ydl.extract_info(url, download=True)
+            base_path = os.path.join(workdir, str(unique_id))
             for ext in ("mp4", "mkv", "webm"):
                 video_file = f"{base_path}.{ext}"
                 if os.path.exists(video_file):
                     logging.info(f"Видео успешно скачано: {video_file}")
+                    metrics.DOWNLOADED_BYTES.inc(file_size(video_file), platform=platform)
                     return video_file
 
             logging.error(f"Ошибка: скачанный файл не найден для {url}")
+            metrics.DOWNLOAD_FAILURES.inc(platform=platform, reason="not_found")
             return None
 
+    except yt_dlp.utils.DownloadCancelled:
+        logging.info(f"Скачивание отменено: {url}")
+        metrics.DOWNLOAD_FAILURES.inc(platform=platform, reason="cancelled")
+        return None
     except Exception as e:
         logging.exception(f"Непредвиденная ошибка при скачивании с {platform} ({url}): {e}")
+        if not note_blocked(platform, e):
+            metrics.DOWNLOAD_FAILURES.inc(platform=platform, reason="error")
+        if segmented:
+            # упала уже начатая загрузка фрагментов — возможно, источник режет параллельные запросы
+            fragment_tuner.record_failure(platform, fragments)
         return None
 
-# --- Хэндлеры ---
-@dp.message(Command("start"))
-async def cmd_start(message: types.Message, state: FSMContext):
-    logging.info(f"Пользователь {message.from_user.id} запустил бота.")
-    await state.clear()
-    await message.reply(
-        "👋 Привет! Я бот для скачивания видео.\n\n"
-        "Просто отправь мне ссылку на видео, или выбери платформу ниже.\n\n"
-        "💡 Совет: ты можешь использовать меня прямо в любом чате!\n"
-        "Для этого напиши: @tktdown_bot <ссылка>",
-        reply_markup=create_main_keyboard(),
-    )
+def ytdlp_stream_args(platform: str) -> list[str]:
+    """Аргументы CLI yt-dlp для потокового режима — те же заголовки и cookies, что в download_video_from_url."""
+    # размер отсекается ещё до скачивания, если источник его сообщает
+    size_filter = f"[filesize<?{TG_UPLOAD_LIMIT}][filesize_approx<?{TG_UPLOAD_LIMIT}]"
+    args = ["-f", STREAM_FORMAT + size_filter, *get_profile(platform).cli_args(fragment_tuner.level(platform))]
+    if platform == "instagram" and os.path.exists(COOKIES_FILE):
+        args += ["--cookies", COOKIES_FILE]
+    return args
 
-@dp.message(lambda m: m.text in ["📥 TikTok", "📸 Instagram", "🎬 YouTube Shorts", "🐦 X (Twitter)"])
-async def handle_platform_choice(message: types.Message, state: FSMContext):
-    await message.reply("Отправьте мне ссылку на видео.", reply_markup=ReplyKeyboardRemove())
-    await state.set_state(DownloadState.url)
+# --- Схлопывание одинаковых запросов (single-flight) ---
+class SingleFlight:
+    """
+    Одновременные запросы с одинаковым ключом делят одну задачу.
+    Задача живёт отдельно от вызывающих: отмена одного ожидающего не рушит остальных,
+    а когда уходит последний ожидающий — задача отменяется (ffmpeg/yt-dlp останавливаются).
+    """
 
-@dp.message(DownloadState.url)
-@dp.message(lambda m: m.text and m.text.startswith("http"))
-async def process_video_link(message: types.Message, state: FSMContext):
-    url = message.text.strip()
-    await state.clear()
+    def __init__(self):
+        self._inflight: dict[str, asyncio.Task] = {}
+        self._waiters: dict[asyncio.Task, int] = {}
 
-    platform = get_platform_from_url(url)
-    if not platform:
-        await message.reply("Не могу определить платформу по этой ссылке.", reply_markup=create_main_keyboard())
-        return
+    def in_flight(self, key: str) -> bool:
+        return key in self._inflight
+
+    async def do(self, key: str, factory: Callable[[], Awaitable]) -> tuple[Any, bool]:
+        """Возвращает (результат, leader) — leader=True, если задачу запустил именно этот вызов."""
+        task = self._inflight.get(key)
+        leader = task is None
+        if leader:
+            task = asyncio.create_task(factory())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._done(key, t))
+        self._waiters[task] = self._waiters.get(task, 0) + 1
+        try:
+            return await asyncio.shield(task), leader
+        except asyncio.CancelledError:
+            if self._waiters[task] == 1 and not task.done():
+                task.cancel()
+            raise
+        finally:
+            self._waiters[task] -= 1
+            if not self._waiters[task]:
+                del self._waiters[task]
+
+    def _done(self, key: str, task: asyncio.Task) -> None:
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        # забираем исключение, даже если все ожидающие ушли, чтобы не было "never retrieved"
+        if not task.cancelled():
+            task.exception()
+
+video_flights = SingleFlight()
+
+# Задачи, которые пользователь может отменить кнопкой: токен -> (id владельца, задача хэндлера)
+running_jobs: dict[str, tuple[int, asyncio.Task]] = {}
+cancelled_jobs: set[str] = set()
+
+# --- Куда грузить ролик и какое сообщение-статус править (сериализуется в очередь задач) ---
+class UploadTarget(NamedTuple):
+    chat_id: int
+    reply_to: Optional[int] = None
+    delete_after: bool = False  # загрузить ради file_id и сразу удалить (инлайн-режим)
+
+class StatusMessage(NamedTuple):
+    chat_id: int
+    message_id: int
+    cancel_token: str
+
+class SharedDelivery:
+    """
+    Кому достаётся ролик общей задачи (video_flights). Грузится он в чат первого ожидающего,
+    который ещё не отменил запрос (ответом на его сообщение), остальным уходит по file_id.
+    Так в чат отменившего ничего не придёт, а в группах не будет лишних сообщений.
+    """
+
+    def __init__(self):
+        self.waiters: dict[object, UploadTarget] = {}  # по порядку прихода
+        self.last: Optional[UploadTarget] = None
+        self.delivered: Optional[UploadTarget] = None  # куда ролик ушёл при загрузке
+
+    @property
+    def target(self) -> UploadTarget:
+        # ушли все — задачу и так отменят, грузить остаётся туда же, куда собирались
+        self.last = next(iter(self.waiters.values()), self.last)
+        return self.last
+
+    async def resolve(self) -> UploadTarget:
+        return self.target
 
-    loading_message = await message.reply("📥 Подготовка к загрузке...")
+    def sent(self, target: UploadTarget) -> None:
+        self.delivered = target
 
+# flight_key -> получатели задачи, которая сейчас идёт
+deliveries: dict[str, SharedDelivery] = {}
+
+async def shared_video_job(
+    flight_key: str,
+    url: str,
+    platform: str,
+    cache_key: Optional[str],
+    user_id: int,
+    target: UploadTarget,
+    status: Optional[StatusMessage] = None,
+) -> Optional[str]:
+    """
+    Точка входа хэндлеров: ждёт общую на всех задачу по flight_key (run_video_job) как один
+    из её получателей, заняв своё место в очереди (scheduler.admit).
+    Возвращает file_id, который вызывающему надо отправить самому, или None — ролик уже у него в чате.
+    """
+    # лимит частоты и место в очереди — у каждого ожидающего свои: отказ одному не должен
+    # достаться всем, кто прислал ту же ссылку
+    admitted = False
+    try:
+        await asyncio.to_thread(user_limiter.check, user_id)  # с JOB_QUEUE это запрос к очереди
+        with scheduler.admit(user_id):
+            admitted = True
+            return await _shared_video_job(flight_key, url, platform, cache_key, user_id, target, status)
+    except QueueFull as e:
+        if not admitted:  # отказы внутри задачи run_video_job уже посчитал
+            metrics.JOBS.inc(platform=platform, result="rate_limited" if isinstance(e, RateLimited) else "busy")
+        raise
+
+async def _shared_video_job(
+    flight_key: str,
+    url: str,
+    platform: str,
+    cache_key: Optional[str],
+    user_id: int,
+    target: UploadTarget,
+    status: Optional[StatusMessage],
+) -> Optional[str]:
+    delivery = deliveries.get(flight_key) if video_flights.in_flight(flight_key) else None
+    if delivery is None:
+        delivery = deliveries[flight_key] = SharedDelivery()
+    me = object()
+    delivery.waiters[me] = target
+
+    async def job() -> Optional[str]:
+        try:
+            return await run_video_job(url, platform, cache_key, user_id, delivery, status)
+        finally:
+            if deliveries.get(flight_key) is delivery:
+                del deliveries[flight_key]
+
+    try:
+        file_id, _leader = await video_flights.do(flight_key, job)
+    finally:
+        del delivery.waiters[me]
+    if not file_id:
+        raise VideoJobError("upload")
+    if delivery.delivered == target and not target.delete_after:
+        return None
+    return file_id
+
+def cancel_markup(job_token: str) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(
+        inline_keyboard=[[InlineKeyboardButton(text="✖️ Отменить", callback_data=f"cancel:{job_token}")]]
+    )
+
+def make_uploader(
+    resolve_target: Callable[[], Awaitable[UploadTarget]],
+    on_sent: Optional[Callable[[UploadTarget], None]] = None,
+) -> Callable[[InputFile], Awaitable[Optional[str]]]:
+    """
+    Загрузчик ролика. Куда грузить, спрашиваем перед самой загрузкой: первый из ждущих общую задачу
+    мог её отменить, и тогда ролик достаётся следующему. on_sent(target) узнаёт, куда он ушёл.
+    """
+    async def upload(video: InputFile) -> Optional[str]:
+        target = await resolve_target()
+        sent = await bot.send_video(
+            chat_id=target.chat_id,
+            video=video,
+            supports_streaming=True,
+            reply_parameters=ReplyParameters(message_id=target.reply_to) if target.reply_to else None,
+        )
+        if on_sent:
+            on_sent(target)
+        if target.delete_after:
+            await sent.delete()
+        return sent.video.file_id if sent.video else None
+    return upload
+
+def status_callbacks(
+    status: StatusMessage,
+) -> tuple[Callable[[dict], None], Callable[[str], Awaitable[None]]]:
+    """(хук прогресса yt-dlp, set_status) для сообщения-статуса; правки идут через progress_updater."""
     loop = asyncio.get_running_loop()
+    chat_id, msg_id = status.chat_id, status.message_id
+    markup = cancel_markup(status.cancel_token)
     last_update_time = 0.0
     spinner = ("⠋","⠙","⠹","⠸","⠼","⠴","⠦","⠧","⠇","⠏")
     spin_i = 0
-    chat_id = loading_message.chat.id
-    msg_id = loading_message.message_id
 
     def progress_hook(d: dict) -> None:
         nonlocal last_update_time, spin_i
@@ -328,11 +755,9 @@ async def process_video_link(message: types.Message, state: FSMContext):
                 speed = d.get("speed") or 0.0
                 if total > 0:
                     percent = downloaded / total * 100.0
-                    filled = int(percent // 10)
-                    bar = "█" * filled + "░" * (10 - filled)
                     text = (
                         f"📥 Скачиваю видео…\n"
-                        f"{bar} {percent:.1f}%\n"
+                        f"{progress_bar(percent)} {percent:.1f}%\n"
                         f"Скорость: {speed/1024/1024:.2f} МБ/с"
                     )
                 else:
@@ -343,167 +768,788 @@ async def process_video_link(message: types.Message, state: FSMContext):
                         f"Загружено: {downloaded/1024/1024:.2f} МБ\n"
                         f"Скорость: {speed/1024/1024:.2f} МБ/с"
                     )
-                fut = asyncio.run_coroutine_threadsafe(
-                    bot.edit_message_text(chat_id=chat_id, message_id=msg_id, text=text),
-                    loop,
-                )
-                try:
-                    fut.result(timeout=0)
-                except Exception:
-                    pass
+                # из потока yt-dlp только кладём состояние; правки и их частоту ведёт progress_updater
+                loop.call_soon_threadsafe(progress_updater.update, chat_id, msg_id, text, markup)
                 last_update_time = now
             elif status == "finished":
-                fut = asyncio.run_coroutine_threadsafe(
-                    bot.edit_message_text(chat_id=chat_id, message_id=msg_id, text="✅ Скачивание завершено, обрабатываю…"),
-                    loop,
+                loop.call_soon_threadsafe(
+                    progress_updater.update, chat_id, msg_id, "✅ Скачивание завершено, обрабатываю…", markup,
                 )
-                try:
-                    fut.result(timeout=0)
-                except Exception:
-                    pass
         except Exception as e:
             logging.debug(f"Ошибка в progress_hook: {e}")
 
-    # 1) Скачиваем
-    video_file = await asyncio.to_thread(download_video_from_url, url, platform, progress_hook)
+    async def set_status(text: str) -> None:
+        progress_updater.update(chat_id, msg_id, text, markup)
 
-    if not video_file:
-        await loading_message.edit_text("❌ Не удалось скачать видео по этой ссылке.")
-        hint = "Это мог быть приватный/возрастной ролик или Instagram попросил вход. Попробуйте другую ссылку."
-        if platform == "instagram":
-            hint = "Instagram для этой ссылки требует вход или сработал лимит. Попробуйте другую публичную ссылку."
-        await message.answer(hint, reply_markup=create_main_keyboard())
-        return
+    return progress_hook, set_status
+
+# --- Конвейер: скачать → репак → (конверт) → загрузить ---
+class VideoJobError(Exception):
+    """
+    Ролик не удалось подготовить. reason: 'download', 'too_big', 'upload', 'cooldown'
+    (платформа на паузе после блокировок, retry_after — сколько секунд ещё ждать) или 'timeout'
+    (воркер не вернул результат за JOB_RESULT_TIMEOUT).
+    """
+
+    def __init__(self, reason: str, size: int = 0, retry_after: float = 0.0):
+        super().__init__(reason)
+        self.reason = reason
+        self.size = size
+        self.retry_after = retry_after
 
-    # 2) ВСЕГДА делаем репак
-    repacked_path = await asyncio.to_thread(repack_to_mp4, video_file)
-    path_after_repack = repacked_path or video_file
-
-    # 3) Проверяем кодеки после репака; при необходимости — редкая конвертация (только IG/Shorts)
-    rv, ra = await asyncio.to_thread(check_codecs, path_after_repack)
-    converted_path = None
-    if platform in {"instagram", "youtube_shorts"} and not (rv == "h264" and ra == "aac"):
-        await loading_message.edit_text("🔧 Делаю файл совместимым с iOS…")
-        converted_path = await asyncio.to_thread(convert_video_for_mobile, path_after_repack)
-
-    path_to_send = converted_path or path_after_repack
-
-    # 4) Проверяем лимит Телеграма — НЕ перекачиваем и НЕ уменьшаем, просто сообщаем
-    size_bytes = file_size(path_to_send)
-    if size_bytes > TG_UPLOAD_LIMIT:
-        await loading_message.edit_text(
-            f"⚠️ Файл слишком большой для отправки ботом: {human_mb(size_bytes)} "
-            f"(лимит {TG_UPLOAD_LIMIT_MB} МБ)."
+# Счётчики решений конвейера (repack_done / repack_skipped / converted / fitted / streamed / stream_fallback /
+# rejected_too_big)
+pipeline_counters: Counter = Counter()
+
+STAGE_LABELS = {"download": "скачивание", "ffmpeg": "обработку", "transcode": "перекодирование"}
+
+async def process_and_upload(
+    url: str,
+    platform: str,
+    cache_key: Optional[str],
+    upload: Callable[[InputFile], Awaitable[Optional[str]]],
+    progress_hook: Optional[Callable[[dict], None]] = None,
+    on_status: Optional[Callable[[str], Awaitable[None]]] = None,
+) -> Optional[str]:
+    """
+    Полный цикл для одной ссылки. upload(video) отправляет файл и возвращает file_id.
+    Возвращает file_id (и кладёт его в кэш) либо бросает VideoJobError.
+    При STREAM_UPLOADS сначала пробует потоковый путь без файлов, при неудаче — обычный через диск.
+    Выполняется там, где стоят пулы стадий: в процессе бота или в worker.py.
+    """
+    def queue_status(stage: str) -> Optional[Callable[[int], Awaitable[None]]]:
+        if not on_status:
+            return None
+        return lambda position: on_status(f"⏳ Вы в очереди на {STAGE_LABELS[stage]}: {position}-й")
+
+    last_progress = 0.0
+    transcode_label = "🔧 Делаю файл совместимым с iOS…"
+
+    async def transcode_progress(percent: Optional[float], speed: str) -> None:
+        nonlocal last_progress
+        now = time.monotonic()
+        if not on_status or percent is None or now - last_progress < 2.0:
+            return
+        last_progress = now
+        await on_status(f"{transcode_label}\n{progress_bar(percent)} {percent:.0f}%\nСкорость: {speed}")
+
+    # yt-dlp в потоке не отменить снаружи — флаг проверяется в хуке прогресса
+    cancel_event = threading.Event()
+
+    def download_hook(d: dict) -> None:
+        if cancel_event.is_set():
+            raise yt_dlp.utils.DownloadCancelled("Загрузка отменена")
+        if progress_hook:
+            progress_hook(d)
+
+    # Платформа недавно блокировала нас — не дёргаем её (и не жжём cookies), пока не кончится пауза
+    # (с JOB_QUEUE состояние в очереди задач — запрос к ней уводим из event loop)
+    pause = await asyncio.to_thread(platform_cooldown.remaining, platform)
+    if pause:
+        raise VideoJobError("cooldown", retry_after=pause)
+    # Ведро платформы: запросы к ней идут не чаще лимита, лишние ждут своей очереди
+    allowed, wait = await asyncio.to_thread(platform_limiter.reserve, platform, PLATFORM_RATE_MAX_WAIT)
+    if not allowed:
+        raise QueueFull()
+    if wait:
+        if on_status:
+            await on_status(f"⏳ {display_platform_name(platform)} ограничивает частоту запросов, начну через {wait:.0f} с…")
+        await asyncio.sleep(wait)
+
+    if STREAM_UPLOADS:
+        # 0) Поток: yt-dlp → ffmpeg remux → Телеграм. Диск нужен, только если контейнеру нужен seek
+        #    (moov в конце) или формат требует перекода — тогда поток упадёт и пойдём обычным путём
+        stream = RemuxStream(url, ytdlp_stream_args(platform), TG_UPLOAD_LIMIT)
+        try:
+            if on_status:
+                await on_status("📥 Скачиваю и сразу отправляю…")
+            with metrics.STAGE_SECONDS.time(stage="stream", platform=platform):
+                file_id = await scheduler.run_coro("download", upload, stream, on_queue=queue_status("download"))
+            pipeline_counters["streamed"] += 1
+            metrics.UPLOADED_BYTES.inc(stream.bytes_sent, platform=platform)
+            if file_id and cache_key:
+                file_id_cache.set(cache_key, file_id)
+            return file_id
+        except Exception as e:
+            if stream.too_big and not TRANSCODE_FIT:
+                raise VideoJobError("too_big", stream.bytes_sent) from e
+            pipeline_counters["stream_fallback"] += 1
+            logging.warning(f"Потоковая загрузка не удалась, качаю через диск: {e}")
+        finally:
+            await stream.close()
+
+    video_file = repacked_path = converted_path = None
+    try:
+        # 1) Метаданные без скачивания: ролик, который не сжать под лимит, отклоняем до первого байта
+        with metrics.STAGE_SECONDS.time(stage="extract", platform=platform):
+            info = await scheduler.run("download", preflight_video, url, platform, on_queue=queue_status("download"))
+        # без метаданных (не одиночное видео) — формат по умолчанию, оценки нет
+        format_id, estimate = choose_format_within_limit(info, TG_UPLOAD_LIMIT) if info else (None, None)
+        if not format_id and estimate:
+            # ни один формат не влезает — качаем самый лёгкий и сожмём, если битрейта на длительность хватит
+            smallest_id, smallest_size = smallest_format(info)
+            if smallest_id:
+                format_id, estimate = smallest_id, smallest_size
+            else:
+                format_id = info.get("format_id")
+            duration = info.get("duration")
+            if (
+                not TRANSCODE_FIT
+                or estimate > TRANSCODE_FIT_MAX_MB * 1024 * 1024
+                or (duration and bitrate_budget(duration, TG_UPLOAD_LIMIT) is None)
+            ):
+                pipeline_counters["rejected_too_big"] += 1
+                raise VideoJobError("too_big", estimate)
+            logging.info(f"В лимит не влезает ни один формат, сожму {format_id} (~{human_mb(estimate)})")
+
+        # Каталог задачи и резерв места под исходник и результат (репак/перекод) — до первого байта
+        reserve = 2 * (estimate or WORKSPACE_UNKNOWN_SIZE_MB * 1024 * 1024)
+        # исходник больше резерва (оценка сильно ошиблась) или больше того, что мы готовы сжимать,
+        # yt-dlp обрывает сам — иначе он съел бы место чужих резервов
+        max_filesize = min(reserve, TRANSCODE_FIT_MAX_MB * 1024 * 1024 if TRANSCODE_FIT else TG_UPLOAD_LIMIT)
+        async with workspace.job(reserve) as job_dir:
+            # 2) Скачиваем выбранный формат по уже полученным метаданным
+            with metrics.STAGE_SECONDS.time(stage="download", platform=platform):
+                video_file = await scheduler.run(
+                    "download", download_video_from_url, url, platform, download_hook, format_id, max_filesize,
+                    info, job_dir, on_cancel=cancel_event.set,
+                )
+            if not video_file:
+                raise VideoJobError("download")
+
+            # 3) Один ffprobe на скачанный файл — по нему решаем, нужен репак или перекод
+            with metrics.STAGE_SECONDS.time(stage="probe", platform=platform):
+                info = await probe_media_async(video_file)
+            needs_fit = (
+                TRANSCODE_FIT and info is not None
+                and TG_UPLOAD_LIMIT < info.size <= TRANSCODE_FIT_MAX_MB * 1024 * 1024
+            )
+            needs_convert = needs_fit or (platform in MOBILE_COMPAT_PLATFORMS and not (info and info.is_h264_aac))
+
+            if needs_convert:
+                # 4а) Конвертация: IG/YouTube не в h264/aac или файл больше лимита. Перекод сам даёт
+                #     faststart-mp4 нужного размера, репак не нужен
+                if needs_fit:
+                    transcode_label = "🗜 Сжимаю видео под лимит Телеграма…"
+                if on_status:
+                    await on_status(transcode_label)
+                with metrics.STAGE_SECONDS.time(stage="convert", platform=platform):
+                    converted_path = await scheduler.run_coro(
+                        "transcode", convert_video_for_mobile, video_file, info, transcode_progress,
+                        on_queue=queue_status("transcode"),
+                    )
+                if converted_path:
+                    pipeline_counters["fitted" if needs_fit else "converted"] += 1
+            if not converted_path:
+                if needs_repack(video_file, info):
+                    # 4б) Репак без перекодирования
+                    with metrics.STAGE_SECONDS.time(stage="repack", platform=platform):
+                        repacked_path = await scheduler.run_coro(
+                            "ffmpeg", repack_to_mp4, video_file, on_queue=queue_status("ffmpeg"),
+                        )
+                    pipeline_counters["repack_done"] += 1
+                else:
+                    # 4в) Уже faststart mp4 с h264/aac — ремукс ничего бы не изменил, шлём как есть
+                    pipeline_counters["repack_skipped"] += 1
+                    logging.info(
+                        f"Репак не нужен ({pipeline_counters['repack_skipped']} пропущено, "
+                        f"{pipeline_counters['repack_done']} выполнено): {video_file}"
+                    )
+            path_to_send = converted_path or repacked_path or video_file
+
+            # 5) Проверяем лимит Телеграма — сюда доходят только ролики, которые сжать не удалось
+            size_bytes = file_size(path_to_send)
+            if size_bytes > TG_UPLOAD_LIMIT:
+                raise VideoJobError("too_big", size_bytes)
+
+            # 6) Отправляем
+            if on_status:
+                await on_status("📤 Отправляю видео...")
+            try:
+                with metrics.STAGE_SECONDS.time(stage="upload", platform=platform):
+                    file_id = await upload(FSInputFile(path_to_send))
+            except Exception as e:
+                logging.exception(f"Ошибка при отправке видео: {e}")
+                raise VideoJobError("upload") from e
+            metrics.UPLOADED_BYTES.inc(size_bytes, platform=platform)
+            if file_id and cache_key:
+                file_id_cache.set(cache_key, file_id)
+            return file_id
+    except asyncio.CancelledError:
+        cancel_event.set()
+        logging.info(f"Задача отменена: {url}")
+        raise
+
+async def run_video_job(
+    url: str,
+    platform: str,
+    cache_key: Optional[str],
+    user_id: int,
+    delivery: SharedDelivery,
+    status: Optional[StatusMessage] = None,
+) -> Optional[str]:
+    """
+    Задача, общая для всех ждущих ролик (её запускает shared_video_job): возвращает file_id
+    или бросает VideoJobError / QueueFull.
+    Без JOB_QUEUE конвейер идёт в этом процессе. С JOB_QUEUE задача уходит в очередь,
+    её берёт worker.py (сам правит статус и грузит ролик), а бот ждёт file_id.
+    Каждой задаче выдаётся job_id: он попадает во все её логи (и у воркера) и в итог tgdl_jobs_total.
+    """
+    token = bind_job_id(uuid.uuid4().hex[:12])
+    outcome = "error"
+    try:
+        logging.info(f"Новая задача ({display_platform_name(platform)}): {url}")
+        file_id = await _run_video_job(url, platform, cache_key, user_id, delivery, status)
+        outcome = "ok"
+        return file_id
+    except VideoJobError as e:
+        outcome = e.reason
+        raise
+    except RateLimited:
+        outcome = "rate_limited"
+        raise
+    except QueueFull:
+        outcome = "busy"
+        raise
+    except asyncio.CancelledError:
+        outcome = "cancelled"
+        raise
+    finally:
+        metrics.JOBS.inc(platform=platform, result=outcome)
+        current_job_id.reset(token)
+
+async def _run_video_job(
+    url: str,
+    platform: str,
+    cache_key: Optional[str],
+    user_id: int,
+    delivery: SharedDelivery,
+    status: Optional[StatusMessage],
+) -> Optional[str]:
+    if job_queue is None:
+        progress_hook, set_status = status_callbacks(status) if status else (None, None)
+        return await process_and_upload(
+            url, platform, cache_key, make_uploader(delivery.resolve, delivery.sent), progress_hook, set_status,
         )
-        await message.answer("Попробуйте более короткое видео или пришлите другую ссылку.", reply_markup=create_main_keyboard())
-        # Чистим файлы
-        for p in {video_file, repacked_path, converted_path}:
-            if p and os.path.exists(p):
-                try:
-                    os.remove(p)
-                    logging.info(f"Файл {p} удален.")
-                except OSError as e:
-                    logging.error(f"Ошибка при удалении файла {p}: {e}")
-        return
 
-    # 5) Отправляем
-    await loading_message.edit_text("📤 Отправляю видео...")
+    payload = {
+        "url": url,
+        "platform": platform,
+        "cache_key": cache_key,
+        "target": delivery.target._asdict(),
+        "status": status._asdict() if status else None,
+        "job_id": current_job_id.get(),
+        "user_id": user_id,
+    }
+    queue_id = await asyncio.to_thread(job_queue.enqueue, payload)
+    logging.info(f"Задача {queue_id} поставлена в очередь: {url}")
+    reported = None
+    taken_at = None  # когда задача впервые ушла из очереди (monotonic); повторы после requeue не продлевают срок
+    target = delivery.target
     try:
-        video_input = FSInputFile(path_to_send)
-        await message.reply_video(video_input)
-        await loading_message.delete()
-        logging.info(f"Видео с {display_platform_name(platform)} успешно отправлено.")
-        await message.answer("Спасибо за использование меня 🥰", reply_markup=create_main_keyboard())
-        await message.answer(
-            "💡 Ты также можешь пользоваться inline-режимом:\n"
-            "просто напиши @tktdown_bot <ссылка> прямо в любом чате.",
-            reply_markup=create_main_keyboard(),
+        while True:
+            result = await asyncio.to_thread(job_queue.take_result, queue_id)
+            if result is not None:
+                break
+            if delivery.target != target:
+                # тот, в чей чат собирались грузить, отменил запрос — ролик получит следующий
+                target = delivery.target
+                await asyncio.to_thread(job_queue.retarget, queue_id, target._asdict())
+            position = await asyncio.to_thread(job_queue.position, queue_id)
+            if status and position and position != reported:
+                # место в очереди показываем, пока задачу не взял воркер — дальше статус правит он
+                progress_updater.update(
+                    status.chat_id, status.message_id,
+                    f"⏳ Вы в очереди на обработку: {position}-й", cancel_markup(status.cancel_token),
+                )
+            reported = position
+            if not position:
+                taken_at = taken_at or time.monotonic()
+                if time.monotonic() - taken_at > JOB_RESULT_TIMEOUT:
+                    # результат протух, воркер пропал после аренды или задача крутится в requeue —
+                    # не держим хэндлер и место в admit вечно
+                    logging.error(f"Задача {queue_id}: нет результата {JOB_RESULT_TIMEOUT:.0f} с, отменяю: {url}")
+                    await asyncio.to_thread(job_queue.cancel, queue_id)
+                    raise VideoJobError("timeout")
+            await asyncio.sleep(JOB_POLL_INTERVAL)
+    except asyncio.CancelledError:
+        await asyncio.to_thread(job_queue.cancel, queue_id)
+        logging.info(f"Задача {queue_id} отменена: {url}")
+        raise
+
+    if result.get("error") == "busy":
+        raise QueueFull()
+    if "error" in result:
+        raise VideoJobError(result["error"], result.get("size", 0), result.get("retry_after", 0.0))
+    if result.get("target"):
+        delivery.sent(UploadTarget(**result["target"]))
+    file_id = result.get("file_id")
+    if file_id and cache_key:
+        file_id_cache.set(cache_key, file_id)
+    return file_id
+
+# --- Метрики состояния: снимаются с компонентов при каждом запросе /metrics ---
+# Кроме тех, что живут в JOB_QUEUE (Redis/SQLite): их раз в METRICS_STORE_INTERVAL снимает фоновая
+# задача через asyncio.to_thread, чтобы медленное хранилище не останавливало event loop на каждом /metrics
+store_gauges: dict[str, Any] = {"job_queue_depth": 0, "platform_cooldowns": {}}
+
+async def refresh_store_gauges() -> None:
+    while True:
+        try:
+            if job_queue:
+                store_gauges["job_queue_depth"] = await asyncio.to_thread(job_queue.depth)
+            store_gauges["platform_cooldowns"] = await asyncio.to_thread(platform_cooldown.states)
+        except Exception as e:
+            logging.warning(f"Не удалось снять метрики очереди задач: {e}")
+        await asyncio.sleep(METRICS_STORE_INTERVAL)
+
+metrics.Callback("tgdl_stage_active", "Занятые слоты пулов стадий",
+                 lambda: {(name,): pool.active for name, pool in scheduler.stages.items()}, ("stage",))
+metrics.Callback("tgdl_stage_queued", "Ожидают слот пула стадии",
+                 lambda: {(name,): pool.queued for name, pool in scheduler.stages.items()}, ("stage",))
+metrics.Callback("tgdl_active_jobs", "Задачи в работе и в очереди (admit)", lambda: scheduler.active_jobs)
+metrics.Callback("tgdl_jobs_rejected_total", "Отказы из-за переполнения", lambda: scheduler.rejected, kind="counter")
+metrics.Callback("tgdl_job_queue_depth", "Задач в JOB_QUEUE ждут воркера", lambda: store_gauges["job_queue_depth"])
+metrics.Callback(
+    "tgdl_cache_requests_total", "Обращения к кэшу file_id",
+    lambda: {("hit",): file_id_cache.hits, ("miss",): file_id_cache.misses}, ("result",), kind="counter",
+)
+metrics.Callback("tgdl_cache_hit_ratio", "Доля попаданий в кэш file_id", lambda: file_id_cache.stats()["hit_ratio"])
+metrics.Callback(
+    "tgdl_pipeline_decisions_total", "Решения конвейера: репак, перекод, сжатие, поток, отказ",
+    lambda: {(k,): v for k, v in pipeline_counters.items()}, ("decision",), kind="counter",
+)
+metrics.Callback("tgdl_progress_edits", "Правки статусов", lambda: {(k,): v for k, v in progress_updater.stats().items()},
+                 ("kind",))
+metrics.Callback("tgdl_workspace_bytes", "Рабочие каталоги: резервы, квоты и свободное место",
+                 lambda: {(k,): v for k, v in workspace.stats().items() if k.startswith(("disk_", "tmpfs_"))}, ("kind",))
+metrics.Callback("tgdl_workspace_jobs", "Задачи с рабочим каталогом", lambda: workspace.jobs)
+metrics.Callback("tgdl_ydl_pool", "Пул YoutubeDL", lambda: {(k,): v for k, v in ydl_pool.stats().items()}, ("kind",))
+metrics.Callback("tgdl_platform_cooldown_seconds", "Сколько ещё длится пауза платформы после блокировок",
+                 lambda: {(k,): v for k, v in store_gauges["platform_cooldowns"].items()}, ("platform",))
+metrics.Callback(
+    "tgdl_rate_limited_total", "Отказы и ожидания по ведру жетонов",
+    lambda: {("user",): user_limiter.limited, ("platform",): platform_limiter.limited}, ("scope",), kind="counter",
+)
+metrics.Callback("tgdl_fragment_concurrency", "Параллельных фрагментов HLS/DASH на загрузку",
+                 lambda: {(k,): v for k, v in fragment_tuner.levels().items()}, ("platform",))
+
+# --- Хэндлеры ---
+async def send_thanks(message: types.Message) -> None:
+    await message.answer("Спасибо за использование меня 🥰", reply_markup=create_main_keyboard())
+    await message.answer(
+        "💡 Ты также можешь пользоваться inline-режимом:\n"
+        "просто напиши @tktdown_bot <ссылка> прямо в любом чате.",
+        reply_markup=create_main_keyboard(),
+    )
+
+@dp.message(Command("start"))
+async def cmd_start(message: types.Message, state: FSMContext):
+    logging.info(f"Пользователь {message.from_user.id} запустил бота.")
+    await state.clear()
+    await message.reply(
+        "👋 Привет! Я бот для скачивания видео.\n\n"
+        "Просто отправь мне ссылку на видео, или выбери платформу ниже.\n\n"
+        "💡 Совет: ты можешь использовать меня прямо в любом чате!\n"
+        "Для этого напиши: @tktdown_bot <ссылка>",
+        reply_markup=create_main_keyboard(),
+    )
+
+@dp.message(lambda m: m.text in ["📥 TikTok", "📸 Instagram", "🎬 YouTube Shorts", "🐦 X (Twitter)"])
+async def handle_platform_choice(message: types.Message, state: FSMContext):
+    await message.reply("Отправьте мне ссылку на видео.", reply_markup=ReplyKeyboardRemove())
+    await state.set_state(DownloadState.url)
+
+@dp.message(DownloadState.url)
+@dp.message(lambda m: m.text and m.text.startswith("http"))
+async def process_video_link(message: types.Message, state: FSMContext):
+    url = message.text.strip()
+    await state.clear()
+
+    normalized = await normalize_url(url)
+    if not normalized:
+        await message.reply("Не могу определить платформу по этой ссылке.", reply_markup=create_main_keyboard())
+        return
+    platform, canonical_id, url = normalized
+
+    # 0) Кэш: этот ролик уже отправляли — шлём по file_id без скачивания и ffmpeg
+    cache_key = video_cache_key(platform, canonical_id)
+    cached_file_id = file_id_cache.get(cache_key) if cache_key else None
+    if cached_file_id:
+        try:
+            await message.reply_video(cached_file_id)
+            logging.info(f"Видео с {display_platform_name(platform)} отправлено из кэша: {cache_key}")
+            await send_thanks(message)
+            return
+        except Exception as e:
+            logging.warning(f"file_id из кэша не подошёл ({cache_key}), скачиваю заново: {e}")
+            file_id_cache.delete(cache_key)
+
+    # Кнопка отмены: пользователь передумал — останавливаем yt-dlp/ffmpeg, а не ждём таймаута
+    job_token = uuid.uuid4().hex[:16]
+    loading_message = await message.reply("📥 Подготовка к загрузке...", reply_markup=cancel_markup(job_token))
+    status = StatusMessage(loading_message.chat.id, loading_message.message_id, job_token)
+    # Ролик грузится ответом на ссылку (остальным ждущим тот же ролик он уйдёт по file_id),
+    # а с UPLOAD_CHAT_ID — в служебный чат ради file_id, и каждому ожидающему — по нему
+    if UPLOAD_CHAT_ID:
+        target = UploadTarget(UPLOAD_CHAT_ID, delete_after=True)
+    else:
+        target = UploadTarget(message.chat.id, reply_to=message.message_id)
+
+    # Тот же ролик уже готовится для другого чата — ждём его результат, а не качаем второй раз
+    flight_key = cache_key or f"url:{url}"
+    if video_flights.in_flight(flight_key):
+        progress_updater.update(
+            status.chat_id, status.message_id,
+            "⏳ Это видео уже готовится по другому запросу, подождите…", cancel_markup(job_token),
         )
+
+    running_jobs[job_token] = (message.from_user.id, asyncio.current_task())
+    try:
+        try:
+            file_id = await shared_video_job(
+                flight_key, url, platform, cache_key, message.from_user.id, target, status,
+            )
+            if file_id:
+                await message.reply_video(file_id)
+        finally:
+            # дальше сообщение-статус правим/удаляем сами — отложенные правки прогресса больше не нужны
+            await progress_updater.finish(status.chat_id, status.message_id)
+    except asyncio.CancelledError:
+        if job_token not in cancelled_jobs:
+            raise
+        await loading_message.edit_text("🚫 Загрузка отменена.")
+        await message.answer("Можно отправить другую ссылку.", reply_markup=create_main_keyboard())
+        return
+    except RateLimited as e:
+        logging.info(f"Пользователь {message.from_user.id} упёрся в лимит частоты: {url}")
+        await loading_message.edit_text(f"🐢 Слишком много ссылок подряд. Следующую можно через {human_wait(e.retry_after)}.")
+        return
+    except QueueFull:
+        logging.warning(f"Очередь переполнена, отказ пользователю {message.from_user.id}: {url}")
+        await loading_message.edit_text("🚦 Бот сейчас перегружен. Попробуйте чуть позже.")
+        await message.answer("Можно отправить ссылку ещё раз через минуту.", reply_markup=create_main_keyboard())
+        return
+    except VideoJobError as e:
+        if e.reason == "download":
+            await loading_message.edit_text("❌ Не удалось скачать видео по этой ссылке.")
+            hint = "Это мог быть приватный/возрастной ролик или Instagram попросил вход. Попробуйте другую ссылку."
+            if platform == "instagram":
+                hint = "Instagram для этой ссылки требует вход или сработал лимит. Попробуйте другую публичную ссылку."
+            await message.answer(hint, reply_markup=create_main_keyboard())
+        elif e.reason == "too_big":
+            await loading_message.edit_text(
+                f"⚠️ Файл слишком большой для отправки ботом: {human_mb(e.size)} "
+                f"(лимит {TG_UPLOAD_LIMIT_MB} МБ)."
+            )
+            await message.answer("Попробуйте более короткое видео или пришлите другую ссылку.", reply_markup=create_main_keyboard())
+        elif e.reason == "cooldown":
+            await loading_message.edit_text(
+                f"⏸ {display_platform_name(platform)} временно ограничил загрузки. "
+                f"Попробуйте через {human_wait(e.retry_after)}."
+            )
+            await message.answer("Ссылки с других платформ работают как обычно.", reply_markup=create_main_keyboard())
+        else:
+            await loading_message.edit_text("⚠️ Ошибка при отправке видео.")
+            await message.answer("Попробуйте ещё раз или выберите платформу:", reply_markup=create_main_keyboard())
+        return
     except Exception as e:
         logging.exception(f"Ошибка при отправке видео: {e}")
         await loading_message.edit_text("⚠️ Ошибка при отправке видео.")
         await message.answer("Попробуйте ещё раз или выберите платформу:", reply_markup=create_main_keyboard())
+        return
     finally:
-        # Чистим файлы
-        for p in {video_file, repacked_path, converted_path, path_to_send}:
-            # path_to_send тоже временный файл из репака/конверта, удаляем
-            if p and os.path.exists(p):
-                try:
-                    os.remove(p)
-                    logging.info(f"Файл {p} удален.")
-                except OSError as e:
-                    logging.error(f"Ошибка при удалении файла {p}: {e}")
+        running_jobs.pop(job_token, None)
+        cancelled_jobs.discard(job_token)
+
+    await loading_message.delete()
+    logging.info(f"Видео с {display_platform_name(platform)} успешно отправлено.")
+    await send_thanks(message)
+
+@dp.callback_query(lambda c: c.data and c.data.startswith("cancel:"))
+async def cancel_job(callback: CallbackQuery):
+    job_token = callback.data.split(":", 1)[1]
+    job = running_jobs.get(job_token)
+    if not job:
+        await callback.answer("Эта загрузка уже завершена.")
+        return
+    owner_id, task = job
+    if callback.from_user.id != owner_id:
+        await callback.answer("Отменить может только тот, кто прислал ссылку.", show_alert=True)
+        return
+    cancelled_jobs.add(job_token)
+    task.cancel()
+    await callback.answer("Отменяю…")
 
 # --- Инлайн режим ---
+# Ответ на inline-запрос должен уйти за секунды, поэтому тяжёлой работы здесь нет:
+# из кэша — сразу готовое видео, иначе заглушка с кнопкой «Загрузка…». Скачивание начинается,
+# только когда пользователь выбрал результат (chosen_inline_result — включите /setinlinefeedback
+# у @BotFather), и заглушка заменяется роликом через edit_message_media.
+# Запрос и выбор результата могут попасть в разные экземпляры бота, поэтому общее состояние —
+# в inline_state (JOB_QUEUE или SQLite кэша), а ролик с каноническим id кодируется прямо в id результата
+inline_placeholder_lock = asyncio.Lock()
+INLINE_PLACEHOLDER_KEY = "inline:placeholder"
+INLINE_RESULT_PREFIX = "v:"
+
+async def inline_result_id(url: str, platform: str, canonical_id: Optional[str], cache_key: Optional[str]) -> str:
+    """id результата-заглушки: 'v:<платформа>:<id ролика>' (до 64 байт) или случайный id записи в inline_state."""
+    if canonical_id:
+        result_id = f"{INLINE_RESULT_PREFIX}{platform}:{canonical_id}"
+        if len(result_id.encode()) <= 64:
+            return result_id
+    result_id = uuid.uuid4().hex
+    await asyncio.to_thread(inline_state.put_pending, result_id, url, platform, cache_key)
+    return result_id
+
+async def inline_result_job(result_id: str) -> Optional[tuple[str, str, Optional[str]]]:
+    """(url, платформа, ключ кэша) выбранной заглушки; None — выбран ролик из кэша или запись протухла."""
+    if result_id.startswith(INLINE_RESULT_PREFIX):
+        platform, _, canonical_id = result_id[len(INLINE_RESULT_PREFIX):].partition(":")
+        url = canonical_url(platform, canonical_id)
+        return (url, platform, video_cache_key(platform, canonical_id)) if url else None
+    return await asyncio.to_thread(inline_state.take_pending, result_id)
+
+def inline_wait_markup() -> InlineKeyboardMarkup:
+    # без клавиатуры Телеграм не пришлёт inline_message_id и заглушку нельзя будет заменить
+    return InlineKeyboardMarkup(
+        inline_keyboard=[[InlineKeyboardButton(text="⏳ Загрузка…", callback_data="inline:wait")]]
+    )
+
+async def inline_placeholder_file_id(user_id: int) -> Optional[str]:
+    """
+    file_id ролика-заглушки: INLINE_PLACEHOLDER_FILE_ID, кэш или один раз сгенерированный
+    ffmpeg'ом и загруженный в INLINE_UPLOAD_CHAT_ID (или в личку пользователя) чёрный кадр.
+    """
+    if INLINE_PLACEHOLDER_FILE_ID:
+        return INLINE_PLACEHOLDER_FILE_ID
+    async with inline_placeholder_lock:
+        file_id = file_id_cache.get(INLINE_PLACEHOLDER_KEY, count=False)
+        if file_id:
+            return file_id
+        try:
+            async with workspace.job(1024 * 1024) as job_dir:
+                path = os.path.join(job_dir, "placeholder.mp4")
+                await run_ffmpeg([
+                    "-y", "-f", "lavfi", "-i", "color=c=0x202020:s=480x480:d=1",
+                    "-c:v", "libx264", "-preset", "ultrafast", "-pix_fmt", "yuv420p", "-movflags", "+faststart", path,
+                ], timeout=30)
+                sent = await bot.send_video(chat_id=INLINE_UPLOAD_CHAT_ID or user_id, video=FSInputFile(path))
+            await sent.delete()
+            file_id = sent.video.file_id if sent.video else None
+        except Exception as e:
+            logging.warning(f"Не удалось подготовить заглушку для инлайн-режима: {e}")
+            return None
+        if file_id:
+            file_id_cache.set(INLINE_PLACEHOLDER_KEY, file_id)
+        return file_id
+
 @dp.inline_query()
 async def inline_handler(query: InlineQuery):
     url = (query.query or "").strip()
-    results = []
     if not url.startswith("http"):
-        await query.answer(results, cache_time=1)
+        await query.answer([], cache_time=1)
+        return
+
+    # Кэш проверяем без сети (короткие ссылки не разворачиваем) — готовое видео отдаём мгновенно
+    normalized = await normalize_url(url, resolve=False)
+    cache_key = video_cache_key(normalized[0], normalized[1]) if normalized else None
+    cached_file_id = file_id_cache.get(cache_key) if cache_key else None
+
+    if not cached_file_id:
+        # Ссылку часто дописывают или вставляют по кускам: отвечаем только на последний запрос пользователя
+        user_id = query.from_user.id
+        await asyncio.to_thread(inline_state.mark_query, user_id, query.id)
+        await asyncio.sleep(INLINE_DEBOUNCE)
+        if not await asyncio.to_thread(inline_state.take_query, user_id, query.id):
+            return
+
+        normalized = await normalize_url(url)
+        if not normalized:
+            await query.answer([], cache_time=1)
+            return
+        cache_key = video_cache_key(normalized[0], normalized[1])
+        cached_file_id = file_id_cache.get(cache_key) if cache_key else None
+
+    platform, canonical_id, url = normalized
+    if cached_file_id:
+        logging.info(f"Инлайн-запрос отдан из кэша: {cache_key}")
+        result = InlineQueryResultCachedVideo(
+            id=str(uuid.uuid4()),
+            video_file_id=cached_file_id,
+            title="Видео",
+            description="Видео скачано вашим ботом",
+        )
+        await query.answer([result], cache_time=1)
         return
 
-    platform = get_platform_from_url(url)
-    if not platform:
-        await query.answer(results, cache_time=1)
+    placeholder = await inline_placeholder_file_id(query.from_user.id)
+    if not placeholder:
+        await query.answer([], cache_time=1, is_personal=True)
         return
+    result_id = await inline_result_id(url, platform, canonical_id, cache_key)
+    await query.answer(
+        [
+            InlineQueryResultCachedVideo(
+                id=result_id,
+                video_file_id=placeholder,
+                title=f"Видео с {display_platform_name(platform)}",
+                description="Нажмите — ролик подгрузится через несколько секунд",
+                caption="⏳ Загружаю видео…",
+                reply_markup=inline_wait_markup(),
+            )
+        ],
+        cache_time=1,
+        is_personal=True,
+    )
 
+@dp.chosen_inline_result()
+async def inline_chosen(chosen: ChosenInlineResult):
+    job = await inline_result_job(chosen.result_id)
+    if not job or not chosen.inline_message_id:
+        return  # выбран ролик из кэша (или запись вытеснена) — менять нечего
+    url, platform, cache_key = job
+    inline_message_id = chosen.inline_message_id
     logging.info(f"Инлайн-запрос на скачивание с {display_platform_name(platform)}: {url}")
-    video_file_path: Optional[str] = None
-    repacked_path: Optional[str] = None
-    converted_path: Optional[str] = None
-    try:
-        # 1) Скачиваем
-        video_file_path = await asyncio.to_thread(download_video_from_url, url, platform)
-
-        if video_file_path:
-            # 2) ВСЕГДА репак
-            repacked_path = await asyncio.to_thread(repack_to_mp4, video_file_path)
-            send_path = repacked_path or video_file_path
-
-            # 3) Проверяем кодеки после репака и при необходимости конвертируем (только IG/Shorts)
-            rv, ra = await asyncio.to_thread(check_codecs, send_path)
-            if platform in {"instagram", "youtube_shorts"} and not (rv == "h264" and ra == "aac"):
-                converted_path = await asyncio.to_thread(convert_video_for_mobile, send_path)
-                send_path = converted_path or send_path
-
-            # 4) Лимит
-            if file_size(send_path) > TG_UPLOAD_LIMIT:
-                await query.answer([], cache_time=1)
-                return
-
-            # 5) Грузим в личку, берём file_id и отдаём cached-видео
-            sent = await bot.send_video(chat_id=query.from_user.id, video=FSInputFile(send_path))
-            file_id = sent.video.file_id
-            await sent.delete()
 
-            results.append(
-                InlineQueryResultCachedVideo(
-                    id=str(uuid.uuid4()),
-                    video_file_id=file_id,
-                    title="Видео",
-                    description="Видео скачано вашим ботом",
-                )
+    error = "⚠️ Не удалось подготовить видео."
+    try:
+        # Грузим в личку (или служебный чат), берём file_id и подставляем его вместо заглушки
+        file_id = await shared_video_job(
+            cache_key or f"url:{url}", url, platform, cache_key, chosen.from_user.id,
+            UploadTarget(INLINE_UPLOAD_CHAT_ID or chosen.from_user.id, delete_after=True),
+        )
+        if file_id:
+            await bot.edit_message_media(
+                inline_message_id=inline_message_id,
+                media=InputMediaVideo(media=file_id, supports_streaming=True),
             )
+            return
+    except RateLimited as e:
+        error = f"🐢 Слишком много ссылок подряд. Следующую можно через {human_wait(e.retry_after)}."
+    except QueueFull:
+        logging.warning(f"Очередь переполнена, инлайн-запрос отклонён: {url}")
+        error = "🚦 Бот сейчас перегружен. Попробуйте чуть позже."
+    except VideoJobError as e:
+        logging.info(f"Инлайн-запрос не выполнен ({e.reason}): {url}")
+        if e.reason == "too_big":
+            error = f"⚠️ Файл слишком большой для отправки ботом: {human_mb(e.size)} (лимит {TG_UPLOAD_LIMIT_MB} МБ)."
+        elif e.reason == "download":
+            error = "❌ Не удалось скачать видео по этой ссылке."
+        elif e.reason == "cooldown":
+            error = f"⏸ {display_platform_name(platform)} временно ограничил загрузки. Попробуйте через {human_wait(e.retry_after)}."
     except Exception as e:
         logging.exception(f"Ошибка в инлайн-режиме при обработке файла: {e}")
-    finally:
-        for p in {video_file_path, repacked_path, converted_path}:
-            if p and os.path.exists(p):
-                try:
-                    os.remove(p)
-                    logging.info(f"Инлайн-файл {p} удален.")
-                except OSError as e:
-                    logging.error(f"Ошибка при удалении файла {p}: {e}")
 
-    await query.answer(results, cache_time=1)
+    try:
+        await bot.edit_message_caption(inline_message_id=inline_message_id, caption=error)
+    except Exception as e:
+        logging.debug(f"Не удалось обновить инлайн-сообщение: {e}")
+
+@dp.callback_query(lambda c: c.data == "inline:wait")
+async def inline_wait(callback: CallbackQuery):
+    await callback.answer("Видео ещё готовится, подождите несколько секунд…")
 
 # --- Запуск ---
+# Обработчики апдейтов, которые ещё работают: при остановке даём им доделать начатое
+inflight_updates: set[asyncio.Task] = set()
+
+@dp.update.outer_middleware()
+async def track_inflight_updates(handler, event, data):
+    task = asyncio.current_task()
+    inflight_updates.add(task)
+    try:
+        return await handler(event, data)
+    finally:
+        inflight_updates.discard(task)
+
+async def drain_inflight_updates(timeout: float) -> None:
+    """Ждёт начатые обработчики до timeout секунд, остальные отменяет (их файлы подчистят finally)."""
+    tasks = set(inflight_updates)
+    if not tasks:
+        return
+    logging.info(f"Дожидаюсь {len(tasks)} начатых обработчиков (до {timeout:.0f} с)…")
+    _done, pending = await asyncio.wait(tasks, timeout=timeout)
+    if pending:
+        logging.warning(f"Не дождался {len(pending)} обработчиков, отменяю.")
+        for task in pending:
+            task.cancel()
+        await asyncio.wait(pending, timeout=5)
+
+async def run_webhook() -> None:
+    """
+    Апдейты приходят POST-запросами; каждый обрабатывается отдельной задачей, а Телеграм получает
+    ответ сразу. Несколько экземпляров за балансировщиком могут делить один WEBHOOK_URL.
+    """
+    if not WEBHOOK_URL:
+        raise RuntimeError("Для BOT_MODE=webhook задайте WEBHOOK_URL.")
+    app = web.Application()
+    SimpleRequestHandler(
+        dispatcher=dp, bot=bot, handle_in_background=True, secret_token=WEBHOOK_SECRET or None,
+    ).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    app.router.add_get("/metrics", metrics.handle_metrics)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:  # Windows
+            pass
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT)
+    await site.start()
+    await bot.set_webhook(
+        f"{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}",
+        secret_token=WEBHOOK_SECRET or None,
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+        allowed_updates=dp.resolve_used_update_types(),
+    )
+    logging.info(f"Webhook слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    try:
+        await stop.wait()
+    finally:
+        # сначала перестаём принимать апдейты (Телеграм отдаст их другим экземплярам или повторит),
+        # затем доделываем начатое. Вебхук не снимаем — он общий для всех экземпляров.
+        await site.stop()
+        await drain_inflight_updates(SHUTDOWN_DRAIN_TIMEOUT)
+        await runner.cleanup()
+
 async def main():
     logging.info("Бот запускается...")
-    await dp.start_polling(bot)
+    if job_queue is None:
+        # в раздельном режиме файлы живут у воркеров — там и уборка
+        workspace.start_sweeper(WORKSPACE_SWEEP_INTERVAL, WORKSPACE_ORPHAN_AGE)
+    metrics_runner = None
+    if METRICS_PORT and BOT_MODE != "webhook":
+        metrics_runner = await metrics.start_http_server(METRICS_HOST, METRICS_PORT)
+        logging.info(f"Метрики: http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    gauges_task = asyncio.create_task(refresh_store_gauges())
+    try:
+        if BOT_MODE == "webhook":
+            await run_webhook()
+        elif BOT_MODE == "polling":
+            await bot.delete_webhook()
+            await dp.start_polling(bot, close_bot_session=False)
+            await drain_inflight_updates(SHUTDOWN_DRAIN_TIMEOUT)
+        else:
+            raise RuntimeError(f"Неизвестный BOT_MODE={BOT_MODE!r}: ожидается polling или webhook.")
+    finally:
+        gauges_task.cancel()
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        await bot.session.close()
+        await close_urls_session()
+        await progress_updater.close()
+        await workspace.close()
+        scheduler.shutdown()
+        if job_queue:
+            job_queue.close()
+        ydl_pool.close()
 
 if __name__ == "__main__":
     install_ffmpeg()  # уберите, если FFmpeg уже установлен системно
-    os.makedirs("downloads", exist_ok=True)
     asyncio.run(main())
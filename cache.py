@@ -0,0 +1,201 @@
+import os
+import json
+import time
+import logging
+import sqlite3
+import threading
+from typing import Optional
+
+
+class FileIdCache:
+    """
+    Персистентный кэш file_id Телеграма (SQLite на локальном диске).
+    Ключ — канонический идентификатор видео, значение — file_id уже отправленного ролика.
+    Записи живут ttl секунд, при переполнении вытесняются давно не использованные (LRU).
+    """
+
+    def __init__(self, path: str, ttl: float, max_entries: int):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        # autocommit: каждая запись сразу на диске, переживает падение процесса
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS file_ids ("
+            " key TEXT PRIMARY KEY,"
+            " file_id TEXT NOT NULL,"
+            " created_at REAL NOT NULL,"
+            " last_used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS file_ids_last_used ON file_ids(last_used)")
+
+    def get(self, key: str, count: bool = True) -> Optional[str]:
+        """
+        Возвращает file_id по ключу или None (промах / запись протухла).
+        count=False — служебные записи (заглушка инлайн-режима), в hits/misses не попадают.
+        """
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT file_id, created_at FROM file_ids WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or now - row[1] > self.ttl:
+                if row is not None:
+                    self._conn.execute("DELETE FROM file_ids WHERE key = ?", (key,))
+                self.misses += count
+                return None
+            self._conn.execute("UPDATE file_ids SET last_used = ? WHERE key = ?", (now, key))
+            self.hits += count
+            return row[0]
+
+    def set(self, key: str, file_id: str) -> None:
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO file_ids (key, file_id, created_at, last_used) VALUES (?, ?, ?, ?)",
+                (key, file_id, now, now),
+            )
+            self._evict(now)
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM file_ids WHERE key = ?", (key,))
+
+    def _evict(self, now: float) -> None:
+        """Удаляет протухшие записи и лишнее сверх max_entries (по давности использования)."""
+        self._conn.execute("DELETE FROM file_ids WHERE created_at < ?", (now - self.ttl,))
+        (count,) = self._conn.execute("SELECT COUNT(*) FROM file_ids").fetchone()
+        overflow = count - self.max_entries
+        if overflow > 0:
+            self._conn.execute(
+                "DELETE FROM file_ids WHERE key IN ("
+                " SELECT key FROM file_ids ORDER BY last_used ASC LIMIT ?)",
+                (overflow,),
+            )
+            logging.info(f"Кэш file_id: вытеснено {overflow} записей.")
+
+    def stats(self) -> dict:
+        with self._lock:
+            (size,) = self._conn.execute("SELECT COUNT(*) FROM file_ids").fetchone()
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / total if total else 0.0,
+            "size": size,
+        }
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class InlineState:
+    """
+    Состояние инлайн-режима: последний запрос пользователя (дебаунс набора ссылки) и ссылки,
+    для которых показана заглушка и ждём chosen_inline_result.
+    Без store — в той же SQLite, что и кэш file_id: её видят только процессы бота на этой машине.
+    Со store (очередь задач JOB_QUEUE, например Redis) — в ней, и тогда состояние общее для экземпляров
+    бота на разных машинах (webhook за балансировщиком); записи там живут pending_ttl, без лимита числа.
+    Все методы блокирующие — из event loop их вызывают через asyncio.to_thread.
+    """
+
+    QUERY_TTL = 60  # сколько помнить последний запрос пользователя в store, сек
+
+    def __init__(self, path: str, pending_ttl: float, max_pending: int, store=None):
+        self.pending_ttl = pending_ttl
+        self.max_pending = max_pending
+        self.store = store
+        self._lock = threading.Lock()
+        self._conn = None
+        if store is not None:
+            return
+
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS inline_queries ("
+            " user_id INTEGER PRIMARY KEY,"
+            " query_id TEXT NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS inline_pending ("
+            " result_id TEXT PRIMARY KEY,"
+            " url TEXT NOT NULL,"
+            " platform TEXT NOT NULL,"
+            " cache_key TEXT,"
+            " created_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS inline_pending_created ON inline_pending(created_at)")
+
+    def mark_query(self, user_id: int, query_id: str) -> None:
+        """Запоминает последний запрос пользователя."""
+        if self.store is not None:
+            self.store.put_value(f"inline_query:{user_id}", query_id, self.QUERY_TTL)
+            return
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO inline_queries (user_id, query_id) VALUES (?, ?)", (user_id, query_id)
+            )
+
+    def take_query(self, user_id: int, query_id: str) -> bool:
+        """True, если query_id всё ещё последний запрос пользователя (запись при этом снимается)."""
+        if self.store is not None:
+            return self.store.take_value(f"inline_query:{user_id}", query_id) is not None
+        with self._lock:
+            cur = self._conn.execute(
+                "DELETE FROM inline_queries WHERE user_id = ? AND query_id = ?", (user_id, query_id)
+            )
+            return cur.rowcount > 0
+
+    def put_pending(self, result_id: str, url: str, platform: str, cache_key: Optional[str]) -> None:
+        if self.store is not None:
+            self.store.put_value(
+                f"inline_pending:{result_id}", json.dumps([url, platform, cache_key]), self.pending_ttl,
+            )
+            return
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO inline_pending (result_id, url, platform, cache_key, created_at)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (result_id, url, platform, cache_key, now),
+            )
+            self._conn.execute("DELETE FROM inline_pending WHERE created_at < ?", (now - self.pending_ttl,))
+            self._conn.execute(
+                "DELETE FROM inline_pending WHERE result_id IN ("
+                " SELECT result_id FROM inline_pending ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_pending,),
+            )
+
+    def take_pending(self, result_id: str) -> Optional[tuple[str, str, Optional[str]]]:
+        """(url, платформа, ключ кэша) для выбранного результата или None; запись снимается."""
+        if self.store is not None:
+            value = self.store.take_value(f"inline_pending:{result_id}")
+            return tuple(json.loads(value)) if value else None
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT url, platform, cache_key, created_at FROM inline_pending WHERE result_id = ?", (result_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute("DELETE FROM inline_pending WHERE result_id = ?", (result_id,))
+        if time.time() - row[3] > self.pending_ttl:
+            return None
+        return row[0], row[1], row[2]
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
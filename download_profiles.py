@@ -0,0 +1,225 @@
+import os
+import threading
+from dataclasses import dataclass, replace
+from typing import Callable, Optional
+
+# --- Настройки ---
+DOWNLOAD_ADAPTIVE = os.getenv("DOWNLOAD_ADAPTIVE", "1") == "1"  # подбирать число параллельных фрагментов по скорости
+DOWNLOAD_MAX_FRAGMENTS = int(os.getenv("DOWNLOAD_MAX_FRAGMENTS", "16"))  # потолок для всех платформ
+DOWNLOAD_USER_AGENT = os.getenv("DOWNLOAD_USER_AGENT", "")  # один UA для всех платформ вместо профильных
+DOWNLOAD_PROBE_EVERY = int(os.getenv("DOWNLOAD_PROBE_EVERY", "20"))  # раз в столько загрузок пробуем уровень выше
+
+DESKTOP_USER_AGENT = (
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
+    "AppleWebKit/537.36 (KHTML, like Gecko) "
+    "Chrome/124.0.0.0 Safari/537.36"
+)
+MOBILE_USER_AGENT = (
+    "Mozilla/5.0 (iPhone; CPU iPhone OS 17_4 like Mac OS X) "
+    "AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.4 Mobile/15E148 Safari/604.1"
+)
+
+FRAGMENT_LADDER = (1, 2, 4, 8, 16)  # уровни параллельности фрагментов, между которыми ходит контроллер
+SEGMENTED_PROTOCOLS = ("m3u8", "m3u8_native", "http_dash_segments", "dash_frag_urls", "f4m", "ism")
+MIN_SAMPLE_BYTES = 2 * 1024 * 1024  # загрузки меньше — слишком шумные, чтобы по ним судить о скорости
+EWMA_ALPHA = 0.3
+GAIN_UP = 1.10    # уровень выше оставляем, если он быстрее хотя бы на 10%
+GAIN_DOWN = 0.95  # уровень ниже выбираем, если он почти не медленнее (лишние соединения ни к чему)
+
+
+@dataclass(frozen=True)
+class DownloadProfile:
+    """Сетевые настройки yt-dlp для платформы."""
+    fragments: int                 # параллельных фрагментов HLS/DASH на старте
+    max_fragments: int
+    http_chunk_size: Optional[int]  # качать прогрессивный файл кусками (обход троттлинга), None — целиком
+    retries: int
+    fragment_retries: int
+    backoff_start: float           # пауза перед повтором: start * 2^n, но не больше backoff_max
+    backoff_max: float
+    socket_timeout: float
+    user_agent: str
+
+    def backoff(self) -> Callable[[int], float]:
+        start, limit = self.backoff_start, self.backoff_max
+        return lambda n: min(limit, start * 2 ** n)
+
+    def ydl_options(self) -> dict:
+        backoff = self.backoff()
+        return {
+            "retries": self.retries,
+            "fragment_retries": self.fragment_retries,
+            "extractor_retries": min(3, self.retries),
+            "retry_sleep_functions": {"http": backoff, "fragment": backoff, "extractor": backoff},
+            "socket_timeout": self.socket_timeout,
+            "http_chunk_size": self.http_chunk_size,
+            "concurrent_fragment_downloads": self.fragments,
+            "http_headers": {"User-Agent": self.user_agent},
+        }
+
+    def cli_args(self, fragments: Optional[int] = None) -> list[str]:
+        """То же для CLI yt-dlp (потоковый режим)."""
+        args = [
+            "--user-agent", self.user_agent,
+            "--retries", str(self.retries),
+            "--fragment-retries", str(self.fragment_retries),
+            "--retry-sleep", f"http:exp={self.backoff_start:g}:{self.backoff_max:g}",
+            "--retry-sleep", f"fragment:exp={self.backoff_start:g}:{self.backoff_max:g}",
+            "--socket-timeout", f"{self.socket_timeout:g}",
+            "--concurrent-fragments", str(fragments or self.fragments),
+        ]
+        if self.http_chunk_size:
+            args += ["--http-chunk-size", str(self.http_chunk_size)]
+        return args
+
+
+DEFAULT_PROFILE = DownloadProfile(
+    fragments=1, max_fragments=4, http_chunk_size=None, retries=5, fragment_retries=5,
+    backoff_start=1.0, backoff_max=16.0, socket_timeout=20.0, user_agent=DESKTOP_USER_AGENT,
+)
+PROFILES: dict[str, DownloadProfile] = {
+    # DASH/HLS; прогрессивные файлы YouTube режет по скорости без Range-кусков по ~10 МБ
+    "youtube": replace(DEFAULT_PROFILE, fragments=4, max_fragments=16, http_chunk_size=10 * 1024 * 1024,
+                       retries=10, fragment_retries=10),
+    "youtube_shorts": replace(DEFAULT_PROFILE, fragments=4, max_fragments=16, http_chunk_size=10 * 1024 * 1024,
+                              retries=10, fragment_retries=10),
+    # видео в X — HLS из коротких сегментов: параллельность даёт больше всего
+    "twitter": replace(DEFAULT_PROFILE, fragments=4, max_fragments=16, fragment_retries=10),
+    # TikTok отдаёт один mp4; CDN быстрый, но рвёт долгие соединения — короткий таймаут, частые повторы
+    "tiktok": replace(DEFAULT_PROFILE, max_fragments=1, socket_timeout=15.0, backoff_start=0.5),
+    # Instagram за частые повторы выдаёт стену логина — повторяем реже и дольше ждём
+    "instagram": replace(DEFAULT_PROFILE, fragments=2, max_fragments=4, retries=3, fragment_retries=3,
+                         backoff_start=2.0, backoff_max=30.0, user_agent=MOBILE_USER_AGENT),
+}
+
+
+def get_profile(platform: str) -> DownloadProfile:
+    profile = PROFILES.get(platform, DEFAULT_PROFILE)
+    profile = replace(profile, max_fragments=max(1, min(profile.max_fragments, DOWNLOAD_MAX_FRAGMENTS)))
+    profile = replace(profile, fragments=min(profile.fragments, profile.max_fragments))
+    if DOWNLOAD_USER_AGENT:
+        profile = replace(profile, user_agent=DOWNLOAD_USER_AGENT)
+    return profile
+
+
+class _PlatformState:
+    def __init__(self, level: int):
+        self.level = level
+        self.speeds: dict[int, float] = {}  # уровень -> сглаженная скорость одной загрузки, байт/с
+        self.since_probe = 0
+        self.probing_from: Optional[int] = None  # уровень, с которого ушли пробовать соседний
+
+
+class FragmentTuner:
+    """
+    Подбирает число параллельных фрагментов для сегментированных (HLS/DASH) загрузок платформы.
+    yt-dlp читает concurrent_fragment_downloads один раз в начале загрузки, поэтому решение
+    принимается между загрузками: по хуку прогресса меряем скорость каждой сегментированной
+    загрузки, сглаживаем её по уровню и поднимаемся по FRAGMENT_LADDER, пока это заметно ускоряет,
+    а при ошибках или отсутствии выигрыша спускаемся. Раз в DOWNLOAD_PROBE_EVERY загрузок
+    снова пробуем уровень выше — условия сети меняются.
+    """
+
+    def __init__(self, adaptive: bool = DOWNLOAD_ADAPTIVE, probe_every: int = DOWNLOAD_PROBE_EVERY):
+        self.adaptive = adaptive
+        self.probe_every = probe_every
+        self.samples = 0
+        self.raised = 0
+        self.lowered = 0
+        self._states: dict[str, _PlatformState] = {}
+        self._lock = threading.Lock()
+
+    def _state(self, platform: str) -> _PlatformState:
+        state = self._states.get(platform)
+        if state is None:
+            state = self._states[platform] = _PlatformState(get_profile(platform).fragments)
+        return state
+
+    def _ladder(self, platform: str) -> list[int]:
+        profile = get_profile(platform)
+        ladder = [n for n in FRAGMENT_LADDER if n <= profile.max_fragments]
+        return sorted(set(ladder) | {profile.fragments, profile.max_fragments})
+
+    def level(self, platform: str) -> int:
+        with self._lock:
+            return self._state(platform).level
+
+    def levels(self) -> dict[str, int]:
+        with self._lock:
+            return {platform: state.level for platform, state in self._states.items()}
+
+    def _neighbour(self, platform: str, level: int, step: int) -> Optional[int]:
+        ladder = self._ladder(platform)
+        i = ladder.index(level) + step if level in ladder else None
+        return ladder[i] if i is not None and 0 <= i < len(ladder) else None
+
+    def record(self, platform: str, level: int, size: int, elapsed: float) -> None:
+        """Итог сегментированной загрузки на уровне level: size байт за elapsed секунд."""
+        if not self.adaptive or size < MIN_SAMPLE_BYTES or elapsed <= 0:
+            return
+        speed = size / elapsed
+        with self._lock:
+            self.samples += 1
+            state = self._state(platform)
+            prev = state.speeds.get(level)
+            state.speeds[level] = speed if prev is None else prev + EWMA_ALPHA * (speed - prev)
+            if level != state.level:
+                return  # загрузка началась до смены уровня — скорость запомнили, решение не трогаем
+            state.since_probe += 1
+            current = state.speeds[level]
+            lower = self._neighbour(platform, level, -1)
+            higher = self._neighbour(platform, level, +1)
+
+            if state.probing_from is not None:
+                # пробный шаг вверх: остаёмся, только если он заметно быстрее прежнего уровня
+                base = state.speeds.get(state.probing_from, 0.0)
+                if current < base * GAIN_UP:
+                    self._move(state, state.probing_from)
+                state.probing_from = None
+            elif lower is not None and lower in state.speeds and state.speeds[lower] >= current * GAIN_DOWN:
+                self._move(state, lower)
+            elif higher is not None and (higher not in state.speeds or state.since_probe >= self.probe_every):
+                state.probing_from = level
+                self._move(state, higher)
+            elif higher is not None and state.speeds[higher] >= current * GAIN_UP:
+                self._move(state, higher)
+
+    def record_failure(self, platform: str, level: int) -> None:
+        """Загрузка упала: возможно, источник режет параллельные запросы — шаг вниз."""
+        if not self.adaptive:
+            return
+        with self._lock:
+            state = self._state(platform)
+            lower = self._neighbour(platform, state.level, -1)
+            if level == state.level and lower is not None:
+                state.probing_from = None
+                self._move(state, lower)
+
+    def _move(self, state: _PlatformState, level: int) -> None:
+        if level > state.level:
+            self.raised += 1
+        elif level < state.level:
+            self.lowered += 1
+        state.level = level
+        state.since_probe = 0
+
+    def hook(self, platform: str, level: int) -> Callable[[dict], None]:
+        """Хук прогресса yt-dlp: на 'finished' сегментированной загрузки отдаёт её скорость в record."""
+        segmented = False
+
+        def progress_hook(d: dict) -> None:
+            nonlocal segmented
+            if d.get("fragment_count"):
+                segmented = True
+            if d.get("status") != "finished":
+                return
+            protocol = str((d.get("info_dict") or {}).get("protocol") or "")
+            if segmented or protocol.startswith(SEGMENTED_PROTOCOLS):
+                self.record(platform, level, d.get("downloaded_bytes") or d.get("total_bytes") or 0,
+                            d.get("elapsed") or 0.0)
+            segmented = False  # video+audio — две загрузки подряд, у каждой свой итог
+
+        return progress_hook
+
+    def stats(self) -> dict:
+        return {"samples": self.samples, "raised": self.raised, "lowered": self.lowered}
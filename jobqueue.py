@@ -0,0 +1,704 @@
+import os
+import json
+import time
+import uuid
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import Any, Optional
+
+from ratelimit import count_block, take_token
+
+
+class JobQueue(ABC):
+    """
+    Очередь задач между фронтендом бота и воркерами (worker.py).
+    Фронтенд кладёт задачу и ждёт результат ({"file_id": ...} или {"error": reason, "size": n}),
+    воркер забирает задачу, продлевает аренду (heartbeat) и сдаёт результат.
+    Задачи упавших воркеров возвращаются в очередь по истечении аренды.
+    Воркеры берут задачи пользователей по кругу (payload["user_id"]): один пользователь с десятком
+    ссылок не займёт всех воркеров, пока другие ждут.
+    Там же живёт состояние, общее для всех процессов: вёдра жетонов пользователей и платформ и паузы после блокировок
+    (ratelimit.KeyedLimiter / PlatformCooldown с store=очередь) и короткоживущие значения
+    (cache.InlineState с store=очередь). Время в нём — time.time().
+    Все методы блокирующие — из event loop их вызывают через asyncio.to_thread.
+    """
+
+    @abstractmethod
+    def enqueue(self, payload: dict) -> str:
+        ...
+
+    @abstractmethod
+    def claim(self, worker_id: str) -> Optional[tuple[str, dict]]:
+        """Самая старая задача пользователя, чья очередь дольше всех не подходила, или None, если задач нет."""
+        ...
+
+    @abstractmethod
+    def heartbeat(self, job_id: str) -> None:
+        ...
+
+    @abstractmethod
+    def complete(self, job_id: str, result: dict) -> None:
+        ...
+
+    @abstractmethod
+    def take_result(self, job_id: str) -> Optional[dict]:
+        """Результат готовой задачи (запись при этом удаляется) или None, если ещё не готова."""
+        ...
+
+    @abstractmethod
+    def position(self, job_id: str) -> int:
+        """Примерное место в очереди (с учётом очерёдности пользователей), начиная с 1; 0 — задача уже у воркера или её нет."""
+        ...
+
+    @abstractmethod
+    def cancel(self, job_id: str) -> None:
+        ...
+
+    @abstractmethod
+    def is_cancelled(self, job_id: str) -> bool:
+        ...
+
+    @abstractmethod
+    def retarget(self, job_id: str, target: dict) -> None:
+        """Новый получатель ролика: тот, в чей чат собирались грузить, отменил, а задачу ждут другие."""
+        ...
+
+    @abstractmethod
+    def target(self, job_id: str) -> Optional[dict]:
+        """Текущий получатель ролика (payload["target"] или заданный через retarget); None — задачи нет."""
+        ...
+
+    @abstractmethod
+    def requeue_stale(self, lease: float) -> int:
+        """Возвращает в очередь задачи, чей воркер не подавал признаков жизни дольше lease секунд."""
+        ...
+
+    @abstractmethod
+    def depth(self) -> int:
+        ...
+
+    @abstractmethod
+    def reserve_token(self, key: str, rate: float, burst: float, max_wait: float) -> tuple[bool, float]:
+        """Общее ведро key (ratelimit.take_token): (списан ли жетон, через сколько секунд начинать)."""
+        ...
+
+    @abstractmethod
+    def count_block(self, key: str, threshold: int, base: float, max_pause: float) -> float:
+        """Учитывает блокировку (ratelimit.count_block); возвращает длину начатой паузы или 0."""
+        ...
+
+    @abstractmethod
+    def clear_blocks(self, key: str) -> None:
+        """Удачный запрос: счётчик блокировок подряд — в 0, длина паузы — к base, если пауза уже кончилась."""
+        ...
+
+    @abstractmethod
+    def cooldown_until(self, key: str) -> float:
+        """Конец паузы key (time.time()), 0 — паузы не было."""
+        ...
+
+    @abstractmethod
+    def cooldowns(self) -> dict[str, float]:
+        """Все ключи, которые уже блокировали -> конец паузы."""
+        ...
+
+    @abstractmethod
+    def put_value(self, key: str, value: str, ttl: float) -> None:
+        """Значение под key на ttl секунд (прежнее заменяется)."""
+        ...
+
+    @abstractmethod
+    def take_value(self, key: str, expected: Optional[str] = None) -> Optional[str]:
+        """Забирает значение key (запись снимается) или None; с expected — только если оно равно expected."""
+        ...
+
+    def close(self) -> None:
+        pass
+
+
+class SQLiteJobQueue(JobQueue):
+    """Очередь в SQLite: несколько процессов-воркеров на одной машине (WAL, BEGIN IMMEDIATE)."""
+
+    GC_INTERVAL = 600  # как часто чистить полные вёдра и очерёдность ушедших пользователей, сек
+
+    def __init__(self, path: str):
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._next_gc = 0.0
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " id TEXT PRIMARY KEY,"
+            " payload TEXT NOT NULL,"
+            " status TEXT NOT NULL,"  # queued / running / done / cancelled
+            " worker TEXT,"
+            " created_at REAL NOT NULL,"
+            " heartbeat REAL,"
+            " result TEXT,"
+            " user_id TEXT)"
+        )
+        self._add_column("jobs", "user_id", "TEXT")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_status_created ON jobs(status, created_at)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_status_user ON jobs(status, user_id, created_at)")
+        # когда очередь пользователя подходила последний раз: claim берёт того, кто ждал дольше всех
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS turns ("
+            " user_id TEXT PRIMARY KEY,"
+            " served REAL NOT NULL)"
+        )
+        # expires — когда ведро наполнится снова: тогда запись можно удалить, ключей-пользователей много
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS buckets ("
+            " key TEXT PRIMARY KEY,"
+            " tokens REAL NOT NULL,"
+            " updated REAL NOT NULL,"
+            " expires REAL)"
+        )
+        self._add_column("buckets", "expires", "REAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS kv ("
+            " key TEXT PRIMARY KEY,"
+            " value TEXT NOT NULL,"
+            " expires REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cooldowns ("
+            " key TEXT PRIMARY KEY,"
+            " failures INTEGER NOT NULL,"
+            " pause REAL NOT NULL,"
+            " until REAL NOT NULL)"
+        )
+
+    def _add_column(self, table: str, column: str, decl: str) -> None:
+        """Колонка, которой не было в базах прежних версий."""
+        if column in {row[1] for row in self._conn.execute(f"PRAGMA table_info({table})")}:
+            return
+        try:
+            self._conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+        except sqlite3.OperationalError as e:
+            if "duplicate column" not in str(e):  # её только что добавил другой процесс
+                raise
+
+    def _gc(self, now: float) -> None:
+        """Под self._lock: раз в GC_INTERVAL удаляет полные вёдра, протухшие значения и очерёдность пользователей без задач."""
+        if now < self._next_gc:
+            return
+        self._next_gc = now + self.GC_INTERVAL
+        self._conn.execute("DELETE FROM buckets WHERE expires < ?", (now,))
+        self._conn.execute("DELETE FROM kv WHERE expires < ?", (now,))
+        self._conn.execute(
+            "DELETE FROM turns WHERE served < ? AND user_id NOT IN"
+            " (SELECT user_id FROM jobs WHERE user_id IS NOT NULL)",
+            (now - self.GC_INTERVAL,),
+        )
+
+    @contextmanager
+    def _immediate(self):
+        """Транзакция с блокировкой на запись сразу: чтение и запись не разорвёт другой процесс."""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def enqueue(self, payload: dict) -> str:
+        job_id = uuid.uuid4().hex
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO jobs (id, payload, status, created_at, user_id) VALUES (?, ?, 'queued', ?, ?)",
+                (job_id, json.dumps(payload), time.time(), _user_key(payload)),
+            )
+        return job_id
+
+    def claim(self, worker_id: str) -> Optional[tuple[str, dict]]:
+        now = time.time()
+        with self._immediate():
+            self._gc(now)
+            # пользователи по кругу: сначала тот, чья очередь дольше всех не подходила (новый — сразу)
+            row = self._conn.execute(
+                "SELECT j.id, j.payload, j.user_id FROM jobs j LEFT JOIN turns t ON t.user_id = j.user_id"
+                " WHERE j.status = 'queued' ORDER BY COALESCE(t.served, 0), j.created_at LIMIT 1"
+            ).fetchone()
+            if row:
+                self._conn.execute(
+                    "UPDATE jobs SET status = 'running', worker = ?, heartbeat = ? WHERE id = ?",
+                    (worker_id, now, row[0]),
+                )
+                if row[2] is not None:
+                    self._conn.execute("INSERT OR REPLACE INTO turns (user_id, served) VALUES (?, ?)", (row[2], now))
+        return (row[0], json.loads(row[1])) if row else None
+
+    def heartbeat(self, job_id: str) -> None:
+        with self._lock:
+            self._conn.execute("UPDATE jobs SET heartbeat = ? WHERE id = ?", (time.time(), job_id))
+
+    def complete(self, job_id: str, result: dict) -> None:
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET status = 'done', result = ? WHERE id = ? AND status != 'cancelled'",
+                (json.dumps(result), job_id),
+            )
+            # отменённую задачу никто ждать не будет
+            self._conn.execute("DELETE FROM jobs WHERE id = ? AND status = 'cancelled'", (job_id,))
+
+    def take_result(self, job_id: str) -> Optional[dict]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT result FROM jobs WHERE id = ? AND status = 'done'", (job_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+        return json.loads(row[0])
+
+    def position(self, job_id: str) -> int:
+        with self._lock:
+            mine = self._conn.execute(
+                "SELECT j.user_id, j.created_at, COALESCE(t.served, 0) FROM jobs j"
+                " LEFT JOIN turns t ON t.user_id = j.user_id WHERE j.id = ? AND j.status = 'queued'",
+                (job_id,),
+            ).fetchone()
+            if mine is None:
+                return 0
+            user_id, created_at, served = mine
+            turn, oldest = self._conn.execute(
+                "SELECT SUM(created_at <= ?), MIN(created_at) FROM jobs WHERE status = 'queued' AND user_id IS ?",
+                (created_at, user_id),
+            ).fetchone()
+            # порядок в круге — как в claim: кто дольше не подходил, при равенстве — чья задача старше
+            others = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(t.served, 0), MIN(j.created_at) FROM jobs j"
+                " LEFT JOIN turns t ON t.user_id = j.user_id"
+                " WHERE j.status = 'queued' AND j.user_id IS NOT ? GROUP BY j.user_id",
+                (user_id,),
+            ).fetchall()
+        return _fair_position(turn, (served, oldest), [(count, (s, o)) for count, s, o in others])
+
+    def cancel(self, job_id: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM jobs WHERE id = ? AND status IN ('queued', 'done')", (job_id,))
+            self._conn.execute("UPDATE jobs SET status = 'cancelled' WHERE id = ? AND status = 'running'", (job_id,))
+
+    def is_cancelled(self, job_id: str) -> bool:
+        with self._lock:
+            row = self._conn.execute("SELECT status FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return row is None or row[0] == "cancelled"
+
+    def retarget(self, job_id: str, target: dict) -> None:
+        with self._immediate():
+            row = self._conn.execute("SELECT payload FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row:
+                payload = json.loads(row[0])
+                payload["target"] = target
+                self._conn.execute("UPDATE jobs SET payload = ? WHERE id = ?", (json.dumps(payload), job_id))
+
+    def target(self, job_id: str) -> Optional[dict]:
+        with self._lock:
+            row = self._conn.execute("SELECT payload FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return json.loads(row[0])["target"] if row else None
+
+    def requeue_stale(self, lease: float) -> int:
+        with self._lock:
+            cur = self._conn.execute(
+                "UPDATE jobs SET status = 'queued', worker = NULL WHERE status = 'running' AND heartbeat < ?",
+                (time.time() - lease,),
+            )
+            self._conn.execute(
+                "DELETE FROM jobs WHERE status = 'cancelled' AND heartbeat < ?", (time.time() - lease,)
+            )
+        return cur.rowcount
+
+    def depth(self) -> int:
+        with self._lock:
+            (count,) = self._conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()
+        return count
+
+    def reserve_token(self, key: str, rate: float, burst: float, max_wait: float) -> tuple[bool, float]:
+        now = time.time()
+        with self._immediate():
+            self._gc(now)
+            row = self._conn.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+            tokens, updated = row or (burst, now)
+            ok, wait, tokens = take_token(tokens, updated, now, rate, burst, max_wait)
+            self._conn.execute(
+                "INSERT OR REPLACE INTO buckets (key, tokens, updated, expires) VALUES (?, ?, ?, ?)",
+                (key, tokens, now, now + (burst - tokens) / rate + 60),
+            )
+        return ok, wait
+
+    def count_block(self, key: str, threshold: int, base: float, max_pause: float) -> float:
+        now = time.time()
+        with self._immediate():
+            row = self._conn.execute("SELECT failures, pause, until FROM cooldowns WHERE key = ?", (key,)).fetchone()
+            failures, pause, until, started = count_block(*(row or (0, 0.0, 0.0)), now, threshold, base, max_pause)
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cooldowns (key, failures, pause, until) VALUES (?, ?, ?, ?)",
+                (key, failures, pause, until),
+            )
+        return started
+
+    def clear_blocks(self, key: str) -> None:
+        with self._lock:
+            self._conn.execute(
+                "UPDATE cooldowns SET failures = 0, pause = CASE WHEN until <= ? THEN 0 ELSE pause END"
+                " WHERE key = ? AND (failures > 0 OR pause > 0)",
+                (time.time(), key),
+            )
+
+    def cooldown_until(self, key: str) -> float:
+        with self._lock:
+            row = self._conn.execute("SELECT until FROM cooldowns WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else 0.0
+
+    def cooldowns(self) -> dict[str, float]:
+        with self._lock:
+            return dict(self._conn.execute("SELECT key, until FROM cooldowns").fetchall())
+
+    def put_value(self, key: str, value: str, ttl: float) -> None:
+        now = time.time()
+        with self._lock:
+            self._gc(now)
+            self._conn.execute(
+                "INSERT OR REPLACE INTO kv (key, value, expires) VALUES (?, ?, ?)", (key, value, now + ttl)
+            )
+
+    def take_value(self, key: str, expected: Optional[str] = None) -> Optional[str]:
+        with self._immediate():
+            row = self._conn.execute(
+                "SELECT value FROM kv WHERE key = ? AND expires > ? AND (? IS NULL OR value = ?)",
+                (key, time.time(), expected, expected),
+            ).fetchone()
+            if row:
+                self._conn.execute("DELETE FROM kv WHERE key = ?", (key,))
+        return row[0] if row else None
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class RedisJobQueue(JobQueue):
+    """
+    Очередь в Redis (или совместимом сервере): воркеры могут жить на других машинах.
+    Нужен пакет redis (pip install redis); LPOS требует Redis 6.0.6+.
+    """
+
+    RESULT_TTL = 3600
+
+    # У каждого пользователя своя очередь <prefix>:queue:<user>, а список <prefix>:users — круг
+    # пользователей, у которых есть задачи: claim берёт задачу первого и переставляет его в конец.
+    # KEYS: круг пользователей, ключ задачи; ARGV: префикс очередей пользователей, id задачи,
+    # пользователь, payload
+    ENQUEUE_SCRIPT = """
+    redis.call('HSET', KEYS[2], 'payload', ARGV[4], 'status', 'queued', 'user', ARGV[3])
+    redis.call('RPUSH', ARGV[1] .. ARGV[3], ARGV[2])
+    if not redis.call('LPOS', KEYS[1], ARGV[3]) then
+        redis.call('RPUSH', KEYS[1], ARGV[3])
+    end
+    """
+    # Забрать задачу и пометить её running — одним шагом на сервере: иначе cancel между LPOP
+    # и HSET ставил бы 'cancelled', а claim тут же перезаписывал бы его на 'running'.
+    # KEYS: круг пользователей, множество running; ARGV: префикс ключей задач, воркер, время,
+    # префикс очередей пользователей
+    CLAIM_SCRIPT = """
+    while true do
+        local user = redis.call('LPOP', KEYS[1])
+        if not user then
+            return nil
+        end
+        local queue = ARGV[4] .. user
+        local job_id = redis.call('LPOP', queue)
+        if redis.call('LLEN', queue) > 0 then
+            redis.call('RPUSH', KEYS[1], user)
+        end
+        local key = ARGV[1] .. (job_id or '')
+        if job_id and redis.call('HGET', key, 'status') == 'queued' then
+            redis.call('HSET', key, 'status', 'running', 'worker', ARGV[2], 'heartbeat', ARGV[3])
+            redis.call('SADD', KEYS[2], job_id)
+            return {job_id, redis.call('HGET', key, 'payload')}
+        end
+        -- отменили, пока лежала в очереди
+    end
+    """
+    # Вернуть в очередь задачу с протухшей арендой, если её тем временем не отменили.
+    # KEYS: круг пользователей, множество running, ключ задачи; ARGV: id задачи, крайний срок heartbeat,
+    # префикс очередей пользователей
+    REQUEUE_SCRIPT = """
+    local status, heartbeat, user = unpack(redis.call('HMGET', KEYS[3], 'status', 'heartbeat', 'user'))
+    user = user or ''
+    if heartbeat and tonumber(heartbeat) >= tonumber(ARGV[2]) then
+        return 0
+    end
+    redis.call('SREM', KEYS[2], ARGV[1])
+    if status == 'running' then
+        redis.call('HSET', KEYS[3], 'status', 'queued')
+        redis.call('LPUSH', ARGV[3] .. user, ARGV[1])  -- в начало: задача и так ждала дольше всех
+        if not redis.call('LPOS', KEYS[1], user) then
+            redis.call('LPUSH', KEYS[1], user)
+        end
+        return 1
+    end
+    redis.call('DEL', KEYS[3])
+    return 0
+    """
+    # Пустую очередь пользователя claim уберёт из круга сам. KEYS: ключ задачи; ARGV: id задачи,
+    # префикс очередей пользователей
+    CANCEL_SCRIPT = """
+    local user = redis.call('HGET', KEYS[1], 'user')
+    if user and redis.call('LREM', ARGV[2] .. user, 0, ARGV[1]) > 0 then
+        redis.call('DEL', KEYS[1])
+        return
+    end
+    local status = redis.call('HGET', KEYS[1], 'status')
+    if status == 'running' then
+        redis.call('HSET', KEYS[1], 'status', 'cancelled')
+    elseif status then
+        redis.call('DEL', KEYS[1])
+    end
+    """
+
+    # Сдать результат: отменённую за это время задачу никто ждать не будет — её удаляем, а не
+    # перезаписываем отмену статусом 'done'. KEYS: множество running, ключ задачи;
+    # ARGV: id задачи, результат (JSON), сколько хранить результат
+    COMPLETE_SCRIPT = """
+    redis.call('SREM', KEYS[1], ARGV[1])
+    local status = redis.call('HGET', KEYS[2], 'status')
+    if not status then
+        return
+    end
+    if status == 'cancelled' then
+        redis.call('DEL', KEYS[2])
+        return
+    end
+    redis.call('HSET', KEYS[2], 'status', 'done', 'result', ARGV[2])
+    redis.call('EXPIRE', KEYS[2], ARGV[3])
+    """
+    # Сменить получателя, только если задача ещё есть: иначе HSET создал бы её заново без статуса.
+    # KEYS: ключ задачи; ARGV: получатель (JSON)
+    RETARGET_SCRIPT = """
+    if redis.call('EXISTS', KEYS[1]) == 1 then
+        redis.call('HSET', KEYS[1], 'target', ARGV[1])
+    end
+    """
+
+    # Ведро жетонов (та же математика, что ratelimit.take_token). Числа Lua Redis обрезает до целых,
+    # поэтому паузу возвращаем строкой. KEYS: ведро; ARGV: rate, burst, max_wait, время
+    TOKEN_SCRIPT = """
+    local rate, burst, max_wait, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4])
+    local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+    local tokens, updated = tonumber(state[1]) or burst, tonumber(state[2]) or now
+    tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+    local wait = math.max(0, (1 - tokens) / rate)
+    local ok = 0
+    if wait <= max_wait then
+        ok = 1
+        tokens = tokens - 1
+    end
+    redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated', now)
+    redis.call('EXPIRE', KEYS[1], math.ceil((burst - tokens) / rate) + 60)  -- полное ведро хранить незачем
+    return {ok, tostring(wait)}
+    """
+    # Учёт блокировки (ratelimit.count_block). KEYS: пауза ключа, множество ключей с паузами;
+    # ARGV: ключ, порог, base, max_pause, время
+    BLOCK_SCRIPT = """
+    local threshold, base, max_pause, now = tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4]), tonumber(ARGV[5])
+    local state = redis.call('HMGET', KEYS[1], 'failures', 'pause', 'until')
+    local failures = (tonumber(state[1]) or 0) + 1
+    local pause, till = tonumber(state[2]) or 0, tonumber(state[3]) or 0
+    local started = 0
+    if failures >= threshold and till <= now then
+        started = pause > 0 and pause or base
+        pause = math.min(max_pause, started * 2)
+        till = now + started
+        failures = 0
+    end
+    redis.call('HSET', KEYS[1], 'failures', failures, 'pause', pause, 'until', till)
+    redis.call('SADD', KEYS[2], ARGV[1])
+    return tostring(started)
+    """
+    # GET и DEL одним шагом, с ARGV[1] — только если значение равно ему. KEYS: значение; ARGV: ожидаемое или ''
+    TAKE_VALUE_SCRIPT = """
+    local value = redis.call('GET', KEYS[1])
+    if not value or (ARGV[1] ~= '' and value ~= ARGV[1]) then
+        return nil
+    end
+    redis.call('DEL', KEYS[1])
+    return value
+    """
+    # KEYS: пауза ключа; ARGV: время
+    CLEAR_BLOCKS_SCRIPT = """
+    local till = redis.call('HGET', KEYS[1], 'until')
+    if not till then
+        return
+    end
+    redis.call('HSET', KEYS[1], 'failures', 0)
+    if tonumber(till) <= tonumber(ARGV[1]) then
+        redis.call('HSET', KEYS[1], 'pause', 0)
+    end
+    """
+
+    def __init__(self, url: str, prefix: str = "tgdl"):
+        try:
+            import redis
+        except ImportError as e:
+            raise RuntimeError("Для JOB_QUEUE=redis://... нужен пакет redis: pip install redis") from e
+        self._redis = redis.Redis.from_url(url, decode_responses=True)
+        self._users = f"{prefix}:users"
+        self._queue = f"{prefix}:queue:"  # + пользователь
+        self._running = f"{prefix}:running"
+        self._prefix = prefix
+        self._enqueue = self._redis.register_script(self.ENQUEUE_SCRIPT)
+        self._claim = self._redis.register_script(self.CLAIM_SCRIPT)
+        self._cancel = self._redis.register_script(self.CANCEL_SCRIPT)
+        self._requeue = self._redis.register_script(self.REQUEUE_SCRIPT)
+        self._retarget = self._redis.register_script(self.RETARGET_SCRIPT)
+        self._complete = self._redis.register_script(self.COMPLETE_SCRIPT)
+        self._take_token = self._redis.register_script(self.TOKEN_SCRIPT)
+        self._count_block = self._redis.register_script(self.BLOCK_SCRIPT)
+        self._clear_blocks = self._redis.register_script(self.CLEAR_BLOCKS_SCRIPT)
+        self._take_value = self._redis.register_script(self.TAKE_VALUE_SCRIPT)
+        self._cooldowns = f"{prefix}:cooldowns"
+
+    def _key(self, job_id: str) -> str:
+        return f"{self._prefix}:job:{job_id}"
+
+    def enqueue(self, payload: dict) -> str:
+        job_id = uuid.uuid4().hex
+        self._enqueue(
+            keys=[self._users, self._key(job_id)],
+            args=[self._queue, job_id, _user_key(payload) or "", json.dumps(payload)],
+        )
+        return job_id
+
+    def claim(self, worker_id: str) -> Optional[tuple[str, dict]]:
+        claimed = self._claim(
+            keys=[self._users, self._running], args=[self._key(""), worker_id, time.time(), self._queue],
+        )
+        if not claimed:
+            return None
+        job_id, payload = claimed
+        return job_id, json.loads(payload)
+
+    def heartbeat(self, job_id: str) -> None:
+        self._redis.hset(self._key(job_id), "heartbeat", time.time())
+
+    def complete(self, job_id: str, result: dict) -> None:
+        self._complete(keys=[self._running, self._key(job_id)], args=[job_id, json.dumps(result), self.RESULT_TTL])
+
+    def take_result(self, job_id: str) -> Optional[dict]:
+        key = self._key(job_id)
+        status, result = self._redis.hmget(key, "status", "result")
+        if status != "done":
+            return None
+        self._redis.delete(key)
+        return json.loads(result)
+
+    def position(self, job_id: str) -> int:
+        user = self._redis.hget(self._key(job_id), "user")
+        index = self._redis.lpos(self._queue + user, job_id) if user is not None else None
+        if index is None:
+            return 0
+        users = self._redis.lrange(self._users, 0, -1)
+        pipe = self._redis.pipeline()
+        for other in users:
+            pipe.llen(self._queue + other)
+        # «дольше не подходила» — место в круге: кто ближе к началу, того очередь раньше
+        others = [
+            (count, turn) for turn, (other, count) in enumerate(zip(users, pipe.execute())) if other != user
+        ]
+        mine = users.index(user) if user in users else len(users)
+        return _fair_position(index + 1, mine, others)
+
+    def cancel(self, job_id: str) -> None:
+        self._cancel(keys=[self._key(job_id)], args=[job_id, self._queue])
+
+    def is_cancelled(self, job_id: str) -> bool:
+        return self._redis.hget(self._key(job_id), "status") in (None, "cancelled")
+
+    def retarget(self, job_id: str, target: dict) -> None:
+        self._retarget(keys=[self._key(job_id)], args=[json.dumps(target)])
+
+    def target(self, job_id: str) -> Optional[dict]:
+        target, payload = self._redis.hmget(self._key(job_id), "target", "payload")
+        if target:
+            return json.loads(target)
+        return json.loads(payload)["target"] if payload else None
+
+    def requeue_stale(self, lease: float) -> int:
+        deadline = time.time() - lease
+        return sum(
+            self._requeue(keys=[self._users, self._running, self._key(job_id)], args=[job_id, deadline, self._queue])
+            for job_id in self._redis.smembers(self._running)
+        )
+
+    def depth(self) -> int:
+        pipe = self._redis.pipeline()
+        for user in self._redis.lrange(self._users, 0, -1):
+            pipe.llen(self._queue + user)
+        return sum(pipe.execute())
+
+    def reserve_token(self, key: str, rate: float, burst: float, max_wait: float) -> tuple[bool, float]:
+        ok, wait = self._take_token(keys=[f"{self._prefix}:bucket:{key}"], args=[rate, burst, max_wait, time.time()])
+        return bool(ok), float(wait)
+
+    def count_block(self, key: str, threshold: int, base: float, max_pause: float) -> float:
+        return float(self._count_block(
+            keys=[f"{self._prefix}:cooldown:{key}", self._cooldowns],
+            args=[key, threshold, base, max_pause, time.time()],
+        ))
+
+    def clear_blocks(self, key: str) -> None:
+        self._clear_blocks(keys=[f"{self._prefix}:cooldown:{key}"], args=[time.time()])
+
+    def cooldown_until(self, key: str) -> float:
+        return float(self._redis.hget(f"{self._prefix}:cooldown:{key}", "until") or 0.0)
+
+    def cooldowns(self) -> dict[str, float]:
+        keys = sorted(self._redis.smembers(self._cooldowns))
+        pipe = self._redis.pipeline()
+        for key in keys:
+            pipe.hget(f"{self._prefix}:cooldown:{key}", "until")
+        return {key: float(until or 0.0) for key, until in zip(keys, pipe.execute())}
+
+    def put_value(self, key: str, value: str, ttl: float) -> None:
+        self._redis.set(f"{self._prefix}:kv:{key}", value, px=max(1, int(ttl * 1000)))
+
+    def take_value(self, key: str, expected: Optional[str] = None) -> Optional[str]:
+        return self._take_value(keys=[f"{self._prefix}:kv:{key}"], args=[expected or ""])
+
+    def close(self) -> None:
+        self._redis.close()
+
+
+def _user_key(payload: dict) -> Optional[str]:
+    user_id = payload.get("user_id")
+    return str(user_id) if user_id is not None else None
+
+
+def _fair_position(turn: int, order, others: list[tuple[int, Any]]) -> int:
+    """
+    Место задачи при очереди пользователей по кругу: она turn-я у своего пользователя, order — его
+    место в круге; others — (задач в очереди, место в круге) остальных пользователей. Кто в круге
+    раньше, успеет взять turn задач до нашей, остальные — turn - 1.
+    """
+    return turn + sum(min(count, turn if other < order else turn - 1) for count, other in others)
+
+
+def open_job_queue(url: str) -> Optional[JobQueue]:
+    """JOB_QUEUE: пусто — всё в этом процессе; sqlite:///path/jobs.sqlite3 или redis://host:6379/0."""
+    if not url:
+        return None
+    if url.startswith("sqlite:///"):
+        # как в SQLAlchemy: sqlite:///cache/jobs.sqlite3 — относительный путь, sqlite:////var/... — абсолютный
+        return SQLiteJobQueue(url[len("sqlite:///"):])
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisJobQueue(url)
+    raise ValueError(f"Неизвестная очередь задач JOB_QUEUE={url!r}")
@@ -0,0 +1,47 @@
+import json
+import logging
+import contextvars
+from typing import Optional
+
+# id задачи, к которой относится текущий код: задаётся в начале задачи и наследуется
+# её подзадачами и потоками пулов стадий (контекст копируется при запуске)
+current_job_id: contextvars.ContextVar[str] = contextvars.ContextVar("job_id", default="")
+
+
+class JobIdFilter(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.job_id = current_job_id.get()
+        record.job_tag = f"[{record.job_id}] " if record.job_id else ""
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись — одна JSON-строка: ts, level, msg, job_id, logger (+ exc при исключении)."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": self.formatTime(record, "%Y-%m-%dT%H:%M:%S") + f".{int(record.msecs):03d}",
+            "level": record.levelname,
+            "msg": record.getMessage(),
+            "logger": record.name,
+        }
+        if getattr(record, "job_id", ""):
+            entry["job_id"] = record.job_id
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+def setup_logging(fmt: str = "text", level: int = logging.INFO) -> None:
+    """LOG_FORMAT=json — структурные логи для сборщика; text — как раньше, плюс [job_id]."""
+    handler = logging.StreamHandler()
+    handler.addFilter(JobIdFilter())
+    if fmt == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(job_tag)s%(message)s"))
+    logging.basicConfig(level=level, handlers=[handler], force=True)
+
+
+def bind_job_id(job_id: Optional[str]) -> contextvars.Token:
+    return current_job_id.set(job_id or "")
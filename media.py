@@ -0,0 +1,282 @@
+import os
+import json
+import struct
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional, Callable, Awaitable
+
+FFMPEG_PATH = "bin/ffmpeg"
+FFPROBE_PATH = "bin/ffprobe"
+PROBE_TIMEOUT = 30
+PROBE_CACHE_SIZE = 256
+
+
+def ffmpeg_bin() -> str:
+    """Возвращает путь к ffmpeg: локальный бинарь или системный."""
+    return FFMPEG_PATH if os.path.exists(FFMPEG_PATH) else "ffmpeg"
+
+
+def ffprobe_bin() -> str:
+    """Возвращает путь к ffprobe: локальный бинарь или системный."""
+    return FFPROBE_PATH if os.path.exists(FFPROBE_PATH) else "ffprobe"
+
+
+@dataclass(frozen=True)
+class MediaInfo:
+    """Что нужно конвейеру о файле — из одного вызова ffprobe."""
+    format_name: str            # "mov,mp4,m4a,3gp,3g2,mj2", "matroska,webm", ...
+    vcodec: str                 # "" если видеодорожки нет
+    acodec: str                 # "" если аудиодорожки нет
+    width: int
+    height: int
+    duration: float             # секунды, 0.0 если неизвестно
+    bit_rate: int               # бит/с всего контейнера, 0 если неизвестно
+    size: int                   # байт
+    moov_before_mdat: Optional[bool]  # faststart; None — не MP4/MOV или атомы не найдены
+    fps: float = 0.0            # кадров/с видеодорожки, 0.0 если неизвестно
+
+    @property
+    def is_mp4(self) -> bool:
+        return "mp4" in self.format_name.split(",")
+
+    @property
+    def is_h264_aac(self) -> bool:
+        return self.vcodec == "h264" and self.acodec == "aac"
+
+
+def needs_repack(path: str, info: Optional[MediaInfo]) -> bool:
+    """
+    Нужен ли ремукс `-c copy -movflags +faststart`. Не нужен, если файл уже .mp4
+    с H.264/AAC и moov стоит перед mdat — ffmpeg переписал бы те же байты.
+    """
+    if info is None:
+        return True
+    return not (
+        path.lower().endswith(".mp4")
+        and info.is_mp4
+        and info.is_h264_aac
+        and info.moov_before_mdat is True
+    )
+
+
+_probe_cache: "OrderedDict[tuple, MediaInfo]" = OrderedDict()
+_probe_lock = threading.Lock()
+
+
+def _cache_key(path: str) -> Optional[tuple]:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return os.path.abspath(path), st.st_mtime_ns, st.st_size
+
+
+def _cache_get(key: Optional[tuple]) -> Optional[MediaInfo]:
+    if key is None:
+        return None
+    with _probe_lock:
+        info = _probe_cache.get(key)
+        if info is not None:
+            _probe_cache.move_to_end(key)
+        return info
+
+
+def _cache_put(key: Optional[tuple], info: MediaInfo) -> None:
+    if key is None:
+        return
+    with _probe_lock:
+        _probe_cache[key] = info
+        while len(_probe_cache) > PROBE_CACHE_SIZE:
+            _probe_cache.popitem(last=False)
+
+
+def _probe_cmd(path: str) -> list[str]:
+    return [ffprobe_bin(), "-v", "error", "-show_streams", "-show_format", "-of", "json", path]
+
+
+def mp4_top_level_atoms(path: str, limit: int = 64) -> list[str]:
+    """Типы атомов верхнего уровня MP4/MOV по порядку (читаются только заголовки)."""
+    atoms: list[str] = []
+    try:
+        with open(path, "rb") as f:
+            end = os.fstat(f.fileno()).st_size
+            pos = 0
+            while pos + 8 <= end and len(atoms) < limit:
+                f.seek(pos)
+                size, kind = struct.unpack(">I4s", f.read(8))
+                if size == 1:
+                    (size,) = struct.unpack(">Q", f.read(8))
+                elif size == 0:
+                    size = end - pos
+                if size < 8:
+                    break
+                atoms.append(kind.decode("latin-1"))
+                pos += size
+    except (OSError, struct.error):
+        pass
+    return atoms
+
+
+def _moov_before_mdat(path: str, format_name: str) -> Optional[bool]:
+    if "mov" not in format_name.split(",") and "mp4" not in format_name.split(","):
+        return None
+    atoms = mp4_top_level_atoms(path)
+    if "moov" not in atoms or "mdat" not in atoms:
+        return None
+    return atoms.index("moov") < atoms.index("mdat")
+
+
+def _frame_rate(value: str) -> float:
+    """Частота кадров из вида "30000/1001" (29.97); "0/0" и мусор дают 0.0."""
+    num, _, den = (value or "").partition("/")
+    try:
+        return float(num) / float(den or 1)
+    except (ValueError, ZeroDivisionError):
+        return 0.0
+
+
+def _parse(path: str, raw: bytes) -> MediaInfo:
+    data = json.loads(raw or b"{}")
+    fmt = data.get("format") or {}
+    video = next((s for s in data.get("streams", []) if s.get("codec_type") == "video"), {})
+    audio = next((s for s in data.get("streams", []) if s.get("codec_type") == "audio"), {})
+    format_name = fmt.get("format_name", "")
+    return MediaInfo(
+        format_name=format_name,
+        vcodec=video.get("codec_name", ""),
+        acodec=audio.get("codec_name", ""),
+        width=int(video.get("width") or 0),
+        height=int(video.get("height") or 0),
+        duration=float(fmt.get("duration") or video.get("duration") or 0.0),
+        bit_rate=int(fmt.get("bit_rate") or 0),
+        size=int(fmt.get("size") or 0) or os.path.getsize(path),
+        moov_before_mdat=_moov_before_mdat(path, format_name),
+        fps=_frame_rate(video.get("avg_frame_rate")) or _frame_rate(video.get("r_frame_rate")),
+    )
+
+
+async def probe_media_async(path: str) -> Optional[MediaInfo]:
+    """
+    Один ffprobe на файл (-show_streams -show_format -of json) через asyncio-подпроцесс — не занимает поток.
+    Результат кэшируется по пути+mtime.
+    """
+    key = _cache_key(path)
+    info = _cache_get(key)
+    if info is not None:
+        return info
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            *_probe_cmd(path), stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL,
+        )
+        try:
+            raw, _ = await asyncio.wait_for(proc.communicate(), timeout=PROBE_TIMEOUT)
+        except BaseException:
+            # таймаут или отмена задачи — не оставляем ffprobe висеть
+            if proc.returncode is None:
+                proc.kill()
+            raise
+        if proc.returncode != 0:
+            raise RuntimeError(f"ffprobe завершился с кодом {proc.returncode}")
+        info = _parse(path, raw)
+    except Exception as e:
+        logging.error(f"Ошибка ffprobe для {path}: {e!r}")
+        return None
+    _cache_put(key, info)
+    return info
+
+
+# --- Асинхронный запуск ffmpeg ---
+FFMPEG_NICE = int(os.getenv("FFMPEG_NICE", "10"))        # приоритет ffmpeg ниже, чем у бота
+FFMPEG_THREADS = int(os.getenv("FFMPEG_THREADS", "2"))   # потоков на одно задание, 0 — на усмотрение ffmpeg
+FFMPEG_KILL_GRACE = 5.0
+
+
+class FFmpegError(Exception):
+    """ffmpeg завершился с ошибкой; в сообщении — хвост stderr."""
+
+
+def lower_priority(pid: int) -> None:
+    """
+    Понижает приоритет уже запущенного процесса. Не через preexec_fn: он выполняется между fork
+    и exec, что небезопасно в многопоточном процессе (потоки yt-dlp, to_thread) и медленнее spawn.
+    """
+    if not hasattr(os, "setpriority"):
+        return  # Windows
+    try:
+        os.setpriority(os.PRIO_PROCESS, pid, FFMPEG_NICE)
+    except OSError:
+        pass  # процесс уже завершился или не хватает прав
+
+
+async def _read_progress(stream: asyncio.StreamReader, duration: float,
+                         on_progress: Optional[Callable[[Optional[float], str], Awaitable[None]]]) -> None:
+    """Разбирает блоки `-progress pipe:1` (key=value ... progress=continue|end)."""
+    block: dict[str, str] = {}
+    async for raw in stream:
+        key, _, value = raw.decode(errors="replace").strip().partition("=")
+        if key != "progress":
+            block[key] = value
+            continue
+        if on_progress:
+            percent = None
+            out_us = block.get("out_time_us") or block.get("out_time_ms")  # оба в микросекундах
+            if duration > 0 and out_us and out_us.isdigit():
+                percent = min(100.0, int(out_us) / (duration * 1e6) * 100.0)
+            try:
+                await on_progress(percent, block.get("speed", "").strip())
+            except Exception as e:
+                logging.debug(f"Ошибка в on_progress: {e}")
+        block = {}
+
+
+async def run_ffmpeg(
+    args: list[str],
+    timeout: float,
+    duration: float = 0.0,
+    on_progress: Optional[Callable[[Optional[float], str], Awaitable[None]]] = None,
+    threads: Optional[int] = None,
+) -> None:
+    """
+    Запускает ffmpeg через asyncio-подпроцесс. args — всё после глобальных флагов,
+    последним элементом идёт путь выхода (перед ним добавляется -threads; по умолчанию FFMPEG_THREADS).
+    При таймауте или отмене задачи процесс убивается, а недописанный выход удаляется.
+    """
+    output_path = args[-1]
+    threads = FFMPEG_THREADS if threads is None else threads
+    thread_args = ["-threads", str(threads)] if threads > 0 else []
+    cmd = [
+        ffmpeg_bin(), "-nostdin", "-hide_banner", "-loglevel", "error", "-nostats",
+        "-progress", "pipe:1", *args[:-1], *thread_args, output_path,
+    ]
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    lower_priority(proc.pid)
+    stderr_task = asyncio.create_task(proc.stderr.read())
+    try:
+        await asyncio.wait_for(
+            asyncio.gather(_read_progress(proc.stdout, duration, on_progress), proc.wait()),
+            timeout=timeout,
+        )
+    except BaseException:
+        if proc.returncode is None:
+            proc.kill()
+            try:
+                await asyncio.wait_for(asyncio.shield(proc.wait()), timeout=FFMPEG_KILL_GRACE)
+            except BaseException:
+                pass
+        stderr_task.cancel()
+        if output_path != "-" and os.path.exists(output_path):
+            try:
+                os.remove(output_path)
+            except OSError:
+                pass
+        raise
+    stderr = (await stderr_task).decode(errors="replace").strip()
+    if proc.returncode != 0:
+        raise FFmpegError(f"ffmpeg завершился с кодом {proc.returncode}: {stderr[-500:]}")
@@ -0,0 +1,162 @@
+import time
+import threading
+from contextlib import contextmanager
+from typing import Callable, Iterable, Optional
+
+from aiohttp import web
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _num(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, doc: str, labels: Iterable[str] = ()):
+        self.name = name
+        self.doc = doc
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels.get(n, "") for n in self.label_names)
+
+    def header(self) -> list[str]:
+        return [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    """Монотонный счётчик; потокобезопасен (инкременты идут и из потоков yt-dlp)."""
+    kind = "counter"
+
+    def __init__(self, name: str, doc: str, labels: Iterable[str] = ()):
+        super().__init__(name, doc, labels)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def collect(self) -> list[str]:
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_labels(self.label_names, k)} {_num(v)}" for k, v in items]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, doc: str, labels: Iterable[str] = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, doc, labels)
+        self.buckets = tuple(buckets) + (float("inf"),)
+        self._values: dict[tuple, list] = {}  # ключ -> [счётчики по корзинам..., сумма, количество]
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.setdefault(key, [0] * len(self.buckets) + [0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[i] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Замер длительности блока (годится и вокруг await)."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def collect(self) -> list[str]:
+        with self._lock:
+            items = [(k, list(v)) for k, v in self._values.items()]
+        lines = []
+        for key, state in items:
+            for bound, count in zip(self.buckets, state):
+                le = f'le="{_num(bound)}"'
+                lines.append(f"{self.name}_bucket{_labels(self.label_names, key, le)} {count}")
+            lines.append(f"{self.name}_sum{_labels(self.label_names, key)} {_num(state[-2])}")
+            lines.append(f"{self.name}_count{_labels(self.label_names, key)} {state[-1]}")
+        return lines
+
+
+class Callback(_Metric):
+    """Значения снимаются при каждом запросе /metrics: fn() -> {значения меток: число} или число."""
+
+    def __init__(self, name: str, doc: str, fn: Callable, labels: Iterable[str] = (), kind: str = "gauge"):
+        super().__init__(name, doc, labels)
+        self.kind = kind
+        self.fn = fn
+
+    def collect(self) -> list[str]:
+        values = self.fn()
+        if not isinstance(values, dict):
+            values = {(): values}
+        lines = []
+        for key, value in values.items():
+            key = key if isinstance(key, tuple) else (key,)
+            lines.append(f"{self.name}{_labels(self.label_names, key)} {_num(value)}")
+        return lines
+
+
+REGISTRY: list[_Metric] = []
+
+
+def render() -> str:
+    lines: list[str] = []
+    for metric in REGISTRY:
+        try:
+            samples = metric.collect()
+        except Exception as e:
+            lines.append(f"# {metric.name}: ошибка сбора: {_escape(e)}")
+            continue
+        lines += metric.header() + samples
+    return "\n".join(lines) + "\n"
+
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(text=render(), content_type="text/plain", charset="utf-8",
+                        headers={"X-Content-Type-Options": "nosniff"})
+
+
+async def start_http_server(host: str, port: int) -> Optional[web.AppRunner]:
+    """Отдельный aiohttp-сервер с /metrics (в webhook-режиме маршрут вешается на общий app)."""
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+# --- Метрики конвейера ---
+STAGE_SECONDS = Histogram(
+    "tgdl_stage_seconds", "Длительность стадий конвейера", ("stage", "platform"),
+)
+JOBS = Counter("tgdl_jobs_total", "Задачи по итогу: ok, download, too_big, upload, cancelled, busy, error",
+               ("platform", "result"))
+DOWNLOAD_FAILURES = Counter("tgdl_download_failures_total", "Неудачные скачивания по причине",
+                            ("platform", "reason"))
+DOWNLOADED_BYTES = Counter("tgdl_downloaded_bytes_total", "Скачано байт (файлы на диске)", ("platform",))
+UPLOADED_BYTES = Counter("tgdl_uploaded_bytes_total", "Загружено в Телеграм байт", ("platform",))
@@ -0,0 +1,158 @@
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Optional
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.types import InlineKeyboardMarkup
+
+CLOSED_KEYS_LIMIT = 10000
+
+
+class ProgressUpdater:
+    """
+    Единая точка правки сообщений-статусов («Скачиваю… 42%»).
+    На каждое сообщение хранится только последнее состояние: промежуточные выбрасываются,
+    правка с тем же текстом не отправляется. Фоновый цикл тратит общий бюджет API
+    (global_rate правок/с, <= 0 — без общего лимита) и держит паузу между правками в одном чате;
+    на 429 ждёт retry_after.
+    """
+
+    def __init__(self, bot: Bot, global_rate: float, chat_interval: float, group_interval: float):
+        self.bot = bot
+        self.global_rate = global_rate
+        self.chat_interval = chat_interval
+        self.group_interval = group_interval
+        self.sent = 0
+        self.skipped = 0
+        self.rate_limited = 0
+        self._pending: "OrderedDict[tuple[int, int], tuple[str, Optional[InlineKeyboardMarkup]]]" = OrderedDict()
+        self._last_text: dict[tuple[int, int], str] = {}
+        self._inflight: dict[tuple[int, int], asyncio.Task] = {}
+        self._closed: "OrderedDict[tuple[int, int], None]" = OrderedDict()
+        self._chat_ready_at: dict[int, float] = {}
+        self._global_ready_at = 0.0
+        self._paused_until = 0.0
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def update(self, chat_id: int, message_id: int, text: str,
+               reply_markup: Optional[InlineKeyboardMarkup] = None) -> None:
+        """Запоминает новое состояние сообщения. Не блокирует; вызывать из потока event loop."""
+        key = (chat_id, message_id)
+        if key in self._closed:
+            return
+        if key in self._pending:
+            self.skipped += 1  # предыдущее состояние так и не ушло — оно уже неактуально
+        self._pending[key] = (text, reply_markup)
+        self._ensure_running()
+        self._wakeup.set()
+
+    async def finish(self, chat_id: int, message_id: int) -> None:
+        """
+        Сообщение больше не обновляется (финальный текст или удаление делает вызывающий).
+        Ждёт правку, которая уже летит, чтобы она не перезаписала финальный текст.
+        """
+        key = (chat_id, message_id)
+        self._pending.pop(key, None)
+        self._last_text.pop(key, None)
+        self._closed[key] = None
+        while len(self._closed) > CLOSED_KEYS_LIMIT:
+            self._closed.popitem(last=False)
+        self._prune_chats(time.monotonic())
+        task = self._inflight.get(key)
+        if task:
+            await asyncio.wait({task})
+
+    def _prune_chats(self, now: float) -> None:
+        """Чаты, чья пауза между правками уже прошла, помнить незачем — иначе словарь растёт с каждым чатом."""
+        for chat_id in [chat_id for chat_id, ready_at in self._chat_ready_at.items() if ready_at <= now]:
+            del self._chat_ready_at[chat_id]
+
+    def _ensure_running(self) -> None:
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def _interval(self, chat_id: int) -> float:
+        return self.group_interval if chat_id < 0 else self.chat_interval
+
+    def _next_ready(self, now: float) -> tuple[Optional[tuple[int, int]], float]:
+        """Первое сообщение, чей чат уже можно править, либо время, когда появится такое."""
+        earliest = float("inf")
+        for key in self._pending:
+            if key in self._inflight:
+                continue
+            ready_at = self._chat_ready_at.get(key[0], 0.0)
+            if ready_at <= now:
+                return key, now
+            earliest = min(earliest, ready_at)
+        return None, earliest
+
+    async def _run(self) -> None:
+        while True:
+            now = time.monotonic()
+            key, ready_at = self._next_ready(now)
+            wait = max(ready_at, self._global_ready_at, self._paused_until) - now
+            if key is None or wait > 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=None if wait == float("inf") else wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            text, markup = self._pending.pop(key)
+            if self._last_text.get(key) == text:
+                self.skipped += 1
+                continue
+            if self.global_rate > 0:
+                self._global_ready_at = now + 1.0 / self.global_rate
+            self._chat_ready_at[key[0]] = now + self._interval(key[0])
+            self._inflight[key] = asyncio.create_task(self._send(key, text, markup))
+
+    async def _send(self, key: tuple[int, int], text: str, markup: Optional[InlineKeyboardMarkup]) -> None:
+        chat_id, message_id = key
+        try:
+            await self.bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=text, reply_markup=markup)
+            self.sent += 1
+            if key not in self._closed:
+                self._last_text[key] = text
+        except TelegramRetryAfter as e:
+            # флуд-контроль: пауза для всех правок; состояние вернём, если его ещё не сменили новым
+            self.rate_limited += 1
+            self._paused_until = time.monotonic() + e.retry_after
+            logging.warning(f"Флуд-лимит Телеграма на правки статусов, пауза {e.retry_after} с.")
+            if key not in self._closed:
+                self._pending.setdefault(key, (text, markup))
+        except TelegramBadRequest as e:
+            if "message is not modified" in str(e):
+                self._last_text[key] = text
+            else:
+                logging.debug(f"Не удалось обновить статус {key}: {e}")
+        except Exception as e:
+            logging.debug(f"Не удалось обновить статус {key}: {e}")
+        finally:
+            self._inflight.pop(key, None)
+            if self._wakeup:
+                self._wakeup.set()
+
+    def stats(self) -> dict:
+        return {
+            "sent": self.sent,
+            "skipped": self.skipped,
+            "rate_limited": self.rate_limited,
+            "pending": len(self._pending),
+        }
+
+    async def close(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        for task in list(self._inflight.values()):
+            task.cancel()
@@ -0,0 +1,199 @@
+import time
+import logging
+import threading
+from collections import OrderedDict
+from typing import Hashable
+
+from scheduler import QueueFull
+
+
+class RateLimited(QueueFull):
+    """Пользователь шлёт задачи чаще, чем разрешено; retry_after — через сколько секунд можно снова."""
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"повторите через {retry_after:.0f} с")
+        self.retry_after = retry_after
+
+
+def take_token(
+    tokens: float, updated: float, now: float, rate: float, burst: float, max_wait: float,
+) -> tuple[bool, float, float]:
+    """
+    Одно списание из ведра с балансом tokens на момент updated: (списан ли жетон, пауза, новый баланс).
+    Та же математика у общих вёдер в очереди задач (JobQueue.reserve_token) — все процессы считают одинаково.
+    """
+    tokens = min(burst, tokens + max(0.0, now - updated) * rate)
+    wait = max(0.0, (1 - tokens) / rate)
+    if wait > max_wait:
+        return False, wait, tokens
+    return True, wait, tokens - 1
+
+
+def count_block(
+    failures: int, pause: float, until: float, now: float, threshold: int, base: float, max_pause: float,
+) -> tuple[int, float, float, float]:
+    """
+    Учёт одной блокировки платформы: новые (подряд ошибок, длина следующей паузы, конец паузы)
+    и длина начатой сейчас паузы (0 — пауза не началась). pause=0 — пауз ещё не было, первая — base.
+    """
+    failures += 1
+    if failures < threshold or until > now:
+        return failures, pause, until, 0.0
+    started = pause or base
+    return 0, min(max_pause, started * 2), now + started, started
+
+
+class TokenBucket:
+    """
+    Ведро жетонов: rate жетонов в секунду, не больше burst про запас; rate <= 0 — лимита нет.
+    reserve() может уводить баланс в минус — это очередь: каждый следующий ждёт дольше предыдущего.
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def reserve(self, max_wait: float = 0.0) -> tuple[bool, float]:
+        """
+        (True, пауза) — жетон списан, начинать через «паузу» секунд (0 — сразу);
+        (False, пауза) — ждать пришлось бы дольше max_wait, жетон не списан.
+        """
+        if self.rate <= 0:
+            return True, 0.0
+        now = time.monotonic()
+        ok, wait, self.tokens = take_token(self.tokens, self.updated, now, self.rate, self.burst, max_wait)
+        self.updated = now
+        return ok, wait
+
+
+class KeyedLimiter:
+    """
+    Свои вёдра на каждый ключ (пользователь, платформа); неактивные ключи вытесняются (LRU).
+    rate <= 0 (общий или у ключа в overrides) — для этого ключа лимита нет.
+    С store (очередь задач JOB_QUEUE) вёдра лежат в ней под ключом '<scope>:<ключ>' и общие
+    для бота и всех воркеров; без store — в памяти процесса.
+    """
+
+    def __init__(self, rate: float, burst: float, overrides: dict = None, max_keys: int = 100_000,
+                 store=None, scope: str = ""):
+        self.rate = rate
+        self.burst = burst
+        self.overrides = overrides or {}  # ключ -> (rate, burst)
+        self.max_keys = max_keys
+        self.store = store
+        self.scope = scope
+        self.limited = 0
+        self._buckets: "OrderedDict[Hashable, TokenBucket]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _bucket(self, key: Hashable) -> TokenBucket:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(*self.overrides.get(key, (self.rate, self.burst)))
+        self._buckets.move_to_end(key)
+        while len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+        return bucket
+
+    def reserve(self, key: Hashable, max_wait: float = 0.0) -> tuple[bool, float]:
+        rate, burst = self.overrides.get(key, (self.rate, self.burst))
+        if rate <= 0:
+            return True, 0.0  # лимит выключен
+        if self.store is not None:
+            ok, wait = self.store.reserve_token(f"{self.scope}:{key}", rate, burst, max_wait)
+        else:
+            with self._lock:
+                ok, wait = self._bucket(key).reserve(max_wait)
+        if not ok:
+            self.limited += 1
+        return ok, wait
+
+    def check(self, key: Hashable) -> None:
+        """Жетон сразу или RateLimited."""
+        ok, wait = self.reserve(key)
+        if not ok:
+            raise RateLimited(wait)
+
+
+class PlatformCooldown:
+    """
+    Пауза для платформы, которая начала нас блокировать (стена логина Instagram, HTTP 429):
+    после threshold таких ошибок подряд новые задачи на платформу не запускаются base секунд;
+    если сразу после паузы блокировка повторяется — пауза удваивается, но не дольше max_pause.
+    Любая удачная экстракция сбрасывает счётчик и длину паузы.
+    С store (очередь задач JOB_QUEUE) состояние общее для бота и всех воркеров: блокировку,
+    пойманную одним воркером, видят все.
+    """
+
+    def __init__(self, threshold: int, base: float, max_pause: float, store=None):
+        self.threshold = threshold
+        self.base = base
+        self.max_pause = max_pause
+        self.store = store
+        self.trips = 0
+        self._failures: dict[str, int] = {}
+        self._pause: dict[str, float] = {}   # платформа -> длина следующей паузы
+        self._until: dict[str, float] = {}   # платформа -> monotonic конца текущей паузы
+        self._lock = threading.Lock()
+
+    def remaining(self, platform: str) -> float:
+        if self.store is not None:
+            return max(0.0, self.store.cooldown_until(platform) - time.time())
+        with self._lock:
+            return max(0.0, self._until.get(platform, 0.0) - time.monotonic())
+
+    def blocked(self, platform: str) -> None:
+        if self.threshold <= 0:
+            return
+        if self.store is not None:
+            pause = self.store.count_block(platform, self.threshold, self.base, self.max_pause)
+        else:
+            with self._lock:
+                failures, self._pause[platform], self._until[platform], pause = count_block(
+                    self._failures.get(platform, 0), self._pause.get(platform, 0.0),
+                    self._until.get(platform, 0.0), time.monotonic(), self.threshold, self.base, self.max_pause,
+                )
+                self._failures[platform] = failures
+        if pause:
+            self.trips += 1
+            logging.warning(f"Платформа {platform} блокирует запросы, пауза {pause:.0f} с.")
+
+    def ok(self, platform: str) -> None:
+        if self.store is not None:
+            self.store.clear_blocks(platform)
+            return
+        with self._lock:
+            self._failures.pop(platform, None)
+            if self._until.get(platform, 0.0) <= time.monotonic():
+                self._pause.pop(platform, None)
+
+    def states(self) -> dict[str, float]:
+        """Платформа -> сколько секунд паузы осталось (только платформы, которые уже блокировали)."""
+        if self.store is not None:
+            now = time.time()
+            return {platform: max(0.0, until - now) for platform, until in self.store.cooldowns().items()}
+        now = time.monotonic()
+        with self._lock:
+            return {platform: max(0.0, until - now) for platform, until in self._until.items()}
+
+
+def parse_rates(spec: str) -> dict[str, tuple[float, float]]:
+    """
+    'instagram=20/5,twitter=60' -> {платформа: (жетонов в секунду, запас)}; значения — в минуту.
+    0 в минуту — лимита нет (как USER_RATE_PER_MIN=0); отрицательное значение или запас меньше 1 — ValueError.
+    """
+    rates = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        name, _, value = item.partition("=")
+        per_min, _, burst = value.partition("/")
+        try:
+            per_min = float(per_min)
+            burst = float(burst) if burst else max(1.0, per_min / 6)
+        except ValueError:
+            raise ValueError(f"Неверный лимит {item!r}: ожидается платформа=в минуту[/запас]") from None
+        if not name.strip() or per_min < 0 or burst < 1:
+            raise ValueError(f"Неверный лимит {item!r}: нужно в минуту >= 0 и запас >= 1")
+        rates[name.strip()] = (per_min / 60, burst)
+    return rates
@@ -0,0 +1,220 @@
+import asyncio
+import logging
+import contextvars
+import functools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Optional, Callable, Awaitable, Any
+
+QUEUE_POSITION_INTERVAL = 3.0  # как часто пересчитывать место в очереди, сек
+
+# Чья задача выполняется (задаётся в admit, у воркера — из задачи очереди): по нему пулы
+# стадий чередуют ожидающих разных пользователей
+current_user: contextvars.ContextVar[Any] = contextvars.ContextVar("current_user", default=None)
+
+
+class QueueFull(Exception):
+    """Бот перегружен: задачу не приняли (общий лимит или лимит пользователя)."""
+
+
+class StagePool:
+    """
+    Ограниченный пул потоков для одной стадии конвейера (скачивание, репак, перекод).
+    Освободившийся слот получают пользователи по кругу (у каждого свой FIFO), так что десяток
+    ссылок от одного не отодвигает остальных; ждущие видят своё место в очереди.
+    """
+
+    def __init__(self, name: str, workers: int):
+        self.name = name
+        self.workers = workers
+        self.active = 0
+        self._waiters: dict[Any, deque[asyncio.Future]] = {}  # пользователь -> его ожидающие
+        self._turns: deque = deque()  # пользователи с ожидающими, в порядке очереди на слот
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"stage-{name}")
+
+    @property
+    def queued(self) -> int:
+        return sum(len(waiters) for waiters in self._waiters.values())
+
+    def _position(self, user: Any, fut: asyncio.Future) -> int:
+        """Место в очереди с учётом чередования: до i-го ожидающего пользователя каждый другой успеет i или i+1."""
+        index = self._waiters[user].index(fut)
+        position = 1
+        after = False
+        for other in self._turns:
+            if other == user:
+                position += index
+                after = True
+            else:
+                position += min(len(self._waiters[other]), index if after else index + 1)
+        return position
+
+    def _remove(self, user: Any, fut: asyncio.Future) -> bool:
+        waiters = self._waiters.get(user)
+        if not waiters or fut not in waiters:
+            return False
+        waiters.remove(fut)
+        if not waiters:
+            del self._waiters[user]
+            self._turns.remove(user)
+        return True
+
+    async def _acquire(self, on_queue: Optional[Callable[[int], Awaitable[None]]]) -> None:
+        if self.active < self.workers and not self._turns:
+            self.active += 1
+            return
+        user = current_user.get()
+        fut = asyncio.get_running_loop().create_future()
+        if user not in self._waiters:
+            self._waiters[user] = deque()
+            self._turns.append(user)
+        self._waiters[user].append(fut)
+        reported = 0
+        try:
+            while not fut.done():
+                position = self._position(user, fut)
+                if on_queue and position != reported:
+                    reported = position
+                    try:
+                        await on_queue(position)
+                    except Exception as e:
+                        logging.debug(f"Ошибка в on_queue: {e}")
+                await asyncio.wait({fut}, timeout=QUEUE_POSITION_INTERVAL)
+        except BaseException:
+            if not self._remove(user, fut) and fut.done() and not fut.cancelled():
+                # слот уже передали нам, но мы уходим — отдаём его следующему
+                self._release()
+            raise
+
+    def _release(self) -> None:
+        while self._turns:
+            user = self._turns.popleft()
+            waiters = self._waiters[user]
+            fut = waiters.popleft()
+            if waiters:
+                self._turns.append(user)  # следующий его ожидающий — после всех остальных пользователей
+            else:
+                del self._waiters[user]
+            if not fut.done():
+                fut.set_result(None)  # слот переходит ждущему, active не меняется
+                return
+        self.active -= 1
+
+    async def run(self, func: Callable, *args, on_queue: Optional[Callable[[int], Awaitable[None]]] = None,
+                  on_cancel: Optional[Callable[[], None]] = None) -> Any:
+        """
+        Поток снаружи не прервать, поэтому при отмене вызывается on_cancel (попросить func выйти —
+        yt-dlp, например, через флаг в хуке прогресса), и run ждёт, пока поток действительно
+        закончит. Слот освобождается тоже только тогда: иначе пул пустил бы задач больше лимита,
+        а Workspace удалил бы каталог из-под работающей загрузки.
+        """
+        await self._acquire(on_queue)
+        loop = asyncio.get_running_loop()
+        try:
+            # контекст (id задачи для логов) переезжает в поток пула, как в asyncio.to_thread
+            call = functools.partial(contextvars.copy_context().run, func, *args)
+            done = self._executor.submit(call)
+        except BaseException:
+            self._release()
+            raise
+
+        def release(_f) -> None:
+            if not loop.is_closed():  # после shutdown пула цикл уже мог закрыться
+                loop.call_soon_threadsafe(self._release)
+
+        done.add_done_callback(release)
+        fut = asyncio.wrap_future(done, loop=loop)
+        try:
+            return await asyncio.shield(fut)
+        except asyncio.CancelledError:
+            if on_cancel:
+                on_cancel()
+            while not fut.done():
+                try:
+                    await asyncio.wait({fut})
+                except asyncio.CancelledError:
+                    pass  # уже отменяемся — дождаться потока всё равно нужно
+            if not fut.cancelled():
+                fut.exception()  # результат брошенного потока никому не нужен
+            raise
+
+    async def run_coro(self, coro_fn: Callable[..., Awaitable], *args,
+                       on_queue: Optional[Callable[[int], Awaitable[None]]] = None, **kwargs) -> Any:
+        """Как run, но для корутины (asyncio-подпроцессы): слот занимается, поток — нет."""
+        await self._acquire(on_queue)
+        try:
+            return await coro_fn(*args, **kwargs)
+        finally:
+            self._release()
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+class JobScheduler:
+    """
+    Планировщик задач: отдельные пулы на сетевое скачивание, ffmpeg (репак/probe) и перекод
+    плюс контроль допуска — общий лимит задач и лимит на одного пользователя.
+    """
+
+    def __init__(
+        self,
+        download_workers: int,
+        ffmpeg_workers: int,
+        transcode_workers: int,
+        max_jobs: int,
+        max_jobs_per_user: int,
+    ):
+        self.stages = {
+            "download": StagePool("download", download_workers),
+            "ffmpeg": StagePool("ffmpeg", ffmpeg_workers),
+            "transcode": StagePool("transcode", transcode_workers),
+        }
+        self.max_jobs = max_jobs
+        self.max_jobs_per_user = max_jobs_per_user
+        self.rejected = 0
+        self._jobs: dict[int, int] = {}
+
+    @property
+    def active_jobs(self) -> int:
+        return sum(self._jobs.values())
+
+    @contextmanager
+    def admit(self, user_id: int):
+        """Резервирует место под задачу пользователя или бросает QueueFull."""
+        if self.active_jobs >= self.max_jobs or self._jobs.get(user_id, 0) >= self.max_jobs_per_user:
+            self.rejected += 1
+            raise QueueFull()
+        self._jobs[user_id] = self._jobs.get(user_id, 0) + 1
+        token = current_user.set(user_id)
+        try:
+            yield
+        finally:
+            current_user.reset(token)
+            self._jobs[user_id] -= 1
+            if not self._jobs[user_id]:
+                del self._jobs[user_id]
+
+    async def run(self, stage: str, func: Callable, *args,
+                  on_queue: Optional[Callable[[int], Awaitable[None]]] = None,
+                  on_cancel: Optional[Callable[[], None]] = None) -> Any:
+        """Выполняет блокирующую func в пуле стадии stage, дожидаясь свободного слота."""
+        return await self.stages[stage].run(func, *args, on_queue=on_queue, on_cancel=on_cancel)
+
+    async def run_coro(self, stage: str, coro_fn: Callable[..., Awaitable], *args,
+                       on_queue: Optional[Callable[[int], Awaitable[None]]] = None, **kwargs) -> Any:
+        """Выполняет корутину coro_fn под лимитом стадии stage."""
+        return await self.stages[stage].run_coro(coro_fn, *args, on_queue=on_queue, **kwargs)
+
+    def stats(self) -> dict:
+        return {
+            "active_jobs": self.active_jobs,
+            "rejected": self.rejected,
+            **{f"{name}_active": pool.active for name, pool in self.stages.items()},
+            **{f"{name}_queued": pool.queued for name, pool in self.stages.items()},
+        }
+
+    def shutdown(self) -> None:
+        for pool in self.stages.values():
+            pool.shutdown()
@@ -0,0 +1,97 @@
+import os
+import sys
+import asyncio
+import logging
+from typing import Optional, AsyncGenerator
+
+from aiogram.types import InputFile
+
+from media import ffmpeg_bin, lower_priority
+
+STREAM_CHUNK_SIZE = 64 * 1024
+STREAM_KILL_GRACE = 5.0
+
+
+class StreamAborted(Exception):
+    """Потоковая загрузка прервана: источник/ffmpeg упали или файл превысил лимит."""
+
+
+class RemuxStream(InputFile):
+    """
+    yt-dlp (-o -) → ffmpeg -c copy → fragmented MP4 → загрузка в Телеграм, без файлов на диске.
+    Процессы соединены pipe'ом ядра, в памяти держится не больше пары чанков.
+    Последний чанк отдаётся только после успешного выхода обоих процессов — иначе загрузка
+    обрывается и Телеграм не получает битый ролик.
+    """
+
+    def __init__(self, url: str, ytdlp_args: list[str], limit: int, filename: str = "video.mp4"):
+        super().__init__(filename=filename, chunk_size=STREAM_CHUNK_SIZE)
+        self.url = url
+        self.ytdlp_args = ytdlp_args
+        self.limit = limit
+        self.bytes_sent = 0
+        self.too_big = False
+        self._procs: list[asyncio.subprocess.Process] = []
+
+    async def _spawn(self) -> tuple[asyncio.subprocess.Process, asyncio.subprocess.Process]:
+        read_fd, write_fd = os.pipe()
+        try:
+            ytdlp = await asyncio.create_subprocess_exec(
+                sys.executable, "-m", "yt_dlp", "--quiet", "--no-warnings", "--no-playlist",
+                *self.ytdlp_args, "-o", "-", self.url,
+                stdout=write_fd, stderr=asyncio.subprocess.PIPE,
+            )
+            self._procs.append(ytdlp)
+            ffmpeg = await asyncio.create_subprocess_exec(
+                ffmpeg_bin(), "-nostdin", "-hide_banner", "-loglevel", "error",
+                "-i", "pipe:0", "-c", "copy", "-f", "mp4",
+                "-movflags", "frag_keyframe+empty_moov+default_base_moof", "pipe:1",
+                stdin=read_fd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+            )
+            self._procs.append(ffmpeg)
+            lower_priority(ffmpeg.pid)
+        finally:
+            # концы pipe теперь у дочерних процессов
+            os.close(read_fd)
+            os.close(write_fd)
+        return ytdlp, ffmpeg
+
+    async def read(self, bot) -> AsyncGenerator[bytes, None]:
+        try:
+            ytdlp, ffmpeg = await self._spawn()
+        except BaseException:
+            await self.close()
+            raise
+        errors = [asyncio.create_task(p.stderr.read()) for p in (ytdlp, ffmpeg)]
+        pending: Optional[bytes] = None
+        try:
+            while chunk := await ffmpeg.stdout.read(self.chunk_size):
+                self.bytes_sent += len(chunk)
+                if self.bytes_sent > self.limit:
+                    self.too_big = True
+                    raise StreamAborted(f"поток превысил лимит {self.limit} байт")
+                if pending is not None:
+                    yield pending
+                pending = chunk
+            rc_ytdlp, rc_ffmpeg = await ytdlp.wait(), await ffmpeg.wait()
+            if rc_ytdlp or rc_ffmpeg or pending is None:
+                stderr = b" | ".join([(await t).strip()[-300:] for t in errors])
+                raise StreamAborted(
+                    f"yt-dlp={rc_ytdlp}, ffmpeg={rc_ffmpeg}: {stderr.decode(errors='replace')}"
+                )
+            yield pending
+        finally:
+            for t in errors:
+                t.cancel()
+            await self.close()
+
+    async def close(self) -> None:
+        """Убивает ещё живые процессы (отмена, обрыв загрузки, превышение лимита)."""
+        for proc in self._procs:
+            if proc.returncode is None:
+                proc.kill()
+                try:
+                    await asyncio.wait_for(proc.wait(), timeout=STREAM_KILL_GRACE)
+                except asyncio.TimeoutError:
+                    logging.warning(f"Процесс {proc.pid} не завершился после kill.")
+        self._procs.clear()
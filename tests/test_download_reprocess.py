@@ -0,0 +1,103 @@
+"""
+Повторная обработка info из preflight_video: выбор формата должен делаться заново,
+следы прошлого выбора (requested_formats, format_id, url, ext) не переживают смену формата.
+"""
+import os
+import sys
+import copy
+import tempfile
+
+os.environ.setdefault("BOT_TOKEN", "123:abc")
+os.environ.setdefault("CACHE_DB", os.path.join(tempfile.mkdtemp(prefix="tgdl-test-"), "cache.db"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import yt_dlp  # noqa: E402
+
+import bot  # noqa: E402
+
+FORMATS = [
+    {"format_id": "small", "url": "http://media.test/small.mp4", "ext": "mp4",
+     "vcodec": "avc1", "acodec": "mp4a", "filesize": 10, "protocol": "https"},
+    {"format_id": "bigv", "url": "http://media.test/bigv.webm", "ext": "webm",
+     "vcodec": "vp9", "acodec": "none", "filesize": 1000, "protocol": "https"},
+    {"format_id": "aud", "url": "http://media.test/aud.m4a", "ext": "m4a",
+     "vcodec": "none", "acodec": "mp4a", "filesize": 100, "protocol": "https"},
+]
+
+
+def raw_info() -> dict:
+    return {
+        "id": "v1", "title": "clip", "formats": copy.deepcopy(FORMATS),
+        "extractor": "generic", "extractor_key": "Generic", "webpage_url": "http://media.test/v1",
+    }
+
+
+class RecordingYDL(yt_dlp.YoutubeDL):
+    """Вместо скачивания запоминает, что yt-dlp выбрал."""
+
+    def __init__(self, params: dict):
+        super().__init__({"quiet": True, "no_warnings": True, **params})
+        self.processed = []
+
+    def process_info(self, info_dict: dict) -> None:
+        self.processed.append(info_dict)
+
+
+def preflight(fmt: str) -> dict:
+    return RecordingYDL({"format": fmt}).process_ie_result(raw_info(), download=False)
+
+
+def test_reprocess_drops_previous_selection():
+    info = preflight("bigv+aud")
+    assert [f["format_id"] for f in info["requested_formats"]] == ["bigv", "aud"]
+
+    fresh = bot.info_for_reprocess(info)
+    for field in bot.FORMAT_SELECTION_FIELDS:
+        assert field not in fresh
+    assert "requested_formats" in info  # исходный info из preflight не тронут
+
+    ydl = RecordingYDL({"format": "small"})
+    ydl.process_ie_result(fresh, download=True)
+    chosen = ydl.processed[0]
+    assert chosen["format_id"] == "small"
+    assert chosen["url"] == "http://media.test/small.mp4"
+    assert chosen["ext"] == "mp4"
+    assert not chosen.get("requested_formats")
+
+
+def test_reprocess_keeps_merge_selection():
+    info = preflight("small")
+    ydl = RecordingYDL({"format": "bigv+aud"})
+    ydl.process_ie_result(bot.info_for_reprocess(info), download=True)
+    chosen = ydl.processed[0]
+    assert chosen["format_id"] == "bigv+aud"
+    assert [f["format_id"] for f in chosen["requested_formats"]] == ["bigv", "aud"]
+
+
+def test_download_uses_override_on_preflight_info(monkeypatch, tmp_path):
+    info = preflight("bigv+aud")
+    seen = []
+
+    def fake_process_info(self, info_dict):
+        seen.append(info_dict)
+        open(self.prepare_filename(info_dict), "wb").close()
+
+    monkeypatch.setattr(yt_dlp.YoutubeDL, "process_info", fake_process_info)
+    path = bot.download_video_from_url("http://media.test/v1", "generic", format_override="small",
+                                       info=info, workdir=str(tmp_path))
+    assert path and path.endswith(".mp4")
+    assert seen[0]["format_id"] == "small"
+    assert not seen[0].get("requested_formats")
+
+
+def test_preflight_takes_first_video_of_playlist(monkeypatch):
+    playlist = {
+        "_type": "playlist", "id": "p", "title": "carousel",
+        "entries": [dict(raw_info(), id="v1"), dict(raw_info(), id="v2")],
+        "extractor": "generic", "extractor_key": "Generic", "webpage_url": "http://media.test/p",
+    }
+    monkeypatch.setattr(yt_dlp.YoutubeDL, "extract_info",
+                        lambda self, url, download=True: self.process_ie_result(copy.deepcopy(playlist), download))
+    info = bot.preflight_video("http://media.test/p", "generic")
+    assert info["id"] == "v1"
+    assert info["format_id"]
@@ -0,0 +1,216 @@
+import os
+import logging
+from dataclasses import dataclass, replace
+from typing import Optional, Callable, Awaitable
+
+from media import MediaInfo, run_ffmpeg
+
+TRANSCODE_MODE = os.getenv("TRANSCODE_MODE", "auto")   # auto / crf / capped / 2pass
+TRANSCODE_PRESET = os.getenv("TRANSCODE_PRESET", "")   # пусто — по объёму работы (длительность × пиксели)
+TRANSCODE_CRF = int(os.getenv("TRANSCODE_CRF", "23"))
+CONTAINER_OVERHEAD = 0.96      # доля лимита под аудио+видео, остальное — mp4-заголовки и запас
+MIN_VIDEO_KBPS = 120           # ниже смотреть уже нельзя — такой ролик не сжимаем
+MIN_BITS_PER_PIXEL = 0.05      # бит на пиксель кадра: меньше — уменьшаем разрешение
+SHORT_SIDE_LADDER = (1080, 720, 540, 480, 360, 240)
+DEFAULT_FPS = 30.0
+FIT_RETRIES = 1                # повторов с поправкой битрейта, если файл всё же не влез
+
+# (пикселей × секунд, пресет): чем больше работы, тем быстрее пресет — перекод не должен упираться в таймаут
+PRESET_BY_WORK = (
+    (1280 * 720 * 60, "veryfast"),
+    (1280 * 720 * 300, "superfast"),
+)
+
+
+@dataclass(frozen=True)
+class TranscodePlan:
+    """
+    Параметры одного перекода в H.264/AAC.
+    mode: "crf" — только качество; "capped" — CRF с потолком битрейта (VBV, один проход);
+    "2pass" — средний битрейт в два прохода, размер почти точно равен бюджету.
+    """
+    mode: str
+    preset: str
+    crf: int
+    video_kbps: int     # потолок (capped) или цель (2pass); 0 — без ограничения
+    short_side: int     # к какой меньшей стороне масштабировать; 0 — как у источника
+    audio_kbps: int     # 0 — копировать AAC как есть
+    threads: int
+
+    def scale_filter(self, info: Optional[MediaInfo]) -> str:
+        if self.short_side and info and info.width and info.height:
+            if info.width >= info.height:
+                return f"scale=-2:{self.short_side}"
+            return f"scale={self.short_side}:-2"
+        return "scale=trunc(iw/2)*2:trunc(ih/2)*2"
+
+    def video_args(self, info: Optional[MediaInfo]) -> list[str]:
+        args = [
+            "-c:v", "libx264", "-preset", self.preset,
+            "-profile:v", "high", "-level:v", "4.0", "-pix_fmt", "yuv420p",
+            "-vf", self.scale_filter(info),
+        ]
+        if self.mode == "2pass":
+            args += ["-b:v", f"{self.video_kbps}k"]
+        else:
+            args += ["-crf", str(self.crf)]
+        if self.video_kbps and self.mode in ("capped", "2pass"):
+            args += ["-maxrate", f"{self.video_kbps * (1 if self.mode == 'capped' else 2)}k",
+                     "-bufsize", f"{self.video_kbps * 2}k"]
+        return args
+
+    def audio_args(self) -> list[str]:
+        if self.audio_kbps == 0:
+            return ["-c:a", "copy"]
+        return ["-c:a", "aac", "-b:a", f"{self.audio_kbps}k"]
+
+
+def _short_side(info: MediaInfo) -> int:
+    return min(info.width, info.height) if info.width and info.height else 0
+
+
+def _scaled_pixels(info: MediaInfo, short_side: int) -> int:
+    if not (info.width and info.height):
+        return 1280 * 720
+    src_short = _short_side(info)
+    ratio = min(1.0, short_side / src_short) if short_side else 1.0
+    return int(info.width * ratio) * int(info.height * ratio)
+
+
+def pick_preset(info: Optional[MediaInfo], short_side: int) -> str:
+    if TRANSCODE_PRESET:
+        return TRANSCODE_PRESET
+    if not info or not info.duration:
+        return "ultrafast"
+    work = _scaled_pixels(info, short_side) * info.duration
+    for max_work, preset in PRESET_BY_WORK:
+        if work <= max_work:
+            return preset
+    return "ultrafast"
+
+
+def bitrate_budget(duration: float, limit: int) -> Optional[tuple[int, int]]:
+    """
+    (видео кбит/с, аудио кбит/с), с которыми ролик длиной duration влезает в limit байт;
+    None — даже MIN_VIDEO_KBPS не влезает. Считается и до скачивания, по длительности из метаданных.
+    """
+    total_kbps = limit * 8 / 1000 * CONTAINER_OVERHEAD / duration
+    audio_kbps = 128
+    if total_kbps - audio_kbps < MIN_VIDEO_KBPS * 2:
+        audio_kbps = 64  # на тесном бюджете звук ужимаем сильнее картинки
+    video_kbps = int(total_kbps - audio_kbps)
+    if video_kbps < MIN_VIDEO_KBPS:
+        return None
+    return video_kbps, audio_kbps
+
+
+def plan_transcode(info: Optional[MediaInfo], limit: int, threads: int) -> Optional[TranscodePlan]:
+    """
+    План перекода, который влезает в limit байт. Бюджет видео = лимит / длительность − аудио;
+    разрешение снижается по лестнице, пока на пиксель приходится меньше MIN_BITS_PER_PIXEL.
+    Источник и так меньше лимита — CRF с потолком битрейта (один проход, размер не больше бюджета);
+    источник больше лимита — два прохода на точный средний битрейт.
+    None — даже минимальный битрейт не влезает (слишком длинный ролик).
+    """
+    copy_audio = bool(info and info.acodec == "aac")
+    if not info or not info.duration:
+        # без длительности бюджет не посчитать — только качество
+        return TranscodePlan("crf", pick_preset(info, 0), TRANSCODE_CRF, 0, 0, 0 if copy_audio else 128, threads)
+
+    budget = bitrate_budget(info.duration, limit)
+    if budget is None:
+        return None
+    video_kbps, audio_kbps = budget
+    if audio_kbps < 128:
+        copy_audio = False
+
+    fps = info.fps or DEFAULT_FPS
+    short_side = 0
+    src_short = _short_side(info)
+    for rung in SHORT_SIDE_LADDER:
+        if src_short and rung >= src_short:
+            continue
+        if video_kbps * 1000 >= MIN_BITS_PER_PIXEL * _scaled_pixels(info, short_side) * fps:
+            break
+        short_side = rung
+    mode = TRANSCODE_MODE
+    if mode == "auto":
+        mode = "capped" if info.size <= limit else "2pass"
+    return TranscodePlan(
+        mode=mode,
+        preset=pick_preset(info, short_side),
+        crf=TRANSCODE_CRF,
+        video_kbps=0 if mode == "crf" else video_kbps,
+        short_side=short_side,
+        audio_kbps=0 if copy_audio else audio_kbps,
+        threads=threads,
+    )
+
+
+async def encode(
+    plan: TranscodePlan,
+    input_path: str,
+    output_path: str,
+    info: Optional[MediaInfo],
+    timeout: float,
+    on_progress: Optional[Callable[[Optional[float], str], Awaitable[None]]] = None,
+) -> None:
+    """Перекод по плану; для 2pass прогресс первого прохода — 0–50%, второго — 50–100%."""
+    duration = info.duration if info else 0.0
+    common = ["-y", "-i", input_path, *plan.video_args(info)]
+    if plan.mode != "2pass":
+        await run_ffmpeg(
+            [*common, *plan.audio_args(), "-movflags", "+faststart", output_path],
+            timeout=timeout, duration=duration, on_progress=on_progress, threads=plan.threads,
+        )
+        return
+
+    passlog = f"{os.path.splitext(output_path)[0]}_2pass"
+
+    def half(offset: float):
+        if not on_progress:
+            return None
+        async def report(percent: Optional[float], speed: str) -> None:
+            await on_progress(None if percent is None else offset + percent / 2, speed)
+        return report
+
+    try:
+        await run_ffmpeg(
+            [*common, "-pass", "1", "-passlogfile", passlog, "-an", "-f", "null", "-"],
+            timeout=timeout / 2, duration=duration, on_progress=half(0.0), threads=plan.threads,
+        )
+        await run_ffmpeg(
+            [*common, "-pass", "2", "-passlogfile", passlog, *plan.audio_args(), "-movflags", "+faststart", output_path],
+            timeout=timeout / 2, duration=duration, on_progress=half(50.0), threads=plan.threads,
+        )
+    finally:
+        for suffix in ("-0.log", "-0.log.mbtree", "-0.log.temp", "-0.log.mbtree.temp"):
+            try:
+                os.remove(passlog + suffix)
+            except OSError:
+                pass
+
+
+async def encode_to_fit(
+    plan: TranscodePlan,
+    input_path: str,
+    output_path: str,
+    info: Optional[MediaInfo],
+    limit: int,
+    timeout: float,
+    on_progress: Optional[Callable[[Optional[float], str], Awaitable[None]]] = None,
+) -> bool:
+    """encode + проверка размера: не влезло — снижаем битрейт пропорционально и повторяем в два прохода."""
+    for attempt in range(FIT_RETRIES + 1):
+        await encode(plan, input_path, output_path, info, timeout, on_progress)
+        size = os.path.getsize(output_path)
+        if size <= limit or not plan.video_kbps:
+            return size <= limit
+        if attempt == FIT_RETRIES:
+            break
+        video_kbps = int(plan.video_kbps * limit / size * 0.95)
+        if video_kbps < MIN_VIDEO_KBPS:
+            break
+        logging.info(f"Перекод дал {size} байт при лимите {limit}, повторяю с {video_kbps} кбит/с")
+        plan = replace(plan, mode="2pass", video_kbps=video_kbps)
+    return False
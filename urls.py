@@ -0,0 +1,180 @@
+import os
+import re
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Optional
+from urllib.parse import urlsplit
+
+import aiohttp
+
+# --- Конфигурация ---
+REDIRECT_TIMEOUT = float(os.getenv("REDIRECT_TIMEOUT", "5"))
+REDIRECT_CACHE_SIZE = int(os.getenv("REDIRECT_CACHE_SIZE", "10000"))
+REDIRECT_CACHE_TTL = float(os.getenv("REDIRECT_CACHE_TTL", str(24 * 3600)))
+REDIRECT_FAILURE_TTL = float(os.getenv("REDIRECT_FAILURE_TTL", "60"))  # неудачу помним недолго — сеть могла моргнуть
+REDIRECT_USER_AGENT = (
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
+    "AppleWebKit/537.36 (KHTML, like Gecko) "
+    "Chrome/124.0.0.0 Safari/537.36"
+)
+
+# (платформа, шаблон, канонический URL). Шаблоны проверяются по порядку, первый совпавший побеждает.
+_ID_PATTERNS: list[tuple[str, re.Pattern, str]] = [
+    ("tiktok", re.compile(
+        r"^https?://(?:www\.|m\.)?tiktok\.com/@(?P<user>[\w.\-]+)/(?:video|photo)/(?P<id>\d+)", re.I),
+     "https://www.tiktok.com/@{user}/video/{id}"),
+    ("tiktok", re.compile(
+        r"^https?://(?:www\.|m\.)?tiktok\.com/(?:v|embed(?:/v2)?)/(?P<id>\d+)", re.I),
+     "https://www.tiktok.com/@/video/{id}"),
+    ("instagram", re.compile(
+        r"^https?://(?:www\.)?(?:instagram\.com|instagr\.am)/(?:[\w.]+/)?(?:p|reels?|tv)/(?P<id>[\w-]+)", re.I),
+     "https://www.instagram.com/p/{id}/"),
+    ("youtube_shorts", re.compile(
+        r"^https?://(?:www\.|m\.)?youtube\.com/shorts/(?P<id>[\w-]{11})", re.I),
+     "https://www.youtube.com/shorts/{id}"),
+    ("youtube", re.compile(
+        r"^https?://(?:www\.|m\.|music\.)?youtube\.com/watch\?(?:[^#]*&)?v=(?P<id>[\w-]{11})", re.I),
+     "https://www.youtube.com/watch?v={id}"),
+    ("youtube", re.compile(
+        r"^https?://(?:www\.|m\.)?(?:youtube\.com/(?:embed|live|v)|youtu\.be)/(?P<id>[\w-]{11})", re.I),
+     "https://www.youtube.com/watch?v={id}"),
+    ("twitter", re.compile(
+        r"^https?://(?:www\.|mobile\.)?(?:twitter|x)\.com/(?:i/web|i|\w+)/status(?:es)?/(?P<id>\d+)", re.I),
+     "https://x.com/i/status/{id}"),
+]
+
+# Канонический URL по платформе и id ролика — без сети и без лишних частей (ник автора TikTok не нужен)
+_CANONICAL_URLS = {
+    "tiktok": "https://www.tiktok.com/@/video/{id}",
+    "instagram": "https://www.instagram.com/p/{id}/",
+    "youtube_shorts": "https://www.youtube.com/shorts/{id}",
+    "youtube": "https://www.youtube.com/watch?v={id}",
+    "twitter": "https://x.com/i/status/{id}",
+}
+
+# Домены платформ (точное совпадение или поддомен). None — короткая ссылка неизвестно куда.
+_PLATFORM_HOSTS: dict[str, Optional[str]] = {
+    "tiktok.com": "tiktok",
+    "instagram.com": "instagram",
+    "instagr.am": "instagram",
+    "youtube.com": "youtube",
+    "youtu.be": "youtube",
+    "twitter.com": "twitter",
+    "x.com": "twitter",
+    "t.co": None,
+}
+
+# Короткие ссылки, которые без редиректа не дают id ролика
+_SHORT_LINK_RE = re.compile(
+    r"^https?://(?:(?:vm|vt)\.tiktok\.com/|(?:www\.|m\.)?tiktok\.com/t/|t\.co/)[\w-]+", re.I
+)
+
+# Шорты и обычные ролики YouTube — одно и то же видео, ключ кэша общий
+_PLATFORM_FAMILY = {"youtube_shorts": "youtube"}
+
+_redirect_cache: "OrderedDict[str, tuple[float, Optional[str]]]" = OrderedDict()
+_session: Optional[aiohttp.ClientSession] = None
+
+
+def host_platform(url: str) -> Optional[str]:
+    """Платформа по домену ссылки (без учёта пути), либо None."""
+    try:
+        host = (urlsplit(url).hostname or "").lower()
+    except ValueError:
+        return None
+    while host:
+        if host in _PLATFORM_HOSTS:
+            return _PLATFORM_HOSTS[host]
+        _, _, host = host.partition(".")
+    return None
+
+
+def match_url(url: str) -> Optional[tuple[str, str, str]]:
+    """Без сети: (платформа, id ролика, канонический URL) или None, если шаблон не подошёл."""
+    u = url.strip()
+    for platform, pattern, template in _ID_PATTERNS:
+        m = pattern.match(u)
+        if m:
+            return platform, m.group("id"), template.format(**m.groupdict())
+    return None
+
+
+def is_short_link(url: str) -> bool:
+    return bool(_SHORT_LINK_RE.match(url.strip()))
+
+
+def canonical_url(platform: str, canonical_id: str) -> Optional[str]:
+    """Обратно к match_url: URL ролика по (платформа, id), None — платформа неизвестна."""
+    template = _CANONICAL_URLS.get(platform)
+    return template.format(id=canonical_id) if template else None
+
+
+def canonical_key(platform: str, canonical_id: str) -> str:
+    """Стабильный ключ ролика для кэшей и дедупликации."""
+    return f"{_PLATFORM_FAMILY.get(platform, platform)}:{canonical_id}"
+
+
+async def _get_session() -> aiohttp.ClientSession:
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=REDIRECT_TIMEOUT),
+            headers={"User-Agent": REDIRECT_USER_AGENT},
+        )
+    return _session
+
+
+async def close_session() -> None:
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+
+async def resolve_redirect(url: str) -> Optional[str]:
+    """
+    Разворачивает короткую ссылку (vm.tiktok.com, t.co, ...) в конечный URL.
+    Результат кэшируется в LRU на REDIRECT_CACHE_TTL секунд, неудача — на REDIRECT_FAILURE_TTL.
+    """
+    now = time.monotonic()
+    cached = _redirect_cache.get(url)
+    if cached and now - cached[0] < (REDIRECT_CACHE_TTL if cached[1] else REDIRECT_FAILURE_TTL):
+        _redirect_cache.move_to_end(url)
+        return cached[1]
+
+    resolved: Optional[str] = None
+    try:
+        session = await _get_session()
+        # GET, а не HEAD: TikTok на HEAD иногда отвечает 405 без Location
+        async with session.get(url, allow_redirects=True) as resp:
+            resolved = str(resp.url)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logging.warning(f"Не удалось развернуть короткую ссылку {url}: {e}")
+
+    _redirect_cache[url] = (now, resolved)
+    _redirect_cache.move_to_end(url)
+    while len(_redirect_cache) > REDIRECT_CACHE_SIZE:
+        _redirect_cache.popitem(last=False)
+    return resolved
+
+
+async def normalize_url(url: str, resolve: bool = True) -> Optional[tuple[str, Optional[str], str]]:
+    """
+    Возвращает (платформа, id ролика, канонический URL).
+    Короткие ссылки при resolve=True разворачиваются через редирект (без блокировки event loop).
+    Если домен известен, но id из пути не извлечь — id будет None, а URL останется исходным.
+    """
+    u = url.strip()
+    if resolve and is_short_link(u):
+        target = await resolve_redirect(u)
+        if target:
+            u = target
+    matched = match_url(u)
+    if matched:
+        return matched
+    platform = host_platform(u)
+    if platform:
+        return platform, None, u
+    return None
@@ -0,0 +1,184 @@
+"""
+Воркер раздельного режима: забирает задачи из JOB_QUEUE и крутит конвейер
+скачать → репак/перекод → загрузить, а бот (bot.py с тем же JOB_QUEUE) только принимает ссылки.
+
+    JOB_QUEUE=sqlite:///cache/jobs.sqlite3 python worker.py --processes 4
+
+Воркеров можно запускать сколько угодно и где угодно, лишь бы они видели ту же очередь
+(SQLite — на одной машине, Redis — на разных). Каждому нужны BOT_TOKEN, ffmpeg и cookies.
+"""
+import os
+import time
+import socket
+import signal
+import asyncio
+import logging
+import argparse
+import multiprocessing
+from typing import Optional
+
+import bot as app
+import metrics
+from jobqueue import JobQueue
+from logs import bind_job_id
+from scheduler import QueueFull, current_user
+
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", str(app.DOWNLOAD_WORKERS)))  # задач на процесс
+WORKER_IDLE_POLL = float(os.getenv("WORKER_IDLE_POLL", "1.0"))  # пауза, когда очередь пуста, сек
+HEARTBEAT_INTERVAL = min(5.0, app.JOB_LEASE / 4)
+
+
+async def handle_job(queue: JobQueue, job_id: str, payload: dict) -> None:
+    bind_job_id(payload.get("job_id") or job_id)  # тот же id, что в логах бота; задача конвейера его унаследует
+    current_user.set(payload.get("user_id"))  # пулы стадий чередуют задачи разных пользователей
+    status = app.StatusMessage(**payload["status"]) if payload.get("status") else None
+    progress_hook, set_status = app.status_callbacks(status) if status else (None, None)
+    delivered: list[app.UploadTarget] = []
+
+    async def resolve_target() -> app.UploadTarget:
+        # получатель мог смениться, пока задача шла (bot.SharedDelivery)
+        target = await asyncio.to_thread(queue.target, job_id)
+        return app.UploadTarget(**(target or payload["target"]))
+
+    job = asyncio.create_task(app.process_and_upload(
+        payload["url"], payload["platform"], payload["cache_key"], app.make_uploader(resolve_target, delivered.append),
+        progress_hook, set_status,
+    ))
+    try:
+        # пока конвейер работает — продлеваем аренду и проверяем, не отменил ли пользователь
+        while not job.done():
+            await asyncio.wait({job}, timeout=HEARTBEAT_INTERVAL)
+            if job.done():
+                break
+            await asyncio.to_thread(queue.heartbeat, job_id)
+            if await asyncio.to_thread(queue.is_cancelled, job_id):
+                logging.info(f"Задача {job_id} отменена пользователем.")
+                job.cancel()
+        try:
+            result = {"file_id": job.result(), "target": delivered[-1]._asdict() if delivered else None}
+        except asyncio.CancelledError:
+            result = {"error": "cancelled"}
+        except QueueFull:
+            result = {"error": "busy"}  # например, нет места на диске — бот скажет «перегружен»
+        except app.VideoJobError as e:
+            result = {"error": e.reason, "size": e.size, "retry_after": e.retry_after}
+        except Exception as e:
+            logging.exception(f"Задача {job_id} упала: {e}")
+            result = {"error": "upload"}
+    except BaseException:
+        job.cancel()
+        raise
+    finally:
+        if status:
+            # статус дальше правит бот — наши отложенные правки не должны перезаписать его текст
+            await app.progress_updater.finish(status.chat_id, status.message_id)
+    await asyncio.to_thread(queue.complete, job_id, result)
+    logging.info(f"Задача {job_id} выполнена: {result}")
+
+
+async def run_worker(queue: JobQueue, worker_id: str, concurrency: int) -> None:
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:  # Windows
+            pass
+
+    slots = asyncio.Semaphore(concurrency)
+    tasks: set[asyncio.Task] = set()
+    last_sweep = 0.0
+    logging.info(f"Воркер {worker_id} запущен: до {concurrency} задач одновременно.")
+    while not stop.is_set():
+        if time.monotonic() - last_sweep > app.JOB_LEASE:
+            last_sweep = time.monotonic()
+            requeued = await asyncio.to_thread(queue.requeue_stale, app.JOB_LEASE)
+            if requeued:
+                logging.warning(f"Вернул в очередь {requeued} задач(и) пропавших воркеров.")
+
+        await slots.acquire()
+        if stop.is_set():
+            # пока ждали слот, пришёл SIGTERM — лишнюю задачу не берём, иначе остановка затянется на неё
+            slots.release()
+            break
+        job = await asyncio.to_thread(queue.claim, worker_id)
+        if job is None:
+            slots.release()
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=WORKER_IDLE_POLL)
+            except asyncio.TimeoutError:
+                pass
+            continue
+
+        job_id, payload = job
+        logging.info(f"Воркер {worker_id} взял задачу {job_id}: {payload['url']}")
+        task = asyncio.create_task(handle_job(queue, job_id, payload))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+        task.add_done_callback(lambda _t: slots.release())
+
+    # мягкая остановка: новые задачи не берём, начатые доводим до конца
+    if tasks:
+        logging.info(f"Воркер {worker_id} останавливается, дожидаюсь {len(tasks)} задач(и)…")
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def worker_main(concurrency: int, index: int = 0) -> None:
+    queue: Optional[JobQueue] = app.job_queue
+    if queue is None:
+        raise RuntimeError("Воркеру нужна очередь: задайте JOB_QUEUE (sqlite:///... или redis://...).")
+    worker_id = f"{socket.gethostname()}:{os.getpid()}"
+    app.workspace.start_sweeper(app.WORKSPACE_SWEEP_INTERVAL, app.WORKSPACE_ORPHAN_AGE)
+    metrics_runner = gauges_task = None
+    if app.WORKER_METRICS_PORT:
+        # у каждого процесса свои счётчики — и свой порт: WORKER_METRICS_PORT + номер процесса
+        # (METRICS_PORT занят ботом)
+        port = app.WORKER_METRICS_PORT + index
+        metrics_runner = await metrics.start_http_server(app.METRICS_HOST, port)
+        logging.info(f"Метрики воркера: http://{app.METRICS_HOST}:{port}/metrics")
+        gauges_task = asyncio.create_task(app.refresh_store_gauges())
+    try:
+        await run_worker(queue, worker_id, concurrency)
+    finally:
+        if gauges_task:
+            gauges_task.cancel()
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        await app.bot.session.close()
+        await app.progress_updater.close()
+        await app.workspace.close()
+        app.scheduler.shutdown()
+        app.ydl_pool.close()
+        queue.close()
+
+
+def run_process(concurrency: int, index: int = 0) -> None:
+    asyncio.run(worker_main(concurrency, index))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Воркер очереди задач бота-скачивальщика")
+    parser.add_argument("--processes", type=int, default=1, help="сколько процессов-воркеров запустить")
+    parser.add_argument("--concurrency", type=int, default=WORKER_CONCURRENCY, help="задач на процесс")
+    args = parser.parse_args()
+
+    app.install_ffmpeg()
+    if args.processes <= 1:
+        run_process(args.concurrency)
+    else:
+        # отдельные процессы — отдельные GIL: перекод и разбор yt-dlp масштабируются по ядрам
+        ctx = multiprocessing.get_context("spawn")  # без fork: соединения с очередью/SQLite не делятся
+        procs = [
+            ctx.Process(target=run_process, args=(args.concurrency, i), name=f"worker-{i}")
+            for i in range(args.processes)
+        ]
+        for p in procs:
+            p.start()
+        try:
+            for p in procs:
+                p.join()
+        except KeyboardInterrupt:
+            for p in procs:
+                p.terminate()
+            for p in procs:
+                p.join()
@@ -0,0 +1,259 @@
+import os
+import time
+import uuid
+import shutil
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from typing import Optional
+
+from scheduler import QueueFull
+
+OWNER_FILE = ".owner"  # "<pid>-<метка>" процесса-владельца: по нему сборщик отличает сироту от живой задачи
+
+
+class WorkspaceFull(QueueFull):
+    """Не удалось зарезервировать место на диске под задачу за отведённое время (для пользователя — перегрузка)."""
+
+
+_instance: tuple[int, str] = (0, "")
+
+
+def instance_id() -> str:
+    """
+    Метка этого процесса: pid плюс случайная часть. Одного pid мало — в контейнере бот после
+    рестарта снова PID 1, и каталоги прошлого запуска выглядели бы своими. Считается заново после fork.
+    """
+    global _instance
+    pid = os.getpid()
+    if _instance[0] != pid:
+        _instance = (pid, f"{pid}-{uuid.uuid4().hex[:12]}")
+    return _instance[1]
+
+
+def _pid_alive(pid: int) -> bool:
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True  # процесс есть, просто чужой
+    return True
+
+
+def _dir_size(path: str) -> int:
+    total = 0
+    for dirpath, _dirnames, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+class _Area:
+    """Один корень рабочих каталогов (диск или tmpfs) со своей квотой и резервами."""
+
+    def __init__(self, root: str, quota: int, min_free: int):
+        self.root = root
+        self.quota = quota
+        self.min_free = min_free
+        self.reserved = 0
+        os.makedirs(root, exist_ok=True)
+
+    def free(self) -> int:
+        try:
+            return shutil.disk_usage(self.root).free
+        except OSError:
+            return 0
+
+    def fits(self, size: int) -> bool:
+        # резерв не больше квоты, и на диске после всех резервов остаётся min_free
+        return self.reserved + size <= self.quota and self.free() - size >= self.min_free
+
+
+class Workspace:
+    """
+    Рабочие каталоги задач: у каждой задачи свой <root>/<pid>-<id>/, который удаляется целиком
+    при выходе из job() — что бы ни создали yt-dlp и ffmpeg. Перед скачиванием задача резервирует
+    байты в квоте (ждёт, пока место освободится); маленькие задачи по возможности идут на tmpfs.
+    Каталоги упавших процессов (pid владельца мёртв или занят уже новым процессом) и забытые файлы сносит sweep().
+    """
+
+    def __init__(
+        self,
+        root: str,
+        quota: int,
+        min_free: int = 0,
+        tmpfs_root: str = "",
+        tmpfs_quota: int = 0,
+        tmpfs_max_job: int = 0,
+        wait_timeout: float = 60.0,
+    ):
+        self.disk = _Area(root, quota, min_free)
+        self.tmpfs = _Area(tmpfs_root, tmpfs_quota, 0) if tmpfs_root and tmpfs_quota else None
+        self.tmpfs_max_job = tmpfs_max_job
+        self.wait_timeout = wait_timeout
+        self.jobs = 0
+        self.waited = 0
+        self.rejected = 0
+        self.orphans_removed = 0
+        self.orphan_bytes_removed = 0
+        self._changed: Optional[asyncio.Condition] = None
+        self._sweeper: Optional[asyncio.Task] = None
+
+    def _condition(self) -> asyncio.Condition:
+        if self._changed is None:
+            self._changed = asyncio.Condition()
+        return self._changed
+
+    def _pick_area(self, size: int) -> Optional[_Area]:
+        if self.tmpfs and size <= self.tmpfs_max_job and self.tmpfs.fits(size):
+            return self.tmpfs
+        if self.disk.fits(size):
+            return self.disk
+        return None
+
+    @asynccontextmanager
+    async def job(self, reserve: int):
+        """Резервирует reserve байт и выдаёт путь к пустому каталогу задачи; после — удаляет его."""
+        if reserve > self.disk.quota:
+            self.rejected += 1
+            raise WorkspaceFull(f"задаче нужно {reserve} байт, квота {self.disk.quota}")
+        cond = self._condition()
+        async with cond:
+            area = self._pick_area(reserve)
+            if area is None:
+                self.waited += 1
+                deadline = time.monotonic() + self.wait_timeout
+                while area is None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.rejected += 1
+                        raise WorkspaceFull(f"нет места под {reserve} байт за {self.wait_timeout:.0f} с")
+                    # будят освободившиеся резервы; свободное место на диске меняют и другие процессы,
+                    # поэтому заодно перепроверяем раз в секунду
+                    try:
+                        await asyncio.wait_for(cond.wait(), timeout=min(1.0, remaining))
+                    except asyncio.TimeoutError:
+                        pass
+                    area = self._pick_area(reserve)
+            area.reserved += reserve
+        self.jobs += 1
+
+        path = os.path.join(area.root, f"{os.getpid()}-{uuid.uuid4().hex[:12]}")
+        try:
+            os.makedirs(path)
+            with open(os.path.join(path, OWNER_FILE), "w") as f:
+                f.write(instance_id())
+            yield path
+        finally:
+            shutil.rmtree(path, ignore_errors=True)
+            self.jobs -= 1
+            async with cond:
+                area.reserved -= reserve
+                cond.notify_all()
+
+    def _is_orphan(self, path: str, max_age: float, now: float) -> bool:
+        try:
+            with open(os.path.join(path, OWNER_FILE)) as f:
+                owner = f.read().strip()
+            pid = int(owner.partition("-")[0] or 0)
+        except (OSError, ValueError):
+            owner, pid = "", 0
+        if owner == instance_id():
+            return False  # каталог живой задачи этого процесса — его удалит сама задача
+        if pid == os.getpid():
+            return True  # pid наш, а метка чужая — каталог прошлого запуска с тем же pid
+        if pid and _pid_alive(pid):
+            # живой владелец, но каталог подозрительно старый — значит, задача зависла или потеряна
+            return now - os.path.getmtime(path) > max_age * 4
+        return pid != 0 or now - os.path.getmtime(path) > max_age
+
+    def sweep(self, max_age: float) -> int:
+        """
+        Удаляет каталоги задач, чей процесс умер, а также файлы и каталоги без владельца старше max_age
+        (например, downloads/<платформа>/ от старых версий). Возвращает число удалённых объектов.
+        """
+        removed = 0
+        now = time.time()
+        for area in filter(None, (self.disk, self.tmpfs)):
+            try:
+                entries = list(os.scandir(area.root))
+            except OSError:
+                continue
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if os.path.exists(os.path.join(entry.path, OWNER_FILE)):
+                            if not self._is_orphan(entry.path, max_age, now):
+                                continue
+                            size = _dir_size(entry.path)
+                            shutil.rmtree(entry.path, ignore_errors=True)
+                        else:
+                            # старая раскладка downloads/<платформа>/<uuid>.* — чистим только старые файлы
+                            size = 0
+                            for sub in os.scandir(entry.path):
+                                if sub.is_file(follow_symlinks=False) and now - sub.stat().st_mtime > max_age:
+                                    size += sub.stat().st_size
+                                    os.remove(sub.path)
+                                    removed += 1
+                            self.orphan_bytes_removed += size
+                            continue
+                    elif now - entry.stat(follow_symlinks=False).st_mtime > max_age:
+                        size = entry.stat(follow_symlinks=False).st_size
+                        os.remove(entry.path)
+                    else:
+                        continue
+                except OSError as e:
+                    logging.debug(f"Не удалось убрать {entry.path}: {e}")
+                    continue
+                removed += 1
+                self.orphan_bytes_removed += size
+        self.orphans_removed += removed
+        if removed:
+            logging.info(f"Уборка рабочих каталогов: удалено {removed} сирот.")
+        return removed
+
+    def start_sweeper(self, interval: float, max_age: float) -> None:
+        """Уборка при старте и затем раз в interval секунд (в фоне, в отдельном потоке)."""
+        async def loop() -> None:
+            while True:
+                try:
+                    await asyncio.to_thread(self.sweep, max_age)
+                except Exception as e:
+                    logging.warning(f"Ошибка уборки рабочих каталогов: {e}")
+                await asyncio.sleep(interval)
+
+        if self._sweeper is None or self._sweeper.done():
+            self._sweeper = asyncio.get_running_loop().create_task(loop())
+
+    async def close(self) -> None:
+        if self._sweeper:
+            self._sweeper.cancel()
+            try:
+                await self._sweeper
+            except asyncio.CancelledError:
+                pass
+
+    def stats(self) -> dict:
+        stats = {
+            "jobs": self.jobs,
+            "waited": self.waited,
+            "rejected": self.rejected,
+            "orphans_removed": self.orphans_removed,
+            "orphan_bytes_removed": self.orphan_bytes_removed,
+            "disk_reserved": self.disk.reserved,
+            "disk_quota": self.disk.quota,
+            "disk_free": self.disk.free(),
+        }
+        if self.tmpfs:
+            stats.update(tmpfs_reserved=self.tmpfs.reserved, tmpfs_quota=self.tmpfs.quota, tmpfs_free=self.tmpfs.free())
+        return stats
+
+    def usage(self) -> int:
+        """Сколько байт реально лежит в рабочих каталогах (обход файлов — не вызывать часто)."""
+        return sum(_dir_size(area.root) for area in filter(None, (self.disk, self.tmpfs)))
@@ -0,0 +1,112 @@
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Optional, Callable
+
+import yt_dlp
+
+# Опции, которые меняются от задачи к задаче; всё остальное задаётся при создании экземпляра
+JOB_OPTIONS = ("outtmpl", "format", "merge_output_format", "max_filesize", "concurrent_fragment_downloads")
+
+
+class YDLPool:
+    """
+    Пул прогретых yt_dlp.YoutubeDL по платформам. Экземпляр один раз разбирает cookiefile,
+    инициализирует экстракторы и держит HTTP-соединения (keep-alive) между задачами.
+    Экземпляр не потокобезопасен, поэтому в каждый момент он выдан ровно одному потоку;
+    опции задачи накладываются на время acquire и откатываются после.
+    """
+
+    def __init__(self, base_options: Callable[[str], dict], size: int, max_uses: int):
+        self._base_options = base_options
+        self.size = size
+        self.max_uses = max_uses
+        self.created = 0
+        self.reused = 0
+        self._idle: dict[str, list[yt_dlp.YoutubeDL]] = {}
+        self._lock = threading.Lock()
+
+    def _create(self, platform: str) -> yt_dlp.YoutubeDL:
+        ydl = yt_dlp.YoutubeDL(self._base_options(platform))
+        ydl.job_progress_hook = None
+        ydl.job_uses = 0
+        # один постоянный хук, который пересылает события хуку текущей задачи
+        ydl.add_progress_hook(lambda d, ydl=ydl: ydl.job_progress_hook and ydl.job_progress_hook(d))
+        with self._lock:
+            self.created += 1
+        return ydl
+
+    def _checkout(self, platform: str) -> yt_dlp.YoutubeDL:
+        with self._lock:
+            idle = self._idle.get(platform)
+            if idle:
+                self.reused += 1
+                return idle.pop()
+        return self._create(platform)
+
+    def _checkin(self, platform: str, ydl: yt_dlp.YoutubeDL) -> None:
+        with self._lock:
+            idle = self._idle.setdefault(platform, [])
+            if ydl.job_uses < self.max_uses and len(idle) < self.size:
+                idle.append(ydl)
+                return
+        ydl.close()
+
+    @contextmanager
+    def acquire(self, platform: str, job_options: Optional[dict] = None,
+                progress_hook: Optional[Callable[[dict], None]] = None):
+        """Выдаёт YoutubeDL платформы с опциями задачи job_options (ключи из JOB_OPTIONS)."""
+        ydl = self._checkout(platform)
+        params = ydl.params
+        saved = {key: params.get(key) for key in JOB_OPTIONS}
+        saved_outtmpl = dict(params["outtmpl"])
+        saved_selector = ydl.format_selector
+        healthy = True
+        try:
+            for key, value in (job_options or {}).items():
+                if key == "outtmpl":
+                    params["outtmpl"]["default"] = value
+                elif key == "format":
+                    params["format"] = value
+                    ydl.format_selector = ydl.build_format_selector(value)
+                else:
+                    params[key] = value
+            ydl.job_progress_hook = progress_hook
+            ydl.job_uses += 1
+            yield ydl
+        except yt_dlp.utils.YoutubeDLError:
+            raise
+        except BaseException:
+            # неожиданная ошибка — состояние экземпляра непредсказуемо, в пул его не возвращаем
+            healthy = False
+            raise
+        finally:
+            ydl.job_progress_hook = None
+            params["outtmpl"] = saved_outtmpl
+            ydl.format_selector = saved_selector
+            for key, value in saved.items():
+                if key == "outtmpl":
+                    continue
+                if value is None:
+                    params.pop(key, None)
+                else:
+                    params[key] = value
+            if healthy:
+                self._checkin(platform, ydl)
+            else:
+                ydl.close()
+
+    def close(self) -> None:
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for instances in idle.values():
+            for ydl in instances:
+                try:
+                    ydl.close()
+                except Exception as e:
+                    logging.debug(f"Ошибка при закрытии YoutubeDL: {e}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            idle = sum(len(v) for v in self._idle.values())
+        return {"created": self.created, "reused": self.reused, "idle": idle}